@@ -1,19 +1,40 @@
+import asyncio
+import functools
+import hashlib
+import json
 import logging
+import math
 import os
-from typing import Optional
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
 
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from mangum import Mangum
-from dateutil.parser import isoparse
 
 from models import (Comment, NewComment, NewPost, Post, PostList, UpdateComment,
     UpdatedPost, CommentList, User, NewUser, UpdateUser, UserList)
+from models import PostBatchResult, CommentBatchResult, UserBatchResult, PostWithComments, PostListItem
+from models import Deletion, PostSearchResult, dumps, parse_timestamp
 import store as store
+import compression
+from conditional import conditional_response, is_conditional, is_current, item_etag, not_modified
+import instrumentation
+from snapshot import PageSnapshot
+import throttling
 
 URL_BASE = '/' + os.environ['BASE_PATH']
 
+# 'sync' runs the boto3 store in the threadpool, 'async' uses the aiobotocore store
+STORE_BACKEND = os.environ.get('BLOG_STORE_BACKEND', 'sync')
+if STORE_BACKEND == 'async':
+    import async_store as db
+else:
+    from async_store import ThreadpoolStore
+    db = ThreadpoolStore(store)
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -32,6 +53,11 @@ tags_metadata = [
     },
 ]
 
+class FastJSONResponse(JSONResponse):
+    '''Renders with orjson when it is installed, see models.dumps.'''
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
 app = FastAPI(
     title="Blog API",
     description="Example blog API",
@@ -40,6 +66,7 @@ app = FastAPI(
     openapi_url=URL_BASE + '/openapi.json',
     redoc_url=None,
     openapi_tags=tags_metadata,
+    default_response_class=FastJSONResponse,
 )
 
 app.add_middleware(
@@ -48,146 +75,528 @@ app.add_middleware(
     allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=['ETag', 'Retry-After', 'Server-Timing'],
 )
 
-handler = Mangum(app)
+app.add_middleware(throttling.DeadlineMiddleware)
+
+app.add_middleware(compression.CompressionMiddleware)
+
+# Outermost, so the timings cover the other middleware too
+app.add_middleware(instrumentation.InstrumentationMiddleware)
+
+@app.exception_handler(throttling.Shed)
+async def shed_response(request: Request, e: throttling.Shed) -> Response:
+    '''Fails requests fast while DynamoDB is throttling them: 429 when the rate
+    limit wouldn't let a call through in time, 503 when calls stayed throttled.'''
+    if isinstance(e, throttling.RateLimited):
+        status_code, detail = 429, 'Too many requests'
+    else:
+        status_code, detail = 503, 'Service overloaded'
+    return FastJSONResponse({'detail': detail}, status_code=status_code,
+                            headers={'Retry-After': str(max(1, math.ceil(e.retry_after)))})
+
+@app.on_event('startup')
+async def resume_deletions():
+    '''Picks up deletions that were interrupted, e.g. by a restart. With
+    several workers (see server.py), only the first one does.'''
+    if os.environ.get('BLOG_WORKER', '0') == '0':
+        await db.resume_deletions()
+
+@app.on_event('startup')
+async def load_search_index():
+    '''Loads the search index kept in BLOG_SEARCH_INDEX, rather than on the first search.'''
+    if store.SEARCH_INDEX_PATH is not None:
+        await db.get_search_index()
+
+# Seconds a worker shutting down waits for DynamoDB calls still in flight
+SHUTDOWN_TIMEOUT = float(os.environ.get('BLOG_SHUTDOWN_TIMEOUT', '10'))
+
+@app.on_event('shutdown')
+async def close_store():
+    '''Runs once the server has finished the requests it had. Calls made
+    outside of them, by prefetches and background deletions, are let finish
+    before the client is closed.'''
+    left = await throttling.drain(SHUTDOWN_TIMEOUT)
+    if left:
+        logger.warning('Closing the DynamoDB client with %d calls in flight', left)
+    await db.save_search_index()
+    await db.close()
+
+# Lifespan events are off, since Mangum 0.10 runs them around every
+# invocation. On Lambda, the warm-up pings resume deletions instead.
+_mangum = Mangum(app, lifespan='off')
+
+def handler(event, context):
+    '''Lambda entry point. Scheduled events with {"warmup": true} warm the instance up.'''
+    if event.get('warmup'):
+        return asyncio.get_event_loop().run_until_complete(warm_up())
+    return _mangum(event, context)
+
+async def warm_up() -> dict:
+    '''Connects to DynamoDB and resumes interrupted deletions.'''
+    started = time.perf_counter()
+    await db.warm_up()
+    resumed = await db.resume_deletions()
+    return {'warm': True, 'resumedDeletions': len(resumed), 'ms': round((time.perf_counter() - started) * 1000)}
+
+# With BLOG_WARM_ON_INIT=1, the DynamoDB connection is opened while a Lambda
+# instance initializes, rather than by its first request
+if os.environ.get('BLOG_WARM_ON_INIT') == '1':
+    asyncio.get_event_loop().run_until_complete(db.warm_up())
+
+MAX_BATCH_ITEMS = 1000
+
+# expand=author embeds each item's author, fetched with one BatchGetItem per page
+EXPAND_QUERY = Query(None, regex='^author$')
+
+# fields=title,slug returns only those fields of each item, read from DynamoDB
+# with a ProjectionExpression
+FIELDS_QUERY = Query(None, regex=r'^\w+(,\w+)*$')
+
+def model_response(result: Any, exclude_unset: bool = False) -> Response:
+    '''Serializes a model returned by the store, skipping FastAPI's validation of
+    it against the response_model. Store models are built from validated input
+    or from our own items, and validating them again costs more than the read.
+
+    exclude_unset must match the route's response_model_exclude_unset.'''
+    return FastJSONResponse(content=result.dict(exclude_unset=exclude_unset))
+
+def fields_response(result: Any, fields: Optional[tuple], exclude_unset: bool = True) -> Response:
+    '''Partial results always leave out unset fields.'''
+    return model_response(result, exclude_unset=exclude_unset or fields is not None)
+
+# Fields that change whenever the rest of a post or user does
+POST_VERSION_FIELDS = ('updated_at', 'comment_count', 'last_comment_at')
+USER_VERSION_FIELDS = ('updated_at',)
 
-@app.get(URL_BASE + '/posts', response_model=PostList, tags=['posts'])
-def list_posts(pageToken: Optional[str]=None, limit: int=20):
+def item_validators(key: str, item: Any, version_fields: Tuple[str, ...]) -> Tuple[str, datetime]:
+    '''ETag and Last-Modified of an item, or of a partial item with its version fields.'''
+    version = tuple(getattr(item, name) for name in version_fields)
+    return item_etag(key, *version), max(value for value in version if isinstance(value, datetime))
+
+async def item_response(request: Request, key: str, get: Callable[[store.Fields], Awaitable[Any]],
+    version_fields: Tuple[str, ...], exclude_unset: bool = False,
+    bodies: Optional[compression.CompressedBodies] = None) -> Response:
+    '''Serves a whole post or user, tagged by its key and version fields.
+
+    For conditional requests only the version fields are read first, so an
+    unchanged item is answered with 304 without reading or serializing it.
+    With bodies, compressed responses are kept there by ETag, which changes
+    with the version fields.'''
+    if is_conditional(request):
+        etag, last_modified = item_validators(key, await get(version_fields), version_fields)
+        if is_current(request, etag, last_modified):
+            return not_modified(request, etag, last_modified)
+    result = await get(None)
+    etag, last_modified = item_validators(key, result, version_fields)
+    if bodies is not None:
+        response = bodies.response(request, etag, lambda: model_response(result, exclude_unset=exclude_unset).body)
+    else:
+        response = model_response(result, exclude_unset=exclude_unset)
+    return conditional_response(request, response, etag, last_modified)
+
+# The first pages of GET /posts and GET /comments with the default limit are
+# served from pre-serialized snapshots, see snapshot.py
+DEFAULT_LIMIT = 20
+
+async def _posts_page(page_token: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    result = await db.list_posts(page_token, DEFAULT_LIMIT)
+    return fields_response(result, None).body, result.nextPageToken
+
+async def _comments_page(page_token: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    result = await db.list_comments(page_token, DEFAULT_LIMIT)
+    return fields_response(result, None).body, result.nextPageToken
+
+post_pages = PageSnapshot(_posts_page)
+comment_pages = PageSnapshot(_comments_page)
+
+# Compressed bodies of whole posts and of snapshot pages, so that they are
+# compressed once per version rather than on every request, see compression.py
+compressed_posts = compression.CompressedBodies()
+compressed_pages = compression.CompressedBodies()
+
+def snapshot_response(request: Request, body: bytes, etag: str) -> Response:
+    return conditional_response(request, compressed_pages.response(request, etag, lambda: body), etag)
+
+def changes_listings(route: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    '''Invalidates the listing snapshots once a write route has run. Posts list
+    their comment counts, so comment writes change both listings.'''
+    @functools.wraps(route)
+    async def write(*args, **kwargs):
+        try:
+            return await route(*args, **kwargs)
+        finally:
+            post_pages.invalidate()
+            comment_pages.invalidate()
+    return write
+
+def invalid_fields(e: store.InvalidFieldsError) -> JSONResponse:
+    return JSONResponse(content={'error': str(e)}, status_code=400)
+
+NDJSON = 'application/x-ndjson'
+
+def batch_too_large(items: List) -> Optional[JSONResponse]:
+    if len(items) > MAX_BATCH_ITEMS:
+        return JSONResponse(content={'error': f'At most {MAX_BATCH_ITEMS} items per batch'}, status_code=400)
+    return None
+
+@app.get(URL_BASE + '/posts', response_model=PostList, response_model_exclude_unset=True, tags=['posts'])
+async def list_posts(request: Request, pageToken: Optional[str]=None, limit: int=DEFAULT_LIMIT,
+                     expand: Optional[str]=EXPAND_QUERY, fields: Optional[str]=FIELDS_QUERY):
     '''List posts in the blog, ordered by created date (descending)'''
+    if limit == DEFAULT_LIMIT and expand is None and fields is None:
+        page = post_pages.get(pageToken)
+        if page is not None:
+            return snapshot_response(request, *page)
+    try:
+        fieldset = store.parse_fields(PostListItem, fields)
+        return conditional_response(request, fields_response(
+            await db.list_posts(pageToken, limit, expand_author=expand == 'author', fields=fieldset), fieldset))
+    except store.InvalidPageTokenError:
+        return JSONResponse(content={'error': 'pageToken is invalid'}, status_code=400)
+    except store.InvalidFieldsError as e:
+        return invalid_fields(e)
+
+@app.get(URL_BASE + '/posts:stream', tags=['posts'], response_class=StreamingResponse)
+async def stream_posts():
+    '''All posts as newline-delimited JSON, ordered by created date (descending).
+    Items are the same as those of list_posts.'''
+    return StreamingResponse(db.stream_posts(), media_type=NDJSON)
+
+@app.get(URL_BASE + '/posts:search', response_model=PostSearchResult, response_model_exclude_unset=True,
+         tags=['posts'])
+async def search_posts(request: Request, q: str=Query(..., max_length=1000), pageToken: Optional[str]=None,
+                       limit: int=Query(20, ge=1)):
+    '''Searches posts by the words in their titles and content. Posts with any
+    of the words of q are returned, the most relevant first, by their BM25 score.
+
+    Only the first 1000 results can be paged through.'''
     try:
-        return store.list_posts(pageToken, limit)
+        return conditional_response(request, model_response(await db.search_posts(q, pageToken, limit),
+                                                            exclude_unset=True))
     except store.InvalidPageTokenError:
         return JSONResponse(content={'error': 'pageToken is invalid'}, status_code=400)
 
-@app.post(URL_BASE + '/posts', response_model=Post, tags=['posts'])
-def create_post(post: NewPost):
+@app.post(URL_BASE + '/posts', response_model=Post, response_model_exclude_unset=True, tags=['posts'])
+@changes_listings
+async def create_post(post: NewPost):
     '''Creates a new post. slug must be unique.
     
-    The author specified in author_email must exist and must have the role 'Author'.'''
+    The author specified in author_email must exist and must have the role 'Author'.
+    This is checked in the same transaction as the write.'''
     try:
-        author = store.get_user(post.author_email)
-        assert author.role == 'Author'
-    except store.NotFoundError:
+        return model_response(await db.create_post(post), exclude_unset=True)
+    except store.UserNotFoundError:
         return JSONResponse(content={'error': 'User does not exist'}, status_code=400)
-    except AssertionError:
+    except store.NotAnAuthorError:
         return JSONResponse(content={'error': 'User is not an author'}, status_code=400)
-
-    try:
-        return store.create_post(post)
     except store.ResourceAlreadyExistsError:
         return JSONResponse(content={"error": "Post slug already exists"}, status_code=400)
 
-@app.get(URL_BASE + '/posts/{slug}', response_model=Post, tags=['posts'])
-def get_post(slug: str):
-    return store.get_post(slug)
+@app.post(URL_BASE + '/posts:batch', response_model=PostBatchResult, response_model_exclude_unset=True,
+          tags=['posts'])
+@changes_listings
+async def create_posts(posts: List[NewPost], transactional: bool=False):
+    '''Creates posts in bulk, reporting a result for each one.
+
+    Posts whose slug already exists are reported as conflicts and not written.
+    By default this is checked before writing, so a post created concurrently
+    can still be overwritten; with transactional=true the check is exact, at
+    twice the write cost.'''
+    return batch_too_large(posts) or model_response(await db.batch_create_posts(posts, transactional),
+                                                    exclude_unset=True)
+
+@app.get(URL_BASE + '/posts/{slug}', response_model=PostWithComments, response_model_exclude_unset=True,
+         tags=['posts'])
+async def get_post(request: Request, slug: str, include: Optional[str]=Query(None, regex='^comments$'),
+                   commentLimit: int=Query(20, ge=1, le=100), fields: Optional[str]=FIELDS_QUERY):
+    '''Gets a post. With include=comments, the first page of its comments is
+    returned too, read from DynamoDB together with the post.
 
-@app.put(URL_BASE + '/posts/{slug}', response_model=Post, tags=['posts'])
-def update_post(slug: str, post: UpdatedPost):
+    With fields, only those fields are returned, so large posts can be
+    checked without reading their content.
+
+    Responses have an ETag, and whole posts a Last-Modified too. Requests with
+    If-None-Match or If-Modified-Since get 304 when the post is unchanged.
+    Whole posts are compressed once per version for each Accept-Encoding.'''
     try:
-        author = store.get_user(post.author_email)
-        assert author.role == 'Author'
+        if include == 'comments':
+            if fields is not None:
+                return JSONResponse(content={'error': "fields can't be combined with include"}, status_code=400)
+            return conditional_response(request, model_response(
+                await db.get_post_with_comments(slug, commentLimit), exclude_unset=True))
+        fieldset = store.parse_fields(Post, fields)
+        if fieldset is not None:
+            return conditional_response(request, fields_response(await db.get_post(slug, fields=fieldset), fieldset))
+        return await item_response(request, f'P#{slug}', lambda fields: db.get_post(slug, fields=fields),
+                                   POST_VERSION_FIELDS, exclude_unset=True, bodies=compressed_posts)
     except store.NotFoundError:
+        return JSONResponse(content={"error": "Post not found"}, status_code=404)
+    except store.InvalidFieldsError as e:
+        return invalid_fields(e)
+
+@app.put(URL_BASE + '/posts/{slug}', response_model=Post, response_model_exclude_unset=True, tags=['posts'])
+@changes_listings
+async def update_post(slug: str, post: UpdatedPost):
+    try:
+        return model_response(await db.update_post(slug, post), exclude_unset=True)
+    except store.UserNotFoundError:
         return JSONResponse(content={'error': 'User does not exist'}, status_code=400)
-    except AssertionError:
+    except store.NotAnAuthorError:
         return JSONResponse(content={'error': 'User is not an author'}, status_code=400)
-    
-    return store.update_post(slug, post)
+    except store.NotFoundError:
+        return JSONResponse(content={'error': 'Post not found'}, status_code=404)
 
 @app.delete(URL_BASE + '/posts/{slug}', status_code=204, tags=['posts'])
-def delete_post(slug: str):
-    store.delete_post(slug)
+@changes_listings
+async def delete_post(slug: str):
+    '''Deletes a post. Its comments are deleted in the background, see
+    get_post_deletion for the progress.'''
+    await db.delete_post(slug)
     return ''
 
-@app.get(URL_BASE + '/comments/', response_model=CommentList, tags=['comments'])
-def list_comments(pageToken: Optional[str]=None, limit: int=20):
+@app.get(URL_BASE + '/posts/{slug}/deletion', response_model=Deletion, tags=['posts'])
+async def get_post_deletion(slug: str):
+    '''Progress of deleting the comments of a deleted post'''
     try:
-        return store.list_comments(pageToken, limit)
+        return model_response(await db.get_deletion('post', slug))
+    except store.NotFoundError:
+        return JSONResponse(content={"error": "Post deletion not found"}, status_code=404)
+
+@app.get(URL_BASE + '/comments/', response_model=CommentList, response_model_exclude_unset=True, tags=['comments'])
+async def list_comments(request: Request, pageToken: Optional[str]=None, limit: int=DEFAULT_LIMIT,
+                        expand: Optional[str]=EXPAND_QUERY, fields: Optional[str]=FIELDS_QUERY):
+    if limit == DEFAULT_LIMIT and expand is None and fields is None:
+        page = comment_pages.get(pageToken)
+        if page is not None:
+            return snapshot_response(request, *page)
+    try:
+        fieldset = store.parse_fields(Comment, fields)
+        return conditional_response(request, fields_response(
+            await db.list_comments(pageToken, limit, expand_author=expand == 'author', fields=fieldset), fieldset))
     except store.InvalidPageTokenError:
         return JSONResponse(content={'error': 'pageToken is invalid'}, status_code=400)
+    except store.InvalidFieldsError as e:
+        return invalid_fields(e)
 
-@app.post(URL_BASE + '/posts/{slug}/comments/', response_model=Comment, tags=['comments'])
-def create_comment(slug: str, comment: NewComment):
-    try:
-        store.get_user(comment.author_email)
-    except store.NotFoundError:
-        return JSONResponse(content={'error': 'User does not exist'}, status_code=400)
+@app.get(URL_BASE + '/comments:stream', tags=['comments'], response_class=StreamingResponse)
+async def stream_comments():
+    '''All comments as newline-delimited JSON, ordered by created date (descending)'''
+    return StreamingResponse(db.stream_comments(), media_type=NDJSON)
 
+@app.post(URL_BASE + '/posts/{slug}/comments/', response_model=Comment, response_model_exclude_unset=True, tags=['comments'])
+@changes_listings
+async def create_comment(slug: str, comment: NewComment):
     try:
-        return store.create_comment(slug, comment)
+        return model_response(await db.create_comment(slug, comment), exclude_unset=True)
+    except store.PostNotFoundError:
+        return JSONResponse(content={'error': 'Post not found'}, status_code=404)
+    except store.UserNotFoundError:
+        return JSONResponse(content={'error': 'User does not exist'}, status_code=400)
     except store.ResourceAlreadyExistsError:
         return JSONResponse(content={"error": "Too many comments at once"}, status_code=429)
 
-@app.get(URL_BASE + '/posts/{slug}/comments/', response_model=CommentList, tags=['comments'])
-def list_comments_for_post(slug: str, pageToken: Optional[str]=None, limit: int=2):
+@app.post(URL_BASE + '/posts/{slug}/comments:batch', response_model=CommentBatchResult, response_model_exclude_unset=True,
+          tags=['comments'])
+@changes_listings
+async def create_comments(slug: str, comments: List[NewComment], transactional: bool=False):
+    '''Creates comments on a post in bulk, reporting a result for each one.'''
+    try:
+        return batch_too_large(comments) or model_response(
+            await db.batch_create_comments(slug, comments, transactional), exclude_unset=True)
+    except store.PostNotFoundError:
+        return JSONResponse(content={'error': 'Post not found'}, status_code=404)
+
+@app.get(URL_BASE + '/posts/{slug}/comments/', response_model=CommentList, response_model_exclude_unset=True,
+         tags=['comments'])
+async def list_comments_for_post(request: Request, slug: str, pageToken: Optional[str]=None, limit: int=2,
+                                 expand: Optional[str]=EXPAND_QUERY, fields: Optional[str]=FIELDS_QUERY):
     try:
-        return store.list_comments_for_post(slug, pageToken, limit)
+        fieldset = store.parse_fields(Comment, fields)
+        return conditional_response(request, fields_response(await db.list_comments_for_post(
+            slug, pageToken, limit, expand_author=expand == 'author', fields=fieldset), fieldset))
     except store.InvalidPageTokenError:
         return JSONResponse(content={'error': 'pageToken is invalid'}, status_code=400)
+    except store.InvalidFieldsError as e:
+        return invalid_fields(e)
 
-@app.put(URL_BASE + '/posts/{slug}/comments/{author}/{date}', response_model=Comment, tags=['comments'])
-def update_comment(slug: str, author: str, date: str, comment: UpdateComment):
-    return store.update_comment(slug, author, isoparse(date), comment)
+@app.put(URL_BASE + '/posts/{slug}/comments/{author}/{date}', response_model=Comment, response_model_exclude_unset=True,
+         tags=['comments'])
+@changes_listings
+async def update_comment(slug: str, author: str, date: str, comment: UpdateComment):
+    return model_response(await db.update_comment(slug, author, parse_timestamp(date), comment), exclude_unset=True)
 
 @app.delete(URL_BASE + '/posts/{slug}/comments/{author}/{date}', status_code=204, tags=['comments'])
-def delete_comment(slug: str, author: str, date: str):
-    store.delete_comment(slug, author, isoparse(date))
+@changes_listings
+async def delete_comment(slug: str, author: str, date: str):
+    await db.delete_comment(slug, author, parse_timestamp(date))
     return ''
 
 
 @app.post(URL_BASE + '/users/', response_model=User, tags=['users'])
-def create_user(user: NewUser):
+async def create_user(user: NewUser):
     try:
-        return store.create_user(user)
+        return model_response(await db.create_user(user))
     except store.ResourceAlreadyExistsError:
         return JSONResponse(content={"error": "User already exists with that email"}, status_code=400)
 
+@app.get(URL_BASE + '/users:stream', tags=['users'], response_class=StreamingResponse)
+async def stream_users():
+    '''All users as newline-delimited JSON, ordered by created date (descending)'''
+    return StreamingResponse(db.stream_users(), media_type=NDJSON)
+
+@app.post(URL_BASE + '/users:batch', response_model=UserBatchResult, tags=['users'])
+async def create_users(users: List[NewUser], transactional: bool=False):
+    '''Creates users in bulk, reporting a result for each one.
+
+    Users whose email already exists are reported as conflicts, see create_posts.'''
+    return batch_too_large(users) or model_response(await db.batch_create_users(users, transactional))
+
 @app.get(URL_BASE + '/users/{email}/', response_model=User, tags=['users'])
-def get_user(email: str):
+async def get_user(request: Request, email: str, fields: Optional[str]=FIELDS_QUERY):
     try:
-        return store.get_user(email)
+        fieldset = store.parse_fields(User, fields)
+        if fieldset is not None:
+            return conditional_response(request, fields_response(
+                await db.get_user(email, fields=fieldset), fieldset, exclude_unset=False))
+        return await item_response(request, f'U#{email}', lambda fields: db.get_user(email, fields=fields),
+                                   USER_VERSION_FIELDS)
     except store.NotFoundError:
         return JSONResponse(content={"error": "User not found"}, status_code=404)
+    except store.InvalidFieldsError as e:
+        return invalid_fields(e)
 
 @app.put(URL_BASE + '/users/{email}/', response_model=User, tags=['users'])
-def update_user(email: str, user: UpdateUser):
-    return store.update_user(email, user)
+async def update_user(email: str, user: UpdateUser):
+    return model_response(await db.update_user(email, user))
 
 @app.delete(URL_BASE + '/users/{email}/', status_code=204, tags=['users'])
-def delete_user(email: str):
-    store.delete_user(email)
+@changes_listings
+async def delete_user(email: str):
+    '''Deletes a user. Their posts and comments are deleted in the background,
+    see get_user_deletion for the progress.'''
+    await db.delete_user(email)
     return ''
 
+@app.get(URL_BASE + '/users/{email}/deletion', response_model=Deletion, tags=['users'])
+async def get_user_deletion(email: str):
+    '''Progress of deleting the posts and comments of a deleted user'''
+    try:
+        return model_response(await db.get_deletion('user', email))
+    except store.NotFoundError:
+        return JSONResponse(content={"error": "User deletion not found"}, status_code=404)
+
 @app.get(URL_BASE + '/users/', response_model=UserList, tags=['users'])
-def list_users(pageToken: Optional[str]=None, limit: int=20):
+async def list_users(request: Request, pageToken: Optional[str]=None, limit: int=20,
+                     fields: Optional[str]=FIELDS_QUERY):
     try:
-        return store.list_users(pageToken, limit)
+        fieldset = store.parse_fields(User, fields)
+        return conditional_response(request, fields_response(
+            await db.list_users(pageToken, limit, fields=fieldset), fieldset, exclude_unset=False))
     except store.InvalidPageTokenError:
         return JSONResponse(content={'error': 'pageToken is invalid'}, status_code=400)
+    except store.InvalidFieldsError as e:
+        return invalid_fields(e)
 
-@app.get(URL_BASE + '/users/{email}/posts', response_model=PostList, tags=['posts'])
-def list_posts_for_author(email: str, pageToken: Optional[str]=None, limit: int=20):
+@app.get(URL_BASE + '/users/{email}/posts', response_model=PostList, response_model_exclude_unset=True, tags=['posts'])
+async def list_posts_for_author(request: Request, email: str, pageToken: Optional[str]=None, limit: int=20,
+                                expand: Optional[str]=EXPAND_QUERY, fields: Optional[str]=FIELDS_QUERY):
     '''List posts in the blog, ordered by created date (descending)'''
     try:
-        return store.list_posts_for_author(email, pageToken, limit)
+        fieldset = store.parse_fields(PostListItem, fields)
+        return conditional_response(request, fields_response(await db.list_posts_for_author(
+            email, pageToken, limit, expand_author=expand == 'author', fields=fieldset), fieldset))
     except store.InvalidPageTokenError:
         return JSONResponse(content={'error': 'pageToken is invalid'}, status_code=400)
+    except store.InvalidFieldsError as e:
+        return invalid_fields(e)
 
-@app.get(URL_BASE + '/users/{email}/comments', response_model=PostList, tags=['comments'])
-def list_comments_for_author(email: str, pageToken: Optional[str]=None, limit: int=20):
-    '''List posts in the blog, ordered by created date (descending)'''
+@app.get(URL_BASE + '/users/{email}/comments', response_model=CommentList, response_model_exclude_unset=True,
+         tags=['comments'])
+async def list_comments_for_author(request: Request, email: str, pageToken: Optional[str]=None, limit: int=20,
+                                   fields: Optional[str]=FIELDS_QUERY):
+    '''List comments by the user, ordered by created date (descending)'''
     try:
-        return store.list_comments_for_author(email, pageToken, limit)
+        fieldset = store.parse_fields(Comment, fields)
+        return conditional_response(request, fields_response(
+            await db.list_comments_for_author(email, pageToken, limit, fields=fieldset), fieldset))
     except store.InvalidPageTokenError:
         return JSONResponse(content={'error': 'pageToken is invalid'}, status_code=400)
+    except store.InvalidFieldsError as e:
+        return invalid_fields(e)
+
+
+def response_cache_stats() -> dict:
+    return {'post_pages': post_pages.stats(), 'comment_pages': comment_pages.stats(),
+            'compressed_posts': compressed_posts.stats(), 'compressed_pages': compressed_pages.stats()}
+
+@app.get(URL_BASE + '/stats/cache', include_in_schema=False)
+async def cache_stats():
+    '''Counters of the in-process user and post caches, of the listing snapshots
+    and of the compressed posts and pages'''
+    return {**store.cache_stats(), **response_cache_stats()}
+
+@app.get(URL_BASE + '/metrics', include_in_schema=False)
+async def metrics():
+    '''Request, DynamoDB, cache and coalescing metrics of this process, in the Prometheus text format'''
+    return PlainTextResponse(instrumentation.render({**store.cache_stats(), **response_cache_stats()},
+                                                    store.coalescing_stats()),
+                             media_type=instrumentation.CONTENT_TYPE)
+
+
+# The OpenAPI document can be written ahead of time with
+# `python app/api.py --write-openapi`, so the first docs request of an instance
+# doesn't generate it. It is only used while api.py and models.py are
+# unchanged since; otherwise it is generated as usual.
+OPENAPI_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'openapi.json')
+
+def _source_digest() -> str:
+    digest = hashlib.sha256()
+    for module in ('api.py', 'models.py'):
+        with open(os.path.join(os.path.dirname(OPENAPI_PATH), module), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def openapi() -> dict:
+    if app.openapi_schema is None:
+        try:
+            with open(OPENAPI_PATH) as f:
+                schema = json.load(f)
+        except FileNotFoundError:
+            schema = None
+        if schema is not None and schema.pop('x-source-digest', None) == _source_digest():
+            app.openapi_schema = schema
+        else:
+            FastAPI.openapi(app)
+    return app.openapi_schema
+
+app.openapi = openapi
+
+def write_openapi():
+    with open(OPENAPI_PATH, 'w') as f:
+        json.dump({**FastAPI.openapi(app), 'x-source-digest': _source_digest()}, f, separators=(',', ':'))
 
 
 if __name__ == '__main__':
     import argparse
-    import uvicorn
+    import server
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', default='0.0.0.0')
     parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--storage', choices=['dynamodb', 'memory'], default=None,
+                        help='storage engine, defaults to BLOG_STORAGE_ENGINE or dynamodb')
+    parser.add_argument('--write-openapi', action='store_true',
+                        help=f'write the OpenAPI document to {os.path.basename(OPENAPI_PATH)} and exit')
     args = parser.parse_args()
 
-    uvicorn.run(app, host=args.host, port=args.port, log_level='info')
\ No newline at end of file
+    if args.write_openapi:
+        write_openapi()
+        raise SystemExit
+
+    if args.storage:
+        from backends import create_backend
+        store.dynamodb = create_backend(args.storage)
+
+    # A single process, see server.py to run several
+    server.serve(app, host=args.host, port=args.port)
\ No newline at end of file
@@ -0,0 +1,521 @@
+'''Non-blocking counterpart of store.py, built on aiobotocore.
+
+The operations mirror those in store.py and share its item builders, page
+token handling and exceptions. A single DynamoDB client (and so a single
+connection pool) is shared by every request in the worker process. Operations
+that don't have a native async implementation here fall back to the blocking
+version in store.py, run in the threadpool.
+'''
+import asyncio
+import contextvars
+from datetime import datetime
+import inspect
+import os
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from botocore.exceptions import ClientError
+from starlette.concurrency import run_in_threadpool
+
+from models import NewPost, Post, PostList, PostListItem, UpdatedPost, PostWithComments
+from models import Comment, CommentList, NewComment, UpdateComment
+from models import UpdateUser, NewUser, User, UserList
+from models import partial_from_dynamo_item, partial_from_model
+import instrumentation
+import store
+import throttling
+from backends import AsyncBackend, StorageBackend, client_config_options
+from cache import SingleFlight
+from store import (NotFoundError, ResourceAlreadyExistsError, InvalidPageTokenError,
+    PageToken, PostNotFoundError)
+
+
+class ThreadpoolStore:
+    '''Exposes the functions of a blocking store module as coroutines.
+
+    Each call is run in the threadpool, so it doesn't block the event loop.
+    Generator functions are returned as they are, for StreamingResponse to
+    iterate in the threadpool.'''
+    def __init__(self, module):
+        self._module = module
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._module, name)
+        if not callable(attr) or isinstance(attr, type) or inspect.isgeneratorfunction(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            return await run_in_threadpool(attr, *args, **kwargs)
+        return call
+
+    async def close(self):
+        pass
+
+
+_sync_fallback = ThreadpoolStore(store)
+
+def __getattr__(name: str):
+    return getattr(_sync_fallback, name)
+
+
+_client = None
+_client_context = None
+_client_loop = None
+_client_lock = None
+_in_process_client: Optional[Tuple[StorageBackend, AsyncBackend]] = None
+
+async def get_client():
+    '''Returns the shared DynamoDB client, creating it on first use.
+
+    The client is bound to the event loop it was created in, so it is
+    recreated if called from a different loop. When store.py runs on an
+    in-process backend, that backend is used instead.'''
+    global _client, _client_context, _client_loop, _client_lock, _in_process_client
+    if isinstance(store.dynamodb, StorageBackend):
+        # Without the blocking flow control of store.py's client, which would sleep on the event loop
+        if _in_process_client is None or _in_process_client[0] is not store.dynamodb:
+            client = throttling.guard_async(AsyncBackend(throttling.unguarded(store.dynamodb)))
+            _in_process_client = (store.dynamodb, client)
+        return _in_process_client[1]
+
+    loop = asyncio.get_running_loop()
+    if _client is not None and _client_loop is loop:
+        return _client
+
+    if _client_lock is None or _client_loop is not loop:
+        _client_lock = asyncio.Lock()
+        _client = None
+        _client_loop = loop
+    async with _client_lock:
+        if _client is None:
+            from aiobotocore.config import AioConfig
+            from aiobotocore.session import get_session
+
+            config = AioConfig(**client_config_options())
+            _client_context = get_session().create_client('dynamodb', config=config)
+            _client = throttling.guard_async(instrumentation.instrument(await _client_context.__aenter__()))
+    return _client
+
+def _after_fork():
+    '''A forked worker creates a client of its own, see store._after_fork.'''
+    global _client, _client_context, _client_loop, _client_lock
+    _client = _client_context = _client_loop = _client_lock = None
+
+if hasattr(os, 'register_at_fork'):  # not on Windows
+    os.register_at_fork(after_in_child=_after_fork)
+
+async def warm_up():
+    '''Creates the shared client and opens a connection, see store.warm_up.'''
+    dynamodb = await get_client()
+    await dynamodb.get_item(
+        TableName=os.environ['BLOG_TABLE'],
+        Key={'PK': {'S': 'WARMUP'}, 'SK': {'S': 'WARMUP'}},
+        ProjectionExpression='PK',
+    )
+
+async def close():
+    '''Closes the shared client and its connection pool.'''
+    global _client, _client_context
+    if _client_context is not None:
+        await _client_context.__aexit__(None, None, None)
+    _client = None
+    _client_context = None
+
+
+async def _coalesced(flights: SingleFlight, call: Callable[..., Awaitable[Dict[str, Any]]],
+    args: Dict[str, Any]) -> Dict[str, Any]:
+    '''Shares a read with concurrent identical ones of this event loop, see store.COALESCE_READS.'''
+    if not store.COALESCE_READS:
+        return await call(**args)
+    return await flights.do_async(store._flight_key(args), lambda: call(**args))
+
+
+async def get_post(slug: str, fields: store.Fields = None) -> Post:
+    post = store.post_cache.get(slug)
+    if post is not None:
+        return partial_from_model(post, fields) if fields is not None else post
+
+    dynamodb = await get_client()
+    result = await _coalesced(store.get_item_flights, dynamodb.get_item, store._get_post_args(slug, fields))
+    if 'Item' not in result:
+        raise NotFoundError
+    if fields is not None:
+        return partial_from_dynamo_item(Post, fields, result['Item'])
+    post = Post.from_dynamo_item(result['Item'])
+    store.post_cache.put(slug, post)
+    return post
+
+
+async def create_post(post: NewPost) -> Post:
+    dynamodb = await get_client()
+    item = store._new_post_item(post, datetime.now().isoformat())
+    try:
+        await dynamodb.transact_write_items(TransactItems=store._create_transaction(item, require_author=True))
+    except ClientError as e:
+        store._raise_cancellation(e, store.CREATE_ERRORS)
+    store._listings_changed('Post')
+
+    post = Post.from_dynamo_item(item)
+    store._post_indexed(post)
+    return post
+
+
+async def update_post(slug: str, post: UpdatedPost) -> Post:
+    dynamodb = await get_client()
+    updated_at = datetime.now().isoformat()
+    unchanged = asyncio.ensure_future(dynamodb.get_item(**store._unchanged_post_args(slug)))
+    try:
+        await dynamodb.transact_write_items(TransactItems=store._update_post_transaction(slug, post, updated_at))
+    except ClientError as e:
+        unchanged.cancel()
+        store._raise_cancellation(e, store.UPDATE_POST_ERRORS)
+    store.post_cache.invalidate(slug)
+    store._listings_changed('Post')
+
+    result = await unchanged
+    if 'Item' not in result:
+        # Created after the read and before the transaction
+        result = await dynamodb.get_item(**store._unchanged_post_args(slug))
+    updated = store._updated_post(slug, post, updated_at, result)
+    store._post_indexed(updated)
+    return updated
+
+async def delete_post(slug: str):
+    dynamodb = await get_client()
+    await dynamodb.transact_write_items(TransactItems=store._start_deletion_transaction('post', slug, f'P#{slug}'))
+    store.post_cache.invalidate(slug)
+    store._listings_changed('Post')
+    store._post_unindexed(slug)
+    store.schedule_deletion('post', slug)
+
+
+# Prefetches running, referenced so that they aren't garbage collected
+_prefetch_tasks: set = set()
+
+async def _prefetch(entityType: str, key: Tuple, read: Callable[[], Awaitable[store.Page]]):
+    try:
+        with instrumentation.recording(instrumentation.RequestMetrics()) as metrics:
+            page = await read()
+        store._store_prefetched(entityType, key, page, metrics)
+    except Exception:
+        store.logger.warning('Prefetching a page of %s failed', entityType, exc_info=True)
+    finally:
+        with store._prefetching_lock:
+            store._prefetching.discard(key)
+
+async def _read_page(entityType: str, base_args: Dict[str, Any], page_token: Optional[PageToken], limit: int,
+    read: Callable[[Optional[PageToken]], Awaitable[store.Page]]) -> store.Page:
+    '''Reads a page of a listing with read, unless it was prefetched, and prefetches the next one.'''
+    page = store._prefetched_page(entityType, base_args, page_token, limit) or await read(page_token)
+    key = store._next_page_key(entityType, base_args, page, limit)
+    if key is not None:
+        # In a context of its own, so the read doesn't count towards the request
+        task = contextvars.Context().run(asyncio.ensure_future, _prefetch(entityType, key, lambda: read(page[1])))
+        _prefetch_tasks.add(task)
+        task.add_done_callback(_prefetch_tasks.discard)
+    return page
+
+async def get_page_for_entity(entityType: str, page_token: Optional[PageToken], limit: int=20,
+    projection: Optional[Dict[str, Any]]=None) -> store.Page:
+    store._check_shard_keys(page_token)
+    base_args = {**store._entity_page_query(entityType)[0], **(projection or {})}
+    return await _read_page(entityType, base_args, page_token, limit,
+                            lambda token: _get_entity_page(entityType, token, limit, projection))
+
+async def _get_entity_page(entityType: str, page_token: Optional[PageToken], limit: int=20,
+    projection: Optional[Dict[str, Any]]=None) -> store.Page:
+    if store.ENTITY_SHARDS > 1:
+        return await _get_sharded_page(entityType, page_token, limit, projection)
+    base_args, index_keys = store._entity_page_query(entityType)
+    return await _get_page({**base_args, **(projection or {})}, index_keys, page_token, limit)
+
+async def get_page_for_author_entity(author: str, entityType: str, page_token: Optional[PageToken],
+    limit: int=20, projection: Optional[Dict[str, Any]]=None) -> store.Page:
+    base_args, index_keys = store._author_entity_page_query(author, entityType)
+    base_args = {**base_args, **(projection or {})}
+    return await _read_page(entityType, base_args, page_token, limit,
+                            lambda token: _get_page(base_args, index_keys, token, limit))
+
+async def _get_page(base_args: Dict[str, Any], index_keys: List[str], page_token: Optional[PageToken], limit: int=20
+    ) -> Tuple[List[Any], Optional[PageToken], Optional[PageToken]]:
+    args = store._page_query_args(base_args, page_token, limit)
+    results = await _query_page_items(args, limit)
+    return store._build_page(results, index_keys, page_token, limit)
+
+async def _query_page_items(args: Dict[str, Any], limit: int) -> List[Any]:
+    dynamodb = await get_client()
+    count = 0
+    results = []
+    while True:
+        response = await _coalesced(store.query_flights, dynamodb.query, args)
+        results.extend(response['Items'])
+        count += len(response['Items'])
+        if count >= limit:
+            break
+        elif 'LastEvaluatedKey' not in response:
+            break
+        else:
+            args['Limit'] = limit - count
+            args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return results
+
+async def _get_sharded_page(entityType: str, page_token: Optional[PageToken], limit: int=20,
+    projection: Optional[Dict[str, Any]]=None) -> Tuple[List[Any], Optional[PageToken], Optional[PageToken]]:
+    shard_args = [store._shard_page_args(entityType, shard, page_token, limit, projection)
+                  for shard in range(store.ENTITY_SHARDS)]
+    shard_results = await asyncio.gather(*(_query_page_items(args, limit) for args in shard_args))
+    return store._merge_shard_pages(list(shard_results), page_token, limit)
+
+
+async def _batch_get(keys: List[Dict[str, Any]], projection: Optional[str]=None) -> List[Dict[str, Any]]:
+    '''Fetches items with BatchGetItem, in concurrent chunks of 100 keys, retrying unprocessed keys.'''
+    chunks = [keys[i:i + store.BATCH_GET_SIZE] for i in range(0, len(keys), store.BATCH_GET_SIZE)]
+    results = await asyncio.gather(*(_batch_get_chunk(chunk, projection) for chunk in chunks))
+    return [item for items in results for item in items]
+
+async def _batch_get_chunk(keys: List[Dict[str, Any]], projection: Optional[str]=None) -> List[Dict[str, Any]]:
+    dynamodb = await get_client()
+    table = os.environ['BLOG_TABLE']
+    request: Dict[str, Any] = {'Keys': keys}
+    if projection:
+        request['ProjectionExpression'] = projection
+    items = []
+    attempt = 0
+    while True:
+        started = time.monotonic()
+        response = await dynamodb.batch_get_item(RequestItems={table: request})
+        items.extend(response['Responses'].get(table, []))
+        unprocessed = response.get('UnprocessedKeys', {}).get(table)
+        if not unprocessed:
+            return items
+        delay = throttling.unprocessed_backoff('BatchGetItem', attempt, time.monotonic() - started)
+        if delay is None:
+            raise throttling.Overloaded(throttling.OVERLOADED_RETRY_AFTER)
+        await asyncio.sleep(delay)
+        request = unprocessed
+        attempt += 1
+
+async def _expand_authors(items: List[Any]):
+    users, missing = store._cached_authors(items)
+    store._set_authors(items, users, await _batch_get(store._user_keys(missing)))
+
+
+async def list_posts(pageToken: Optional[str] = None, limit: int = 2, expand_author: bool = False, fields: store.Fields=None) -> PostList:
+    page = store._decode_page_token(pageToken)
+
+    items, nextToken, prevToken = await get_page_for_entity('Post', page, limit=limit,
+        projection=store._page_projection(PostListItem, fields, expand_author))
+
+    parsed_items = store._parse_page_items(PostListItem, items, fields, expand_author)
+    if expand_author:
+        await _expand_authors(parsed_items)
+    return PostList.construct(
+        posts=parsed_items,
+        nextPageToken=nextToken.encode() if nextToken else None,
+        prevPageToken=prevToken.encode() if prevToken else None,
+    )
+
+
+async def create_comment(post_slug: str, comment: NewComment) -> Comment:
+    dynamodb = await get_client()
+    item = store._new_comment_item(post_slug, comment, datetime.now().isoformat())
+    try:
+        await dynamodb.transact_write_items(TransactItems=store._create_comment_transaction(item))
+    except ClientError as e:
+        store._raise_cancellation(e, store.CREATE_COMMENT_ERRORS)
+    store.post_cache.invalidate(post_slug)
+    store._listings_changed('Comment', 'Post')
+
+    return Comment.from_dynamo_item(item)
+
+async def update_comment(post_slug: str, author: str, date: datetime, comment: UpdateComment) -> Comment:
+    dynamodb = await get_client()
+    result = await dynamodb.update_item(
+        TableName=os.environ['BLOG_TABLE'],
+        ReturnValues='ALL_NEW',
+        Key={'PK': {'S': f'P#{post_slug}'}, 'SK': {'S': f'C#{date.isoformat()}#{author}'}},
+        UpdateExpression='SET Comment=:content, UpdatedAt=:updated_at',
+        ExpressionAttributeValues={
+            ':content': {'S': comment.content},
+            ':updated_at': {'S': datetime.now().isoformat()},
+        },
+    )
+    store._listings_changed('Comment')
+    return Comment.from_dynamo_item(result['Attributes'])
+
+async def delete_comment(post_slug: str, author: str, date: datetime) -> None:
+    dynamodb = await get_client()
+    try:
+        try:
+            await dynamodb.transact_write_items(
+                TransactItems=store._delete_comment_transaction(post_slug, author, date))
+        except ClientError as e:
+            store._raise_cancellation(e, store.DELETE_COMMENT_ERRORS)
+    except PostNotFoundError:
+        await dynamodb.delete_item(**store._comment_key_args(post_slug, author, date))
+    except NotFoundError:
+        pass
+    store.post_cache.invalidate(post_slug)
+    store._listings_changed('Comment', 'Post')
+
+async def list_comments_for_post(post_slug: str, pageToken: Optional[str]=None, limit: int=20, expand_author: bool=False, fields: store.Fields=None) -> CommentList:
+    page = store._decode_page_token(pageToken)
+
+    base_args, index_keys = store._post_comments_page_query(post_slug)
+    base_args = {**base_args, **(store._page_projection(Comment, fields, expand_author) or {})}
+    items, nextToken, prevToken = await _read_page('Comment', base_args, page, limit,
+                                                   lambda token: _get_page(base_args, index_keys, token, limit))
+
+    parsed_items = store._parse_page_items(Comment, items, fields, expand_author)
+    if expand_author:
+        await _expand_authors(parsed_items)
+    return CommentList.construct(
+        comments=parsed_items,
+        nextPageToken=nextToken.encode() if nextToken else None,
+        prevPageToken=prevToken.encode() if prevToken else None,
+    )
+
+async def get_post_with_comments(post_slug: str, limit: int=20) -> PostWithComments:
+    items = await _query_page_items(store._post_with_comments_args(post_slug, limit), limit + 1)
+    return store._split_post_and_comments(post_slug, items, limit)
+
+async def list_comments(pageToken: Optional[str]=None, limit: int=20, expand_author: bool=False, fields: store.Fields=None) -> CommentList:
+    page = store._decode_page_token(pageToken)
+
+    items, nextToken, prevToken = await get_page_for_entity('Comment', page, limit=limit,
+        projection=store._page_projection(Comment, fields, expand_author))
+
+    parsed_items = store._parse_page_items(Comment, items, fields, expand_author)
+    if expand_author:
+        await _expand_authors(parsed_items)
+    return CommentList.construct(
+        comments=parsed_items,
+        nextPageToken=nextToken.encode() if nextToken else None,
+        prevPageToken=prevToken.encode() if prevToken else None,
+    )
+
+
+async def get_user(email: str, fields: store.Fields = None) -> User:
+    user = store.user_cache.get(email)
+    if user is not None:
+        return partial_from_model(user, fields) if fields is not None else user
+
+    dynamodb = await get_client()
+    result = await _coalesced(store.get_item_flights, dynamodb.get_item, store._get_user_args(email, fields))
+    if 'Item' not in result:
+        raise NotFoundError
+    if fields is not None:
+        return partial_from_dynamo_item(User, fields, result['Item'])
+
+    user = User.from_dynamo_item(result['Item'])
+    store.user_cache.put(email, user)
+    return user
+
+async def create_user(user: NewUser) -> User:
+    dynamodb = await get_client()
+    item = store._new_user_item(user, datetime.now().isoformat())
+    try:
+        await dynamodb.put_item(
+            TableName=os.environ['BLOG_TABLE'],
+            Item=item,
+            ConditionExpression='attribute_not_exists(PK)', # Prevent overwriting
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            raise ResourceAlreadyExistsError
+        else:
+            raise
+    store._listings_changed('User')
+
+    return User.from_dynamo_item(item)
+
+async def update_user(email: str, user: UpdateUser) -> User:
+    dynamodb = await get_client()
+    result = await dynamodb.update_item(
+        TableName=os.environ['BLOG_TABLE'],
+        ReturnValues='ALL_NEW',
+        Key={'PK': {'S': f'U#{email}'}, 'SK': {'S': f'U#{email}'}},
+        UpdateExpression='SET FirstName=:first_name, LastName=:last_name, Role=:role, UpdatedAt=:updated_at',
+        ExpressionAttributeValues={
+            ':first_name': {'S': user.first_name},
+            ':last_name': {'S': user.last_name},
+            ':role': {'S': user.role},
+            ':updated_at': {'S': datetime.now().isoformat()},
+        },
+    )
+    store.user_cache.invalidate(email)
+    store._listings_changed('User')
+    return User.from_dynamo_item(result['Attributes'])
+
+async def delete_user(email: str):
+    dynamodb = await get_client()
+    await dynamodb.transact_write_items(TransactItems=store._start_deletion_transaction('user', email, f'U#{email}'))
+    store.user_cache.invalidate(email)
+    store._listings_changed('User')
+    store.schedule_deletion('user', email)
+
+async def list_users(pageToken: Optional[str]=None, limit: int=20, fields: store.Fields=None) -> UserList:
+    page = store._decode_page_token(pageToken)
+
+    items, nextToken, prevToken = await get_page_for_entity('User', page, limit=limit,
+        projection=store._page_projection(User, fields))
+
+    parsed_items = store._parse_page_items(User, items, fields)
+    return UserList.construct(
+        users=parsed_items,
+        nextPageToken=nextToken.encode() if nextToken else None,
+        prevPageToken=prevToken.encode() if prevToken else None,
+    )
+
+async def list_posts_for_author(email: str, pageToken: Optional[str]=None, limit: int=20, expand_author: bool=False, fields: store.Fields=None) -> PostList:
+    page = store._decode_page_token(pageToken)
+
+    items, nextToken, prevToken = await get_page_for_author_entity(email, 'Post', page, limit=limit,
+        projection=store._page_projection(PostListItem, fields, expand_author))
+
+    parsed_items = store._parse_page_items(PostListItem, items, fields, expand_author)
+    if expand_author:
+        await _expand_authors(parsed_items)
+    return PostList.construct(
+        posts=parsed_items,
+        nextPageToken=nextToken.encode() if nextToken else None,
+        prevPageToken=prevToken.encode() if prevToken else None,
+    )
+
+async def list_comments_for_author(email: str, pageToken: Optional[str]=None, limit: int=20, fields: store.Fields=None) -> CommentList:
+    page = store._decode_page_token(pageToken)
+
+    items, nextToken, prevToken = await get_page_for_author_entity(email, 'Comment', page, limit=limit,
+        projection=store._page_projection(Comment, fields))
+
+    parsed_items = store._parse_page_items(Comment, items, fields)
+    return CommentList.construct(
+        comments=parsed_items,
+        nextPageToken=nextToken.encode() if nextToken else None,
+        prevPageToken=prevToken.encode() if prevToken else None,
+    )
+
+
+async def _stream_pages(fetch) -> AsyncIterator[List[Any]]:
+    task = asyncio.ensure_future(fetch(None))
+    try:
+        while task is not None:
+            items, nextToken, _ = await task
+            task = asyncio.ensure_future(fetch(nextToken)) if nextToken else None
+            yield items
+    finally:
+        # The client went away before the end
+        if task is not None:
+            task.cancel()
+
+async def stream_posts() -> AsyncIterator[bytes]:
+    async for items in _stream_pages(lambda token: _get_entity_page('Post', token, store.STREAM_PAGE_SIZE)):
+        yield store._ndjson(PostListItem, items)
+
+async def stream_comments() -> AsyncIterator[bytes]:
+    async for items in _stream_pages(lambda token: _get_entity_page('Comment', token, store.STREAM_PAGE_SIZE)):
+        yield store._ndjson(Comment, items)
+
+async def stream_users() -> AsyncIterator[bytes]:
+    async for items in _stream_pages(lambda token: _get_entity_page('User', token, store.STREAM_PAGE_SIZE)):
+        yield store._ndjson(User, items)
@@ -0,0 +1,168 @@
+'''Storage backends that store.py can run against.
+
+A backend implements the subset of the boto3 DynamoDB client API that the
+stores use, taking and returning the same request and response shapes. The
+boto3 client itself is the production backend; memory_backend provides an
+embedded engine for local runs, CI and benchmarks.
+
+The engine is picked with the BLOG_STORAGE_ENGINE environment variable
+('dynamodb' or 'memory'). BLOG_STORAGE_FAULTS puts a FaultInjectingBackend in
+front of the memory engine, to see how the API copes with throttling.
+'''
+import json
+import os
+import random
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from botocore.exceptions import ClientError
+
+from instrumentation import OPERATIONS, instrument
+from throttling import guard
+
+
+class StorageBackend:
+    '''Interface of a storage backend.
+
+    Errors are raised as botocore ClientErrors with the same codes DynamoDB
+    would use, so callers handle every backend the same way.'''
+    def get_item(self, **kwargs) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def put_item(self, **kwargs) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def update_item(self, **kwargs) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def delete_item(self, **kwargs) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def query(self, **kwargs) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def scan(self, **kwargs) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def batch_get_item(self, **kwargs) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def batch_write_item(self, **kwargs) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def transact_write_items(self, **kwargs) -> Dict[str, Any]:
+        raise NotImplementedError
+
+
+class AsyncBackend:
+    '''Exposes an in-process StorageBackend with the coroutine API of an aiobotocore client.
+
+    Only meant for backends that don't do I/O, since calls run on the event loop.'''
+    def __init__(self, backend: StorageBackend):
+        self._backend = backend
+
+    def __getattr__(self, name: str):
+        backend = self._backend
+
+        async def call(**kwargs):
+            return getattr(backend, name)(**kwargs)
+        return call
+
+
+class FaultInjectingBackend(StorageBackend):
+    '''Stand-in for a table under load, in front of another backend.
+
+    Calls beyond `capacity` per second (with a second's worth of burst) are
+    throttled with ProvisionedThroughputExceededException, like a table with
+    that much provisioned throughput. A share `error_rate` of the others fails
+    with InternalServerError, and every call takes `latency` seconds longer.
+    Both sleep the calling thread, so with the async store they stall the
+    event loop, as the memory engine runs on it.'''
+    def __init__(self, backend: StorageBackend, capacity: Optional[float] = None, error_rate: float = 0.0,
+        latency: float = 0.0):
+        self._backend = backend
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.latency = latency
+        self._tokens = capacity or 0.0
+        self._refilled = time.monotonic()
+        self._lock = threading.Lock()
+        for name in OPERATIONS:
+            setattr(self, name, self._faulty(name, getattr(backend, name)))
+
+    def __getattr__(self, name: str):
+        return getattr(self._backend, name)
+
+    def _faulty(self, name: str, method):
+        operation = ''.join(part.title() for part in name.split('_'))
+
+        def call(**kwargs):
+            if self.latency:
+                time.sleep(self.latency)
+            if not self._take():
+                raise ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException',
+                                             'Message': 'The level of configured provisioned throughput for the '
+                                                        'table was exceeded.'},
+                                   'ResponseMetadata': {'HTTPStatusCode': 400}}, operation)
+            if self.error_rate and random.random() < self.error_rate:
+                raise ClientError({'Error': {'Code': 'InternalServerError', 'Message': 'Internal server error'},
+                                   'ResponseMetadata': {'HTTPStatusCode': 500}}, operation)
+            return method(**kwargs)
+        return call
+
+    def _take(self) -> bool:
+        if self.capacity is None:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._refilled) * self.capacity)
+            self._refilled = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+def client_config_options() -> Dict[str, Any]:
+    '''Options of the botocore Config of DynamoDB clients, sync and async.
+
+    Timeouts are bounded so that a slow call fails well within the Lambda
+    timeout, and connections are kept alive between invocations. Calls are
+    retried by throttling.guard, within the deadline of their request, so
+    botocore makes a single attempt.'''
+    from botocore.config import Config
+    options: Dict[str, Any] = {
+        'max_pool_connections': int(os.environ.get('BLOG_DYNAMODB_MAX_CONNECTIONS', '200')),
+        'connect_timeout': float(os.environ.get('BLOG_DYNAMODB_CONNECT_TIMEOUT', '1')),
+        'read_timeout': float(os.environ.get('BLOG_DYNAMODB_READ_TIMEOUT', '2')),
+        'retries': {'total_max_attempts': 1, 'mode': 'standard'},
+    }
+    # Older botocore versions don't have it
+    if 'tcp_keepalive' in Config.OPTION_DEFAULTS:
+        options['tcp_keepalive'] = True
+    return options
+
+
+def create_backend(engine: Optional[str] = None):
+    '''Creates the storage backend named by engine, or by BLOG_STORAGE_ENGINE.
+
+    Its calls are recorded by the instrumentation module, and put under the
+    flow control of the throttling module.'''
+    engine = engine or os.environ.get('BLOG_STORAGE_ENGINE', 'dynamodb')
+    if engine == 'dynamodb':
+        # botocore rather than boto3, which also imports s3transfer and the
+        # resource layer, a good part of a cold start
+        from botocore.config import Config
+        from botocore.session import get_session
+        return guard(instrument(get_session().create_client('dynamodb', config=Config(**client_config_options()))))
+    elif engine == 'memory':
+        from memory_backend import InMemoryDynamoDB
+        backend = InMemoryDynamoDB()
+        # e.g. '{"capacity": 500, "error_rate": 0.01, "latency": 0.005}', see FaultInjectingBackend
+        faults = os.environ.get('BLOG_STORAGE_FAULTS')
+        if faults:
+            backend = FaultInjectingBackend(backend, **json.loads(faults))
+        return guard(instrument(backend))
+    else:
+        raise ValueError(f'Unknown storage engine: {engine}')
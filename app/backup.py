@@ -0,0 +1,256 @@
+'''Exports the blog table to compressed JSONL shards, and restores it from them.
+
+    python backup.py export ./dump --segments 16
+    python backup.py restore ./dump --table BlogV2-staging
+
+Export scans the table in parallel segments, each written to its own
+gzipped shard of DynamoDB JSON items, one per line. Restore writes the
+shards back with concurrent BatchWriteItem calls, retrying unprocessed
+items. Both stream pages through, so memory use doesn't grow with the
+table, and take --rate to cap the items per second they read or write.
+
+Both can be interrupted and run again with the same arguments to resume.
+After each page, export records how far each segment got and the size of
+its shard, and cuts off anything written after that on resume. Restore
+records how many lines of each shard it has written, in a directory per
+target table.
+'''
+import argparse
+import base64
+from concurrent.futures import ThreadPoolExecutor, wait
+import glob
+import gzip
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import store
+
+RESTORE_PAGE_SIZE = 500
+
+
+class RateLimiter:
+    '''Token bucket shared by the threads of a run. A rate of 0 disables it.'''
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, count: int):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Go into debt rather than splitting the request, and make the
+            # next caller wait it off
+            self._tokens -= count
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class Progress:
+    def __init__(self, done: int = 0):
+        self.done = done
+        self.started = time.monotonic()
+        self._start_count = done
+        self._lock = threading.Lock()
+
+    def add(self, count: int):
+        with self._lock:
+            self.done += count
+
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return (self.done - self._start_count) / elapsed if elapsed > 0 else 0.0
+
+    def report(self, action: str) -> str:
+        return f'{action} {self.done} items, {self.rate():.0f} items/s'
+
+
+def _encode_value(value: Dict[str, Any]) -> Dict[str, Any]:
+    '''Makes binary values JSON serializable, as base64 strings.'''
+    (type_, raw), = value.items()
+    if type_ == 'B':
+        return {'B': base64.b64encode(raw).decode()}
+    elif type_ == 'BS':
+        return {'BS': [base64.b64encode(member).decode() for member in raw]}
+    elif type_ == 'M':
+        return {'M': {name: _encode_value(member) for name, member in raw.items()}}
+    elif type_ == 'L':
+        return {'L': [_encode_value(member) for member in raw]}
+    return value
+
+def _decode_value(value: Dict[str, Any]) -> Dict[str, Any]:
+    (type_, raw), = value.items()
+    if type_ == 'B':
+        return {'B': base64.b64decode(raw)}
+    elif type_ == 'BS':
+        return {'BS': [base64.b64decode(member) for member in raw]}
+    elif type_ == 'M':
+        return {'M': {name: _decode_value(member) for name, member in raw.items()}}
+    elif type_ == 'L':
+        return {'L': [_decode_value(member) for member in raw]}
+    return value
+
+def encode_item(item: Dict[str, Any]) -> str:
+    return json.dumps({name: _encode_value(value) for name, value in item.items()}, separators=(',', ':'))
+
+def decode_item(line: str) -> Dict[str, Any]:
+    return {name: _decode_value(value) for name, value in json.loads(line).items()}
+
+
+def _read_state(path: str) -> Optional[Dict[str, Any]]:
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def _write_state(path: str, state: Dict[str, Any]):
+    # Replaced atomically, so an interruption leaves the old or the new state
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def export_segment(directory: str, segment: int, total_segments: int, limiter: RateLimiter,
+    progress: Progress, page_size: int=1000):
+    shard = os.path.join(directory, f'segment-{segment:04d}.jsonl.gz')
+    state_path = os.path.join(directory, f'segment-{segment:04d}.json')
+    state = _read_state(state_path) or {'last_evaluated_key': None, 'items': 0, 'offset': 0, 'done': False}
+    if state['done']:
+        return
+
+    args = {
+        'TableName': os.environ['BLOG_TABLE'],
+        'Segment': segment,
+        'TotalSegments': total_segments,
+        'Limit': page_size,
+    }
+    with open(shard, 'ab') as f:
+        # Drop whatever was written after the last recorded page
+        f.truncate(state['offset'])
+        while True:
+            if state['last_evaluated_key']:
+                args['ExclusiveStartKey'] = state['last_evaluated_key']
+            response = store.dynamodb.scan(**args)
+            limiter.acquire(len(response['Items']))
+            # Each page is its own gzip member; readers see them as one stream
+            f.write(gzip.compress(''.join(encode_item(item) + '\n' for item in response['Items']).encode()))
+            f.flush()
+            os.fsync(f.fileno())
+
+            state['items'] += len(response['Items'])
+            state['offset'] = f.tell()
+            state['last_evaluated_key'] = response.get('LastEvaluatedKey')
+            state['done'] = state['last_evaluated_key'] is None
+            _write_state(state_path, state)
+            progress.add(len(response['Items']))
+            if state['done']:
+                break
+
+
+def export(directory: str, segments: int=8, rate: float=0, report: Callable[[str], None]=print) -> int:
+    '''Exports the table into directory, resuming an earlier export there. Returns the item count.'''
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = os.path.join(directory, 'export.json')
+    manifest = _read_state(manifest_path)
+    if manifest is None:
+        manifest = {'table': os.environ['BLOG_TABLE'], 'segments': segments}
+        _write_state(manifest_path, manifest)
+    elif manifest['segments'] != segments:
+        raise ValueError(f'{directory} holds an export with {manifest["segments"]} segments')
+
+    states = [_read_state(os.path.join(directory, f'segment-{segment:04d}.json')) for segment in range(segments)]
+    progress = Progress(sum(state['items'] for state in states if state))
+    limiter = RateLimiter(rate)
+    _run([lambda segment=segment: export_segment(directory, segment, segments, limiter, progress)
+          for segment in range(segments)], segments, progress, 'Exported', report)
+    return progress.done
+
+
+def _shard_lines(shard: str, skip: int) -> Iterator[str]:
+    with gzip.open(shard, 'rt') as f:
+        for i, line in enumerate(f):
+            if i >= skip:
+                yield line
+
+def restore_shard(shard: str, state_directory: str, limiter: RateLimiter, progress: Progress):
+    state_path = os.path.join(state_directory, os.path.basename(shard).split('.')[0] + '.json')
+    state = _read_state(state_path) or {'lines': 0, 'done': False}
+    if state['done']:
+        return
+
+    page: List[Dict[str, Any]] = []
+    def write_page():
+        limiter.acquire(len(page))
+        statuses = store._batch_write([{'PutRequest': {'Item': item}} for item in page])
+        failed = [error for status, error in statuses if (status, error) != store.CREATED]
+        if failed:
+            raise RuntimeError(f'{shard}: {len(failed)} items {failed[0]}')
+        state['lines'] += len(page)
+        _write_state(state_path, state)
+        progress.add(len(page))
+        page.clear()
+
+    for line in _shard_lines(shard, state['lines']):
+        page.append(decode_item(line))
+        if len(page) >= RESTORE_PAGE_SIZE:
+            write_page()
+    if page:
+        write_page()
+    state['done'] = True
+    _write_state(state_path, state)
+
+
+def restore(directory: str, threads: int=8, rate: float=0, report: Callable[[str], None]=print) -> int:
+    '''Writes the shards in directory to the table, resuming an earlier restore. Returns the item count.'''
+    shards = sorted(glob.glob(os.path.join(directory, 'segment-*.jsonl.gz')))
+    state_directory = os.path.join(directory, f'restore-{os.environ["BLOG_TABLE"]}')
+    os.makedirs(state_directory, exist_ok=True)
+
+    states = [_read_state(os.path.join(state_directory, os.path.basename(shard).split('.')[0] + '.json'))
+              for shard in shards]
+    progress = Progress(sum(state['lines'] for state in states if state))
+    limiter = RateLimiter(rate)
+    _run([lambda shard=shard: restore_shard(shard, state_directory, limiter, progress) for shard in shards],
+         threads, progress, 'Restored', report)
+    return progress.done
+
+
+def _run(tasks: List[Callable[[], None]], threads: int, progress: Progress, action: str,
+    report: Callable[[str], None], interval: float=5.0):
+    '''Runs the tasks in a thread pool, reporting progress every interval seconds.'''
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        pending = set(executor.submit(task) for task in tasks)
+        while pending:
+            done, pending = wait(pending, timeout=interval)
+            for future in done:
+                # Raise the first error; finished pages stay recorded for a rerun
+                future.result()
+            if pending:
+                report(progress.report(action))
+    report(progress.report(action))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('mode', choices=['export', 'restore'])
+    parser.add_argument('directory', help='directory of the shards')
+    parser.add_argument('--table', default=None, help='table to export or restore, defaults to BLOG_TABLE')
+    parser.add_argument('--segments', type=int, default=8, help='number of parallel scan segments of an export')
+    parser.add_argument('--threads', type=int, default=8, help='number of shards restored in parallel')
+    parser.add_argument('--rate', type=float, default=0, help='maximum items per second, 0 for no limit')
+    args = parser.parse_args()
+
+    if args.table:
+        os.environ['BLOG_TABLE'] = args.table
+    if args.mode == 'export':
+        export(args.directory, args.segments, args.rate)
+    else:
+        restore(args.directory, args.threads, args.rate)
@@ -0,0 +1,104 @@
+'''Rewrites the content of existing posts in the current storage encoding.
+
+Run it after enabling BLOG_CONTENT_COMPRESSION, with the same settings:
+
+    BLOG_CONTENT_COMPRESSION=zlib python compress_content.py
+
+Posts written before the change keep working, since plain content can always
+be read; this only brings their size down. With --decompress, compressed
+content is turned back into plain strings, e.g. before turning compression
+off for good. The table is scanned in parallel segments, and each post is
+updated with a condition on its current content, so the backfill can be rerun
+and doesn't overwrite concurrent edits or recreate deleted posts.
+'''
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+from typing import Any, Dict
+
+from botocore.exceptions import ClientError
+
+import content
+import store
+
+
+def _size(value: Dict[str, Any]) -> int:
+    return len(value['B']) if 'B' in value else len(value['S'].encode())
+
+
+def backfill_segment(segment: int, total_segments: int, compression: str, threshold: int,
+    dry_run: bool=False) -> Dict[str, int]:
+    counts = {'scanned': 0, 'converted': 0, 'skipped': 0, 'bytes_before': 0, 'bytes_after': 0}
+    args = {
+        'TableName': os.environ['BLOG_TABLE'],
+        'ProjectionExpression': 'PK, SK, Content, ContentEncoding',
+        # Only posts have a Content attribute, comments store theirs in Comment
+        'FilterExpression': 'attribute_exists(Content)',
+        'Segment': segment,
+        'TotalSegments': total_segments,
+    }
+    while True:
+        response = store.dynamodb.scan(**args)
+        for item in response['Items']:
+            counts['scanned'] += 1
+            current = item['Content']
+            target = content.encode(content.decode(item), compression, threshold)
+            if target['Content'] == current:
+                continue
+            counts['bytes_before'] += _size(current)
+            counts['bytes_after'] += _size(target['Content'])
+
+            if not dry_run:
+                values = {':current': current, ':content': target['Content']}
+                update = 'SET Content=:content'
+                if 'ContentEncoding' in target:
+                    update += ', ContentEncoding=:content_encoding'
+                    values[':content_encoding'] = target['ContentEncoding']
+                else:
+                    update += ' REMOVE ContentEncoding'
+                try:
+                    store.dynamodb.update_item(
+                        TableName=os.environ['BLOG_TABLE'],
+                        Key={'PK': item['PK'], 'SK': item['SK']},
+                        UpdateExpression=update,
+                        ConditionExpression='Content = :current',
+                        ExpressionAttributeValues=values,
+                    )
+                except ClientError as e:
+                    if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                        counts['skipped'] += 1
+                        continue
+                    else:
+                        raise
+            counts['converted'] += 1
+
+        if 'LastEvaluatedKey' not in response:
+            break
+        args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return counts
+
+
+def backfill(compression: str, threshold: int, segments: int=4, dry_run: bool=False) -> Dict[str, int]:
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        results = list(executor.map(
+            lambda segment: backfill_segment(segment, segments, compression, threshold, dry_run),
+            range(segments)))
+    return {key: sum(counts[key] for counts in results) for key in results[0]}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--compression', choices=['none'] + list(content.CODECS), default=content.COMPRESSION,
+                        help='codec, defaults to BLOG_CONTENT_COMPRESSION')
+    parser.add_argument('--threshold', type=int, default=content.COMPRESSION_THRESHOLD,
+                        help='compress content above this many bytes, defaults to BLOG_CONTENT_COMPRESSION_THRESHOLD')
+    parser.add_argument('--decompress', action='store_true', help='store all content as plain strings')
+    parser.add_argument('--segments', type=int, default=4, help='number of parallel scan segments')
+    parser.add_argument('--dry-run', action='store_true', help="count posts to convert, but don't update them")
+    args = parser.parse_args()
+
+    compression = 'none' if args.decompress else args.compression
+    counts = backfill(compression, args.threshold, args.segments, args.dry_run)
+    print(f"Scanned {counts['scanned']} posts, converted {counts['converted']} "
+          f"({counts['bytes_before']} to {counts['bytes_after']} content bytes), "
+          f"skipped {counts['skipped']} that changed during the backfill")
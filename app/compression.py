@@ -0,0 +1,224 @@
+'''Compression of response bodies, negotiated with Accept-Encoding, and a cache
+of compressed bodies of hot items.
+'''
+import os
+import time
+import zlib
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import Request
+from starlette.responses import Response
+
+from cache import LRUCache
+import instrumentation
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+SUPPORTED = ('br', 'gzip') if brotli is not None else ('gzip',)
+_setting = os.environ.get('BLOG_RESPONSE_COMPRESSION', 'br,gzip')
+ENCODINGS: Tuple[str, ...] = tuple(encoding for encoding in (e.strip() for e in _setting.split(','))
+                                   if encoding in SUPPORTED)
+MIN_SIZE = int(os.environ.get('BLOG_COMPRESSION_MIN_SIZE', '1024'))
+# Levels for compressing on the fly: close to the best ratio for JSON at a
+# fraction of the CPU time of the highest levels
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/')
+
+RESPONSE_CACHE_SIZE = int(os.environ.get('BLOG_COMPRESSED_CACHE_SIZE', '256'))
+# Keys change with the content, so entries don't go stale; the TTL frees old versions
+RESPONSE_CACHE_TTL = 3600.0
+
+
+def negotiate(accept_encoding: str, encodings: Tuple[str, ...] = ENCODINGS) -> Optional[str]:
+    '''The encoding of encodings with the highest q-value in an Accept-Encoding
+    header, the first of them on a tie, or None for no compression.'''
+    weights: Dict[str, float] = {}
+    for entry in accept_encoding.split(','):
+        name, _, params = entry.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name] = weight
+    best, best_weight = None, 0.0
+    for encoding in encodings:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+class _Compressor:
+    '''Compresses a body in one or more chunks, and counts the CPU time it takes.'''
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        self.seconds = 0.0
+        if encoding == 'br':
+            self._compressor: Any = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            # wbits of 16 + 15 writes a gzip header and trailer
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes, last: bool) -> bytes:
+        started = time.thread_time()
+        if self.encoding == 'br':
+            compressed = self._compressor.process(data)
+            compressed += self._compressor.finish() if last else self._compressor.flush()
+        else:
+            compressed = self._compressor.compress(data)
+            compressed += self._compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+        self.seconds += time.thread_time() - started
+        return compressed
+
+    def record(self):
+        instrumentation.RESPONSE_COMPRESSIONS.inc((('encoding', self.encoding),))
+        instrumentation.RESPONSE_COMPRESSION_SECONDS.inc((('encoding', self.encoding),), self.seconds)
+
+def compress(data: bytes, encoding: str) -> bytes:
+    compressor = _Compressor(encoding)
+    compressed = compressor.compress(data, last=True)
+    compressor.record()
+    return compressed
+
+def _record_sent(encoding: str, size: int, compressed_size: int):
+    labels = (('encoding', encoding),)
+    instrumentation.RESPONSE_BYTES.inc(labels, size)
+    instrumentation.RESPONSE_COMPRESSED_BYTES.inc(labels, compressed_size)
+    if size:
+        instrumentation.RESPONSE_COMPRESSION_RATIO.observe(labels, compressed_size / size)
+
+def _record_uncompressed(reason: str):
+    instrumentation.RESPONSES_UNCOMPRESSED.inc((('reason', reason),))
+
+
+def _compressible(headers: Headers) -> bool:
+    return 'content-encoding' not in headers and headers.get('content-type', '').startswith(COMPRESSIBLE_TYPES)
+
+
+class CompressionMiddleware:
+    '''ASGI middleware that compresses response bodies, see the module docstring.'''
+    def __init__(self, app: Any, encodings: Tuple[str, ...] = ENCODINGS, min_size: int = MIN_SIZE):
+        self.app = app
+        self.encodings = encodings
+        self.min_size = min_size
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable):
+        if scope['type'] != 'http' or not self.encodings:
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate(Headers(scope=scope).get('accept-encoding', ''), self.encodings)
+        responder = _Responder(send, encoding, self.min_size)
+        await self.app(scope, receive, responder.send)
+
+
+class _Responder:
+    '''Holds back the start of a response until its first body chunk shows
+    whether, and how, to compress it.'''
+    def __init__(self, send: Callable, encoding: Optional[str], min_size: int):
+        self._send = send
+        self.encoding = encoding
+        self.min_size = min_size
+        self._start: Optional[Dict[str, Any]] = None
+        self._compressor: Optional[_Compressor] = None
+        self._passthrough = False
+        self._size = 0
+        self._compressed_size = 0
+
+    async def send(self, message: Dict[str, Any]):
+        if message['type'] == 'http.response.start':
+            self._start = message
+        elif message['type'] != 'http.response.body' or self._passthrough:
+            await self._send(message)
+        elif self._compressor is None:
+            await self._first_body(message)
+        else:
+            await self._send_compressed(message)
+
+    async def _first_body(self, message: Dict[str, Any]):
+        start = self._start
+        start['headers'] = list(start.get('headers', []))
+        headers = MutableHeaders(raw=start['headers'])
+        body, more_body = message.get('body', b''), message.get('more_body', False)
+        if not _compressible(headers):
+            return await self._pass(message)
+        headers.add_vary_header('Accept-Encoding')
+        if not more_body and len(body) < self.min_size:
+            _record_uncompressed('small')
+            return await self._pass(message)
+        if self.encoding is None:
+            _record_uncompressed('not_accepted')
+            return await self._pass(message)
+
+        self._compressor = _Compressor(self.encoding)
+        headers['content-encoding'] = self.encoding
+        if more_body:
+            del headers['content-length']
+            await self._send(start)
+            await self._send_compressed(message)
+        else:
+            compressed = self._compressor.compress(body, last=True)
+            headers['content-length'] = str(len(compressed))
+            await self._send(start)
+            await self._send({'type': 'http.response.body', 'body': compressed})
+            self._done(len(body), len(compressed))
+
+    async def _pass(self, message: Dict[str, Any]):
+        self._passthrough = True
+        await self._send(self._start)
+        await self._send(message)
+
+    async def _send_compressed(self, message: Dict[str, Any]):
+        body, more_body = message.get('body', b''), message.get('more_body', False)
+        compressed = self._compressor.compress(body, last=not more_body)
+        self._size += len(body)
+        self._compressed_size += len(compressed)
+        await self._send({'type': 'http.response.body', 'body': compressed, 'more_body': more_body})
+        if not more_body:
+            self._done(self._size, self._compressed_size)
+
+    def _done(self, size: int, compressed_size: int):
+        self._compressor.record()
+        _record_sent(self.encoding, size, compressed_size)
+
+
+class CompressedBodies:
+    '''Compressed response bodies by a key naming the content's version, and encoding.'''
+    def __init__(self, maxsize: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL,
+        encodings: Tuple[str, ...] = ENCODINGS, min_size: int = MIN_SIZE):
+        self.encodings = encodings
+        self.min_size = min_size
+        self._cache = LRUCache(maxsize, ttl)
+
+    def response(self, request: Request, key: Hashable, render: Callable[[], bytes],
+        media_type: str = 'application/json') -> Response:
+        '''A response with the body render returns, compressed if the request accepts it.'''
+        encoding = negotiate(request.headers.get('accept-encoding', ''), self.encodings)
+        if encoding is None or self._cache.maxsize <= 0:
+            # Left to the middleware
+            return Response(render(), media_type=media_type)
+        cached: Optional[Tuple[bytes, int]] = self._cache.get((key, encoding))
+        if cached is None:
+            body = render()
+            if len(body) < self.min_size:
+                return Response(body, media_type=media_type)
+            cached = (compress(body, encoding), len(body))
+            self._cache.put((key, encoding), cached)
+        compressed, size = cached
+        _record_sent(encoding, size, len(compressed))
+        return Response(compressed, media_type=media_type,
+                        headers={'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'})
+
+    def stats(self) -> Dict[str, int]:
+        return self._cache.stats()
@@ -0,0 +1,89 @@
+'''Conditional GETs: ETag and Last-Modified validators, 304 responses and Cache-Control.
+
+Posts and users are tagged by their key and a few version fields (UpdatedAt,
+and a post's comment counters), so whether a client's copy is current can be
+decided from those alone, before reading the item. Other responses (pages,
+partial items) are tagged by a hash of their body. ETags are weak, as the
+bytes of a response depend on its Content-Encoding (see compression.py).
+
+Cache-Control is 'no-cache' by default, which lets clients and caches keep
+responses but makes them revalidate. BLOG_CACHE_CONTROL overrides it per
+route, as a JSON object of route names (the endpoint functions in api.py) to
+header values, e.g. '{"get_post": "public, max-age=60"}'.
+'''
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+import hashlib
+import json
+import os
+from typing import Any, Dict, Optional
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+DEFAULT_CACHE_CONTROL = 'no-cache'
+CACHE_CONTROL: Dict[str, str] = json.loads(os.environ.get('BLOG_CACHE_CONTROL', '{}'))
+
+
+def item_etag(key: str, *version: Any) -> str:
+    '''ETag of an item, from its key and the values of its version fields.'''
+    digest = hashlib.sha256(repr((key,) + version).encode()).hexdigest()
+    return f'W/"{digest[:32]}"'
+
+def body_etag(body: bytes) -> str:
+    return f'W/"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+
+def _utc(value: datetime) -> datetime:
+    # Timestamps are written without a zone, in the UTC clock of Lambda
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+def _opaque(tag: str) -> str:
+    # Tags are compared weakly, so without W/
+    tag = tag.strip()
+    return tag[2:] if tag.startswith('W/') else tag
+
+def _etags(header: str) -> set:
+    '''Entity tags of an If-None-Match header.'''
+    return {_opaque(tag) for tag in header.split(',')}
+
+def is_current(request: Request, etag: str, last_modified: Optional[datetime] = None) -> bool:
+    '''Whether the client's copy, named by If-None-Match or If-Modified-Since, is current.'''
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        # If-Modified-Since is ignored when If-None-Match is sent
+        tags = _etags(if_none_match)
+        return '*' in tags or _opaque(etag) in tags
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        since = _utc(parsedate_to_datetime(if_modified_since))
+    except (TypeError, ValueError):
+        return False
+    # HTTP dates have whole seconds
+    return _utc(last_modified).replace(microsecond=0) <= since
+
+def is_conditional(request: Request) -> bool:
+    return 'if-none-match' in request.headers or 'if-modified-since' in request.headers
+
+
+def validator_headers(request: Request, etag: str, last_modified: Optional[datetime] = None) -> Dict[str, str]:
+    route = request.scope['endpoint'].__name__
+    headers = {'ETag': etag, 'Cache-Control': CACHE_CONTROL.get(route, DEFAULT_CACHE_CONTROL)}
+    if last_modified is not None:
+        headers['Last-Modified'] = format_datetime(_utc(last_modified), usegmt=True)
+    return headers
+
+def not_modified(request: Request, etag: str, last_modified: Optional[datetime] = None) -> Response:
+    return Response(status_code=304, headers=validator_headers(request, etag, last_modified))
+
+def conditional_response(request: Request, response: Response, etag: Optional[str] = None,
+    last_modified: Optional[datetime] = None) -> Response:
+    '''Adds validators to a 200 response, tagged by its body unless etag is given,
+    or answers 304 if the client's copy is current.'''
+    etag = etag or body_etag(response.body)
+    if is_current(request, etag, last_modified):
+        return not_modified(request, etag, last_modified)
+    response.headers.update(validator_headers(request, etag, last_modified))
+    return response
@@ -0,0 +1,42 @@
+'''Storage encoding of post content.
+
+With BLOG_CONTENT_COMPRESSION set to 'zlib' or 'lzma', content longer than
+BLOG_CONTENT_COMPRESSION_THRESHOLD bytes is stored as a binary Content
+attribute, and ContentEncoding names the codec. Other content is stored as a
+plain string, so items written in either mode can always be read.
+'''
+import lzma
+import os
+import zlib
+from typing import Any, Callable, Dict, Optional, Tuple
+
+COMPRESSION = os.environ.get('BLOG_CONTENT_COMPRESSION', 'none')
+COMPRESSION_THRESHOLD = int(os.environ.get('BLOG_CONTENT_COMPRESSION_THRESHOLD', '4096'))
+
+CODECS: Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+    'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+    'lzma': (lambda data: lzma.compress(data, preset=6), lzma.decompress),
+}
+
+
+def encode(content: str, compression: Optional[str] = None, threshold: Optional[int] = None
+    ) -> Dict[str, Dict[str, Any]]:
+    '''Returns the Content attribute, and ContentEncoding if it is compressed.'''
+    compression = COMPRESSION if compression is None else compression
+    threshold = COMPRESSION_THRESHOLD if threshold is None else threshold
+    data = content.encode()
+    if compression in CODECS and len(data) > threshold:
+        compressed = CODECS[compression][0](data)
+        # Not worth it for content that doesn't compress
+        if len(compressed) < len(data):
+            return {'Content': {'B': compressed}, 'ContentEncoding': {'S': compression}}
+    return {'Content': {'S': content}}
+
+
+def decode(item: Dict[str, Dict[str, Any]]) -> str:
+    '''Returns the content of an item, whichever way it was stored.'''
+    value = item['Content']
+    if 'S' in value:
+        return value['S']
+    return CODECS[item['ContentEncoding']['S']][1](value['B']).decode()
+
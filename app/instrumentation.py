@@ -0,0 +1,353 @@
+'''Per-request instrumentation of DynamoDB calls, and in-process metrics.
+
+InstrumentationMiddleware keeps a RequestMetrics for each HTTP request in a
+context variable. Hooks on the DynamoDB client turn on ReturnConsumedCapacity
+and record each call's operation, latency and consumed capacity into the
+metrics of the request it is made for. They are returned in a Server-Timing
+header, and added to per-route histograms that /metrics exposes in the
+Prometheus text format.
+
+Metrics are kept per process, so each worker (or Lambda instance) reports
+its own.
+'''
+import bisect
+from contextlib import contextmanager
+from contextvars import ContextVar
+import math
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Operations of StorageBackend, wrapped on in-process backends
+OPERATIONS = ('get_item', 'put_item', 'update_item', 'delete_item', 'query', 'scan',
+              'batch_get_item', 'batch_write_item', 'transact_write_items')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CALL_COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+RATIO_BUCKETS = (0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4, 0.5, 0.75, 1.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Labels, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            lines += [f'{self.name}{_format_labels(labels)} {_format_value(value)}'
+                      for labels, value in sorted(self._values.items())]
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def set(self, labels: Labels, value: float):
+        with self._lock:
+            self._values[labels] = value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        with self._lock:
+            lines += [f'{self.name}{_format_labels(labels)} {_format_value(value)}'
+                      for labels, value in sorted(self._values.items())]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...]):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # Per label set: count in each bucket (not cumulative), then the sum
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Labels, value: float):
+        with self._lock:
+            counts, total = self._values.setdefault(labels, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (math.inf,), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == math.inf else _format_value(bound)
+                    lines.append(f'{self.name}_bucket{_format_labels(labels + (("le", le),))} {cumulative}')
+                lines.append(f'{self.name}_sum{_format_labels(labels)} {_format_value(total[0])}')
+                lines.append(f'{self.name}_count{_format_labels(labels)} {cumulative}')
+        return lines
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+REQUESTS = Counter('blog_http_requests_total', 'HTTP requests by route and status.')
+REQUEST_SECONDS = Histogram('blog_http_request_duration_seconds',
+    'Time from receiving a request to sending the last of its response.', LATENCY_BUCKETS)
+REQUEST_DYNAMODB_CALLS = Histogram('blog_http_request_dynamodb_calls',
+    'DynamoDB calls made for a request.', CALL_COUNT_BUCKETS)
+REQUEST_DYNAMODB_SECONDS = Counter('blog_http_request_dynamodb_seconds_total',
+    'Time spent in DynamoDB calls made for requests. Calls made in parallel add up.')
+REQUEST_CAPACITY = Counter('blog_http_request_consumed_capacity_units_total',
+    'DynamoDB capacity units consumed by requests.')
+DYNAMODB_CALL_SECONDS = Histogram('blog_dynamodb_call_duration_seconds',
+    'Latency of DynamoDB calls by operation, including retries, in and outside of requests.', LATENCY_BUCKETS)
+DYNAMODB_ERRORS = Counter('blog_dynamodb_call_errors_total', 'DynamoDB calls that failed, by operation.')
+DYNAMODB_CAPACITY = Counter('blog_dynamodb_consumed_capacity_units_total',
+    'DynamoDB capacity units consumed, by operation.')
+DYNAMODB_RETRIES = Counter('blog_dynamodb_retries_total',
+    'DynamoDB calls retried, by operation and reason (throttled, error, or unprocessed items of batch calls).')
+DYNAMODB_SHED = Counter('blog_dynamodb_shed_total',
+    'DynamoDB calls given up on to fail the request fast, by operation and reason (rate_limited or overloaded).')
+DYNAMODB_LIMITER_WAIT_SECONDS = Counter('blog_dynamodb_rate_limiter_wait_seconds_total',
+    'Time DynamoDB calls waited for the adaptive rate limiter, by operation.')
+DYNAMODB_RATE_LIMIT = Gauge('blog_dynamodb_rate_limit',
+    'Calls per second the adaptive rate limiter lets through, 0 while unlimited.')
+DYNAMODB_IN_FLIGHT = Gauge('blog_dynamodb_calls_in_flight',
+    'DynamoDB calls started and not finished yet, including their retries.')
+PAGE_PREFETCHES = Counter('blog_page_prefetches_total',
+    'Next pages of listings read speculatively, by entity type.')
+PAGE_PREFETCH_HITS = Counter('blog_page_prefetch_hits_total',
+    'Pages of listings served from a prefetch, by entity type.')
+PAGE_PREFETCH_CAPACITY = Counter('blog_page_prefetch_consumed_capacity_units_total',
+    'DynamoDB capacity units consumed by prefetching pages, by entity type.')
+RESPONSE_COMPRESSIONS = Counter('blog_response_compressions_total',
+    'Response bodies compressed, by encoding. Bodies served from the cache of compressed posts are not.')
+RESPONSE_COMPRESSION_SECONDS = Counter('blog_response_compression_cpu_seconds_total',
+    'CPU time spent compressing response bodies, by encoding.')
+RESPONSE_BYTES = Counter('blog_response_compression_input_bytes_total',
+    'Size of the bodies of compressed responses before compression, by encoding.')
+RESPONSE_COMPRESSED_BYTES = Counter('blog_response_compression_output_bytes_total',
+    'Size of the bodies of compressed responses as sent, by encoding.')
+RESPONSE_COMPRESSION_RATIO = Histogram('blog_response_compression_ratio',
+    'Compressed size of response bodies over their size, by encoding.', RATIO_BUCKETS)
+RESPONSES_UNCOMPRESSED = Counter('blog_responses_uncompressed_total',
+    'Compressible responses sent uncompressed, by reason (small, or not_accepted by the client).')
+
+METRICS = [REQUESTS, REQUEST_SECONDS, REQUEST_DYNAMODB_CALLS, REQUEST_DYNAMODB_SECONDS, REQUEST_CAPACITY,
+           DYNAMODB_CALL_SECONDS, DYNAMODB_ERRORS, DYNAMODB_CAPACITY, DYNAMODB_RETRIES, DYNAMODB_SHED,
+           DYNAMODB_LIMITER_WAIT_SECONDS, DYNAMODB_RATE_LIMIT, DYNAMODB_IN_FLIGHT, PAGE_PREFETCHES,
+           PAGE_PREFETCH_HITS, PAGE_PREFETCH_CAPACITY, RESPONSE_COMPRESSIONS, RESPONSE_COMPRESSION_SECONDS,
+           RESPONSE_BYTES, RESPONSE_COMPRESSED_BYTES, RESPONSE_COMPRESSION_RATIO, RESPONSES_UNCOMPRESSED]
+
+
+class Call(NamedTuple):
+    operation: str
+    seconds: float
+    capacity: float
+
+
+class RequestMetrics:
+    '''DynamoDB calls made for one request, from any thread it fans out to.'''
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.calls: List[Call] = []
+        self._lock = threading.Lock()
+
+    def add(self, call: Call):
+        with self._lock:
+            self.calls.append(call)
+
+    def by_operation(self) -> Dict[str, Tuple[int, float, float]]:
+        '''Call count, seconds and capacity units of each operation.'''
+        totals: Dict[str, Tuple[int, float, float]] = {}
+        with self._lock:
+            for call in self.calls:
+                count, seconds, capacity = totals.get(call.operation, (0, 0.0, 0.0))
+                totals[call.operation] = (count + 1, seconds + call.seconds, capacity + call.capacity)
+        return totals
+
+    def server_timing(self) -> str:
+        '''One entry per DynamoDB operation, and the time since the request started.'''
+        entries = [f'ddb-{operation};dur={seconds * 1000:.1f};desc="{operation} x{count}, {capacity:g} CU"'
+                   for operation, (count, seconds, capacity) in sorted(self.by_operation().items())]
+        entries.append(f'app;dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ', '.join(entries)
+
+
+_current: ContextVar[Optional[RequestMetrics]] = ContextVar('request_metrics', default=None)
+
+def current() -> Optional[RequestMetrics]:
+    '''Metrics of the request being handled, None outside of requests.'''
+    return _current.get()
+
+@contextmanager
+def recording(metrics: RequestMetrics) -> Iterator[RequestMetrics]:
+    '''Records the DynamoDB calls made in the block into metrics rather than
+    into those of the current request, e.g. for work done in the background.'''
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+
+
+def consumed_capacity(response: Dict[str, Any]) -> float:
+    '''Capacity units in the ConsumedCapacity of a response, one entry or a list of them.'''
+    consumed = response.get('ConsumedCapacity')
+    if consumed is None:
+        return 0.0
+    if isinstance(consumed, dict):
+        consumed = [consumed]
+    return sum(float(entry.get('CapacityUnits', 0)) for entry in consumed)
+
+def record_call(operation: str, seconds: float, response: Optional[Dict[str, Any]]):
+    '''Records a DynamoDB call; a response of None means the call failed.'''
+    capacity = consumed_capacity(response) if response is not None else 0.0
+    DYNAMODB_CALL_SECONDS.observe((('operation', operation),), seconds)
+    if response is None or 'Error' in response:
+        DYNAMODB_ERRORS.inc((('operation', operation),))
+    if capacity:
+        DYNAMODB_CAPACITY.inc((('operation', operation),), capacity)
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add(Call(operation, seconds, capacity))
+
+
+# Hooks on the events of botocore (and aiobotocore) clients. The start time is
+# kept in the request context botocore passes to each event of a call.
+
+def _return_consumed_capacity(params: Dict[str, Any], model: Any, **kwargs):
+    if 'ReturnConsumedCapacity' in model.input_shape.members:
+        params.setdefault('ReturnConsumedCapacity', 'TOTAL')
+
+def _start_call(model: Any, context: Dict[str, Any], **kwargs):
+    context['instrumentation'] = (model.name, time.perf_counter())
+
+def _end_call(parsed: Dict[str, Any], context: Dict[str, Any], **kwargs):
+    operation, started = context.pop('instrumentation', (None, None))
+    if operation is not None:
+        record_call(operation, time.perf_counter() - started, parsed)
+
+def _failed_call(context: Dict[str, Any], **kwargs):
+    operation, started = context.pop('instrumentation', (None, None))
+    if operation is not None:
+        record_call(operation, time.perf_counter() - started, None)
+
+
+def _timed(operation: str, method: Callable[..., Dict[str, Any]]) -> Callable[..., Dict[str, Any]]:
+    def call(**kwargs):
+        kwargs.setdefault('ReturnConsumedCapacity', 'TOTAL')
+        started = time.perf_counter()
+        try:
+            response = method(**kwargs)
+        except Exception:
+            record_call(operation, time.perf_counter() - started, None)
+            raise
+        record_call(operation, time.perf_counter() - started, response)
+        return response
+    return call
+
+def instrument(client: Any) -> Any:
+    '''Records the calls made with a DynamoDB client or in-process backend. Returns it.'''
+    if hasattr(client, 'meta'):
+        events = client.meta.events
+        events.register('provide-client-params.dynamodb.*', _return_consumed_capacity)
+        events.register('before-call.dynamodb.*', _start_call)
+        events.register('after-call.dynamodb.*', _end_call)
+        events.register('after-call-error.dynamodb.*', _failed_call)
+    else:
+        for name in OPERATIONS:
+            operation = ''.join(part.title() for part in name.split('_'))
+            setattr(client, name, _timed(operation, getattr(client, name)))
+    return client
+
+
+class InstrumentationMiddleware:
+    '''ASGI middleware that measures each HTTP request and adds a Server-Timing header.
+
+    The header is sent before the body, so for streamed responses it only
+    covers the calls made up to then; the histograms cover the whole response.'''
+    def __init__(self, app: Any):
+        self.app = app
+        self._routes: Dict[Any, str] = {}
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        metrics = RequestMetrics()
+        status = [500]
+
+        async def send_with_timing(message: Dict[str, Any]):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+                message['headers'] = list(message.get('headers', [])) + [
+                    (b'server-timing', metrics.server_timing().encode())]
+            await send(message)
+
+        token = _current.set(metrics)
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            self._observe(scope, status[0], metrics)
+
+    def _observe(self, scope: Dict[str, Any], status: int, metrics: RequestMetrics):
+        labels = (('method', scope['method']), ('route', self._route(scope)))
+        REQUESTS.inc(labels + (('status', str(status)),))
+        REQUEST_SECONDS.observe(labels, time.perf_counter() - metrics.started)
+        totals = metrics.by_operation().values()
+        REQUEST_DYNAMODB_CALLS.observe(labels, sum(count for count, _, _ in totals))
+        REQUEST_DYNAMODB_SECONDS.inc(labels, sum(seconds for _, seconds, _ in totals))
+        REQUEST_CAPACITY.inc(labels, sum(capacity for _, _, capacity in totals))
+
+    def _route(self, scope: Dict[str, Any]) -> str:
+        '''The path template of the matched route, so paths with ids share their metrics.'''
+        endpoint = scope.get('endpoint')
+        if endpoint is None:
+            return 'unmatched'
+        if endpoint not in self._routes:
+            paths = [route.path for route in scope['app'].routes if getattr(route, 'endpoint', None) is endpoint]
+            self._routes[endpoint] = paths[0] if paths else endpoint.__name__
+        return self._routes[endpoint]
+
+
+def render(cache_stats: Optional[Dict[str, Dict[str, int]]] = None,
+    coalescing_stats: Optional[Dict[str, Dict[str, int]]] = None) -> str:
+    '''All metrics in the Prometheus text format, with the counters of the given
+    caches and of the coalescing of reads, by operation.'''
+    lines: List[str] = []
+    for metric in METRICS:
+        lines += metric.render()
+    for stat, kind in [('hits', 'counter'), ('misses', 'counter'), ('evictions', 'counter'),
+                       ('expirations', 'counter'), ('size', 'gauge'), ('maxsize', 'gauge')]:
+        name = f'blog_cache_{stat}' + ('_total' if kind == 'counter' else '')
+        lines += [f'# TYPE {name} {kind}']
+        lines += [f'{name}{_format_labels((("cache", cache),))} {stats[stat]}'
+                  for cache, stats in sorted((cache_stats or {}).items())]
+    for stat, name, kind in [('calls', 'blog_coalescing_calls_total', 'counter'),
+                             ('coalesced', 'blog_coalescing_coalesced_total', 'counter'),
+                             ('in_flight', 'blog_coalescing_in_flight', 'gauge')]:
+        lines += [f'# TYPE {name} {kind}']
+        lines += [f'{name}{_format_labels((("operation", operation),))} {stats[stat]}'
+                  for operation, stats in sorted((coalescing_stats or {}).items())]
+    return '\n'.join(lines) + '\n'
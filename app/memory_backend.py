@@ -0,0 +1,862 @@
+'''Embedded in-memory storage engine that behaves like the blog's DynamoDB table.
+
+Items are kept in the same single-table layout as in DynamoDB (PK/SK keys and
+attribute-value dicts). The table's primary key and each global secondary
+index are kept as sorted lists per partition, so key condition queries are
+O(log n) range lookups, and pagination with Limit/ExclusiveStartKey behaves
+the way store._get_page expects.
+
+Only the parts of the DynamoDB API and expression syntax that the stores use
+are supported: top-level attribute names (also in projection expressions), the comparison operators, BETWEEN,
+IN, AND/OR/NOT, and the attribute_exists, attribute_not_exists, begins_with,
+contains and size functions; SET (with + and -, and if_not_exists), REMOVE,
+ADD and DELETE update actions.
+
+With ReturnConsumedCapacity, responses include an estimate of the capacity
+units DynamoDB would charge, from the sizes of the items read and written.
+'''
+import bisect
+import copy
+from decimal import Decimal
+import math
+import os
+import re
+import threading
+import zlib
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+from backends import StorageBackend
+
+
+class IndexDefinition(NamedTuple):
+    name: Optional[str]  # None for the table's primary key
+    hash_key: str
+    range_key: str
+    projection: Optional[Tuple[str, ...]]  # projected non-key attributes, None for all
+
+
+# Projected attributes of the global secondary indexes in template.yaml
+ENTITY_INDEX_ATTRIBUTES = ('PK', 'SK', 'Slug', 'Title', 'Comment', 'UpdatedAt', 'AuthorEmail',
+    'FirstName', 'LastName', 'Role', 'CommentCount', 'LastCommentAt')
+AUTHOR_INDEX_ATTRIBUTES = ('PK', 'SK', 'Slug', 'Title', 'Comment', 'UpdatedAt', 'AuthorEmail',
+    'CommentCount', 'LastCommentAt')
+
+def blog_table_indexes() -> List[IndexDefinition]:
+    '''Returns the global secondary indexes of the blog table, as defined in template.yaml.'''
+    return [
+        IndexDefinition(
+            os.environ.get('BLOG_TABLE_ENTITY_INDEX', 'EntityType-CreatedAt-IndexV2'),
+            'EntityType', 'CreatedAt', ENTITY_INDEX_ATTRIBUTES,
+        ),
+        IndexDefinition(
+            os.environ.get('BLOG_TABLE_AUTHOR_INDEX', 'AuthorEmail_EntityType-CreatedAt-IndexV3'),
+            'AuthorEmail_EntityType', 'CreatedAt', AUTHOR_INDEX_ATTRIBUTES,
+        ),
+    ]
+
+
+def _error(code: str, message: str, operation: str) -> ClientError:
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+def _validation_error(message: str) -> ClientError:
+    return _error('ValidationException', message, 'Expression')
+
+
+class _Top:
+    '''Sorts after every other value, to build exclusive upper bounds of sort keys.'''
+    def __eq__(self, other):
+        return isinstance(other, _Top)
+
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return not isinstance(other, _Top)
+
+    def __hash__(self):
+        return 0
+
+_TOP = _Top()
+
+
+def _scalar(value: Dict[str, Any]) -> Any:
+    '''Converts a key attribute value to a python value with the same ordering.'''
+    if 'S' in value:
+        return value['S']
+    elif 'N' in value:
+        return Decimal(value['N'])
+    elif 'B' in value:
+        return value['B']
+    raise _validation_error('Key attributes must be of type S, N or B')
+
+def _comparable(value: Dict[str, Any]) -> Tuple[str, Any]:
+    (type_, raw), = value.items()
+    if type_ == 'N':
+        return type_, Decimal(raw)
+    elif type_ in ('NS', 'SS', 'BS'):
+        return type_, frozenset(Decimal(v) for v in raw) if type_ == 'NS' else frozenset(raw)
+    return type_, raw
+
+
+# Capacity estimates. Sizes follow DynamoDB's rules loosely: attribute names
+# plus values, with numbers counted by their digits.
+
+def _value_size(value: Dict[str, Any]) -> int:
+    (type_, raw), = value.items()
+    if type_ in ('S', 'N'):
+        return len(raw.encode())
+    elif type_ == 'B':
+        return len(raw)
+    elif type_ in ('SS', 'NS'):
+        return sum(len(member.encode()) for member in raw)
+    elif type_ == 'BS':
+        return sum(len(member) for member in raw)
+    elif type_ == 'M':
+        return 3 + sum(len(name.encode()) + _value_size(member) for name, member in raw.items())
+    elif type_ == 'L':
+        return 3 + sum(1 + _value_size(member) for member in raw)
+    return 1
+
+def _item_size(item: Optional[Dict[str, Any]]) -> int:
+    if item is None:
+        return 0
+    return sum(len(name.encode()) + _value_size(value) for name, value in item.items())
+
+def _read_units(size: int, consistent: bool = False) -> float:
+    '''One unit per 4 KB read, half of that for eventually consistent reads.'''
+    return max(1, math.ceil(size / 4096)) * (1.0 if consistent else 0.5)
+
+def _write_units(size: int) -> float:
+    return float(max(1, math.ceil(size / 1024)))
+
+def _consumed(kwargs: Dict[str, Any], capacity: Dict[str, float]) -> Dict[str, Any]:
+    '''The ConsumedCapacity entries of a response, if asked for; capacity is by table.'''
+    if kwargs.get('ReturnConsumedCapacity', 'NONE') == 'NONE':
+        return {}
+    entries = [{'TableName': table_name, 'CapacityUnits': units} for table_name, units in capacity.items()]
+    return {'ConsumedCapacity': entries[0] if 'TableName' in kwargs else entries}
+
+
+class _Index:
+    def __init__(self, definition: IndexDefinition):
+        self.definition = definition
+        # hash key value -> sorted list of (range key value, PK value, SK value)
+        self.partitions: Dict[Any, List[Tuple]] = {}
+
+    def entry(self, item: Dict[str, Any]) -> Optional[Tuple[Any, Tuple]]:
+        hash_value = item.get(self.definition.hash_key)
+        range_value = item.get(self.definition.range_key)
+        if hash_value is None or range_value is None:
+            # Indexes are sparse: items without the index keys aren't in them
+            return None
+        return _scalar(hash_value), (_scalar(range_value), _scalar(item['PK']), _scalar(item['SK']))
+
+    def add(self, item: Dict[str, Any]):
+        entry = self.entry(item)
+        if entry is not None:
+            bisect.insort(self.partitions.setdefault(entry[0], []), entry[1])
+
+    def remove(self, item: Dict[str, Any]):
+        entry = self.entry(item)
+        if entry is None:
+            return
+        entries = self.partitions.get(entry[0], [])
+        i = bisect.bisect_left(entries, entry[1])
+        if i < len(entries) and entries[i] == entry[1]:
+            del entries[i]
+            if not entries:
+                del self.partitions[entry[0]]
+
+    def project(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        if self.definition.projection is None:
+            return item
+        keys = ('PK', 'SK', self.definition.hash_key, self.definition.range_key)
+        return {name: value for name, value in item.items()
+                if name in keys or name in self.definition.projection}
+
+    def key_of(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        keys = ('PK', 'SK', self.definition.hash_key, self.definition.range_key)
+        return {name: item[name] for name in keys}
+
+
+class _Table:
+    def __init__(self, indexes: List[IndexDefinition]):
+        self.items: Dict[Tuple[Any, Any], Dict[str, Any]] = {}
+        # Sorted (PK value, SK value) of every item, the order scans go through
+        self.keys: List[Tuple[Any, Any]] = []
+        self.primary = _Index(IndexDefinition(None, 'PK', 'SK', None))
+        self.indexes = {definition.name: _Index(definition) for definition in indexes}
+
+    def index(self, name: Optional[str]) -> _Index:
+        if name is None:
+            return self.primary
+        try:
+            return self.indexes[name]
+        except KeyError:
+            raise _error('ValidationException', f'The table does not have the specified index: {name}', 'Query')
+
+    def all_indexes(self) -> List[_Index]:
+        return [self.primary, *self.indexes.values()]
+
+    def put(self, item: Dict[str, Any]):
+        self.delete(item)
+        key = (_scalar(item['PK']), _scalar(item['SK']))
+        self.items[key] = item
+        bisect.insort(self.keys, key)
+        for index in self.all_indexes():
+            index.add(item)
+
+    def delete(self, key: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        key = (_scalar(key['PK']), _scalar(key['SK']))
+        old = self.items.pop(key, None)
+        if old is not None:
+            del self.keys[bisect.bisect_left(self.keys, key)]
+            for index in self.all_indexes():
+                index.remove(old)
+        return old
+
+    def get(self, key: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        return self.items.get((_scalar(key['PK']), _scalar(key['SK'])))
+
+
+class InMemoryDynamoDB(StorageBackend):
+    '''A thread-safe, in-process stand-in for the DynamoDB client.
+
+    Tables are created on first use, with the blog table's key schema and
+    indexes.'''
+    def __init__(self, indexes: Optional[List[IndexDefinition]] = None):
+        self._indexes = indexes if indexes is not None else blog_table_indexes()
+        self._tables: Dict[str, _Table] = {}
+        self._lock = threading.RLock()
+
+    def _table(self, name: str) -> _Table:
+        if name not in self._tables:
+            self._tables[name] = _Table(self._indexes)
+        return self._tables[name]
+
+    @staticmethod
+    def _key(kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        key = kwargs['Key']
+        if set(key) != {'PK', 'SK'}:
+            raise _validation_error('The provided key element does not match the schema')
+        return key
+
+    @staticmethod
+    def _condition_holds(kwargs: Dict[str, Any], item: Optional[Dict[str, Any]]) -> bool:
+        if 'ConditionExpression' not in kwargs:
+            return True
+        condition = _parse_condition(kwargs['ConditionExpression'],
+            kwargs.get('ExpressionAttributeNames', {}), kwargs.get('ExpressionAttributeValues', {}))
+        return _evaluate(condition, item or {})
+
+    def _check_condition(self, kwargs: Dict[str, Any], item: Optional[Dict[str, Any]], operation: str):
+        if not self._condition_holds(kwargs, item):
+            raise _error('ConditionalCheckFailedException', 'The conditional request failed', operation)
+
+    @staticmethod
+    def _updated_item(kwargs: Dict[str, Any], old: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        item = copy.deepcopy(old) if old is not None else copy.deepcopy(kwargs['Key'])
+        if 'UpdateExpression' in kwargs:
+            _apply_update(item, kwargs['UpdateExpression'],
+                kwargs.get('ExpressionAttributeNames', {}), kwargs.get('ExpressionAttributeValues', {}))
+        return item
+
+    def get_item(self, **kwargs) -> Dict[str, Any]:
+        projection = _parse_projection(kwargs)
+        with self._lock:
+            item = self._table(kwargs['TableName']).get(self._key(kwargs))
+            consumed = _consumed(kwargs, {kwargs['TableName']: _read_units(
+                _item_size(item), kwargs.get('ConsistentRead', False))})
+            if item is None:
+                return consumed
+            return {'Item': copy.deepcopy(_project(item, projection)), **consumed}
+
+    def put_item(self, **kwargs) -> Dict[str, Any]:
+        item = copy.deepcopy(kwargs['Item'])
+        if 'PK' not in item or 'SK' not in item:
+            raise _validation_error('One of the required keys was not given a value')
+        with self._lock:
+            table = self._table(kwargs['TableName'])
+            old = table.get(item)
+            self._check_condition(kwargs, old, 'PutItem')
+            table.put(item)
+        consumed = _consumed(kwargs, {kwargs['TableName']: _write_units(max(_item_size(old), _item_size(item)))})
+        if kwargs.get('ReturnValues') == 'ALL_OLD' and old is not None:
+            return {'Attributes': copy.deepcopy(old), **consumed}
+        return consumed
+
+    def update_item(self, **kwargs) -> Dict[str, Any]:
+        key = self._key(kwargs)
+        with self._lock:
+            table = self._table(kwargs['TableName'])
+            old = table.get(key)
+            self._check_condition(kwargs, old, 'UpdateItem')
+            item = self._updated_item(kwargs, old)
+            table.put(item)
+
+        consumed = _consumed(kwargs, {kwargs['TableName']: _write_units(max(_item_size(old), _item_size(item)))})
+        return_values = kwargs.get('ReturnValues', 'NONE')
+        if return_values == 'ALL_NEW':
+            return {'Attributes': copy.deepcopy(item), **consumed}
+        elif return_values == 'ALL_OLD' and old is not None:
+            return {'Attributes': copy.deepcopy(old), **consumed}
+        return consumed
+
+    def delete_item(self, **kwargs) -> Dict[str, Any]:
+        key = self._key(kwargs)
+        with self._lock:
+            table = self._table(kwargs['TableName'])
+            self._check_condition(kwargs, table.get(key), 'DeleteItem')
+            old = table.delete(key)
+        consumed = _consumed(kwargs, {kwargs['TableName']: _write_units(_item_size(old))})
+        if kwargs.get('ReturnValues') == 'ALL_OLD' and old is not None:
+            return {'Attributes': copy.deepcopy(old), **consumed}
+        return consumed
+
+    def batch_get_item(self, **kwargs) -> Dict[str, Any]:
+        responses = {}
+        capacity: Dict[str, float] = {}
+        with self._lock:
+            for table_name, request in kwargs['RequestItems'].items():
+                if len(request['Keys']) > 100:
+                    raise _validation_error('Too many items requested for the BatchGetItem call')
+                projection = _parse_projection(request)
+                table = self._table(table_name)
+                responses[table_name] = []
+                capacity[table_name] = 0.0
+                for key in request['Keys']:
+                    item = table.get(self._key({'Key': key}))
+                    capacity[table_name] += _read_units(_item_size(item), request.get('ConsistentRead', False))
+                    if item is not None:
+                        responses[table_name].append(copy.deepcopy(_project(item, projection)))
+        return {'Responses': responses, 'UnprocessedKeys': {}, **_consumed(kwargs, capacity)}
+
+    def batch_write_item(self, **kwargs) -> Dict[str, Any]:
+        requests = [(table_name, request) for table_name, table_requests in kwargs['RequestItems'].items()
+                    for request in table_requests]
+        if len(requests) > 25:
+            raise _validation_error('Too many items requested for the BatchWriteItem call')
+        keys = set()
+        for table_name, request in requests:
+            key = request['PutRequest']['Item'] if 'PutRequest' in request else request['DeleteRequest']['Key']
+            keys.add((table_name, _scalar(key['PK']), _scalar(key['SK'])))
+        if len(keys) != len(requests):
+            raise _validation_error('Provided list of item keys contains duplicates')
+
+        capacity: Dict[str, float] = {}
+        with self._lock:
+            for table_name, request in requests:
+                table = self._table(table_name)
+                if 'PutRequest' in request:
+                    item = copy.deepcopy(request['PutRequest']['Item'])
+                    size = max(_item_size(table.get(item)), _item_size(item))
+                    table.put(item)
+                else:
+                    size = _item_size(table.delete(self._key(request['DeleteRequest'])))
+                capacity[table_name] = capacity.get(table_name, 0.0) + _write_units(size)
+        return {'UnprocessedItems': {}, **_consumed(kwargs, capacity)}
+
+    def transact_write_items(self, **kwargs) -> Dict[str, Any]:
+        actions = [next(iter(action.items())) for action in kwargs['TransactItems']]
+        if len(actions) > 100:
+            raise _validation_error('Member must have length less than or equal to 100')
+        keys = set()
+        for kind, request in actions:
+            key = request['Item'] if kind == 'Put' else request['Key']
+            keys.add((request['TableName'], _scalar(key['PK']), _scalar(key['SK'])))
+        if len(keys) != len(actions):
+            raise _validation_error('Transaction request cannot include multiple operations on one item')
+
+        with self._lock:
+            reasons = []
+            for kind, request in actions:
+                table = self._table(request['TableName'])
+                item = table.get(request['Item'] if kind == 'Put' else request['Key'])
+                if self._condition_holds(request, item):
+                    reasons.append({'Code': 'None'})
+                else:
+                    reason = {'Code': 'ConditionalCheckFailed', 'Message': 'The conditional request failed'}
+                    if request.get('ReturnValuesOnConditionCheckFailure') == 'ALL_OLD' and item is not None:
+                        reason['Item'] = copy.deepcopy(item)
+                    reasons.append(reason)
+            if any(reason['Code'] != 'None' for reason in reasons):
+                codes = ', '.join(reason['Code'] for reason in reasons)
+                error = _error('TransactionCanceledException',
+                    f'Transaction cancelled, please refer cancellation reasons for specific reasons [{codes}]',
+                    'TransactWriteItems')
+                error.response['CancellationReasons'] = reasons
+                raise error
+
+            # Transactions cost twice as much as the same reads and writes
+            capacity: Dict[str, float] = {}
+            for kind, request in actions:
+                table = self._table(request['TableName'])
+                old = table.get(request['Item'] if kind == 'Put' else request['Key'])
+                if kind == 'Put':
+                    units = _write_units(max(_item_size(old), _item_size(request['Item'])))
+                    table.put(copy.deepcopy(request['Item']))
+                elif kind == 'Update':
+                    item = self._updated_item(request, old)
+                    units = _write_units(max(_item_size(old), _item_size(item)))
+                    table.put(item)
+                elif kind == 'Delete':
+                    units = _write_units(_item_size(old))
+                    table.delete(request['Key'])
+                else:
+                    units = _read_units(_item_size(old), consistent=True)
+                capacity[request['TableName']] = capacity.get(request['TableName'], 0.0) + 2 * units
+        return _consumed(kwargs, capacity)
+
+    def query(self, **kwargs) -> Dict[str, Any]:
+        names = kwargs.get('ExpressionAttributeNames', {})
+        values = kwargs.get('ExpressionAttributeValues', {})
+        key_condition = _parse_condition(kwargs['KeyConditionExpression'], names, values)
+        filter_condition = (_parse_condition(kwargs['FilterExpression'], names, values)
+                            if 'FilterExpression' in kwargs else None)
+        projection = _parse_projection(kwargs)
+        forward = kwargs.get('ScanIndexForward', True)
+        limit = kwargs.get('Limit')
+
+        with self._lock:
+            index = self._table(kwargs['TableName']).index(kwargs.get('IndexName'))
+            hash_value, low, high = _key_bounds(key_condition, index.definition)
+            entries = index.partitions.get(hash_value, [])
+            start = bisect.bisect_left(entries, low) if low is not None else 0
+            end = bisect.bisect_left(entries, high) if high is not None else len(entries)
+
+            if 'ExclusiveStartKey' in kwargs:
+                hash_and_entry = index.entry(kwargs['ExclusiveStartKey'])
+                if hash_and_entry is None:
+                    raise _validation_error('The provided starting key is invalid')
+                if forward:
+                    start = max(start, bisect.bisect_right(entries, hash_and_entry[1]))
+                else:
+                    end = min(end, bisect.bisect_left(entries, hash_and_entry[1]))
+
+            positions = range(start, end) if forward else range(end - 1, start - 1, -1)
+            if limit is not None:
+                selected = positions[:limit]
+                has_more = len(positions) > limit
+            else:
+                selected = positions
+                has_more = False
+
+            table = self._table(kwargs['TableName'])
+            items = [index.project(table.items[entries[i][1:]]) for i in selected]
+            last_key = index.key_of(items[-1]) if has_more and items else None
+            scanned_count = len(items)
+            # Queries are charged for the items read, before filtering
+            units = _read_units(sum(_item_size(item) for item in items), kwargs.get('ConsistentRead', False))
+            if filter_condition is not None:
+                items = [item for item in items if _evaluate(filter_condition, item)]
+            items = copy.deepcopy([_project(item, projection) for item in items])
+
+        response = {'Count': len(items), 'ScannedCount': scanned_count,
+                    **_consumed(kwargs, {kwargs['TableName']: units})}
+        if kwargs.get('Select') != 'COUNT':
+            response['Items'] = items
+        if last_key is not None:
+            response['LastEvaluatedKey'] = copy.deepcopy(last_key)
+        return response
+
+    def scan(self, **kwargs) -> Dict[str, Any]:
+        filter_condition = (_parse_condition(kwargs['FilterExpression'],
+                                kwargs.get('ExpressionAttributeNames', {}),
+                                kwargs.get('ExpressionAttributeValues', {}))
+                            if 'FilterExpression' in kwargs else None)
+        projection = _parse_projection(kwargs)
+        limit = kwargs.get('Limit')
+        segment, total_segments = kwargs.get('Segment', 0), kwargs.get('TotalSegments', 1)
+        if not 0 <= segment < total_segments:
+            raise _validation_error('Segment must be less than TotalSegments')
+
+        with self._lock:
+            table = self._table(kwargs['TableName'])
+            position = 0
+            if 'ExclusiveStartKey' in kwargs:
+                start_key = kwargs['ExclusiveStartKey']
+                position = bisect.bisect_right(table.keys, (_scalar(start_key['PK']), _scalar(start_key['SK'])))
+
+            items = []
+            last_key = None
+            while position < len(table.keys):
+                key = table.keys[position]
+                position += 1
+                # Items are split between segments by partition key, like in DynamoDB
+                if total_segments > 1 and zlib.crc32(str(key[0]).encode()) % total_segments != segment:
+                    continue
+                items.append(table.items[key])
+                if limit is not None and len(items) >= limit:
+                    if position < len(table.keys):
+                        last_key = {'PK': items[-1]['PK'], 'SK': items[-1]['SK']}
+                    break
+
+            scanned_count = len(items)
+            units = _read_units(sum(_item_size(item) for item in items), kwargs.get('ConsistentRead', False))
+            if filter_condition is not None:
+                items = [item for item in items if _evaluate(filter_condition, item)]
+            items = copy.deepcopy([_project(item, projection) for item in items])
+
+        response = {'Count': len(items), 'ScannedCount': scanned_count,
+                    **_consumed(kwargs, {kwargs['TableName']: units})}
+        if kwargs.get('Select') != 'COUNT':
+            response['Items'] = items
+        if last_key is not None:
+            response['LastEvaluatedKey'] = copy.deepcopy(last_key)
+        return response
+
+
+def _key_bounds(condition: Tuple, definition: IndexDefinition) -> Tuple[Any, Optional[Tuple], Optional[Tuple]]:
+    '''Turns a key condition into the hash key value and the sort key bounds of entries to read.'''
+    conditions = _flatten_and(condition)
+    hash_conditions = [c for c in conditions
+                       if c[0] == 'cmp' and c[1] == '=' and c[2] == ('path', definition.hash_key)]
+    range_conditions = [c for c in conditions if c not in hash_conditions]
+    if len(hash_conditions) != 1 or len(range_conditions) > 1:
+        raise _validation_error('Query key condition not supported')
+    hash_value = _scalar(hash_conditions[0][3][1])
+
+    if not range_conditions:
+        return hash_value, None, None
+    condition = range_conditions[0]
+    kind = condition[0]
+    if kind == 'cmp' and condition[2] == ('path', definition.range_key) and condition[3][0] == 'value':
+        op, value = condition[1], _scalar(condition[3][1])
+        bounds = {
+            '=': ((value,), (value, _TOP)),
+            '<': (None, (value,)),
+            '<=': (None, (value, _TOP)),
+            '>': ((value, _TOP), None),
+            '>=': ((value,), None),
+        }
+        if op not in bounds:
+            raise _validation_error(f'Unsupported operator in key condition: {op}')
+        low, high = bounds[op]
+        return hash_value, low, high
+    elif kind == 'between' and condition[1] == ('path', definition.range_key):
+        return hash_value, (_scalar(condition[2][1]),), (_scalar(condition[3][1]), _TOP)
+    elif (kind == 'func' and condition[1] == 'begins_with'
+          and condition[2][0] == ('path', definition.range_key)):
+        prefix = _scalar(condition[2][1][1])
+        if not prefix:
+            return hash_value, None, None
+        # The smallest value greater than every value starting with prefix
+        successor = prefix[:-1] + (chr(ord(prefix[-1]) + 1) if isinstance(prefix, str)
+                                   else bytes([prefix[-1] + 1]))
+        return hash_value, (prefix,), (successor,)
+    raise _validation_error('Query key condition not supported')
+
+def _flatten_and(condition: Tuple) -> List[Tuple]:
+    if condition[0] == 'and':
+        return _flatten_and(condition[1]) + _flatten_and(condition[2])
+    return [condition]
+
+
+_TOKEN = re.compile(r'\s*(?:(?P<name>#[A-Za-z0-9_]+)|(?P<value>:[A-Za-z0-9_]+)'
+                    r'|(?P<ident>[A-Za-z_][A-Za-z0-9_]*)|(?P<op><>|<=|>=|[=<>(),+-]))')
+
+def _tokenize(expression: str) -> List[Tuple[str, str]]:
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = _TOKEN.match(expression, position)
+        if not match:
+            raise _validation_error(f'Invalid expression: unsupported syntax at "{expression[position:]}"')
+        tokens.append((match.lastgroup, match.group(match.lastgroup)))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    def __init__(self, expression: str, names: Dict[str, str], values: Dict[str, Any]):
+        self.tokens = _tokenize(expression)
+        self.position = 0
+        self.names = names
+        self.values = values
+
+    def peek(self, offset: int = 0) -> Tuple[Optional[str], Optional[str]]:
+        if self.position + offset < len(self.tokens):
+            return self.tokens[self.position + offset]
+        return None, None
+
+    def next(self) -> Tuple[str, str]:
+        if self.position >= len(self.tokens):
+            raise _validation_error('Invalid expression: unexpected end of expression')
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def expect(self, text: str):
+        kind, token = self.next()
+        if token.upper() != text.upper():
+            raise _validation_error(f'Invalid expression: expected "{text}", found "{token}"')
+
+    def at_keyword(self, keyword: str) -> bool:
+        kind, token = self.peek()
+        return kind == 'ident' and token.upper() == keyword
+
+    def done(self) -> bool:
+        return self.position >= len(self.tokens)
+
+    def path(self) -> Tuple:
+        kind, token = self.next()
+        if kind == 'name':
+            if token not in self.names:
+                raise _validation_error(f'An expression attribute name used in the document path is not defined: {token}')
+            return ('path', self.names[token])
+        elif kind == 'ident':
+            return ('path', token)
+        raise _validation_error(f'Invalid expression: expected an attribute name, found "{token}"')
+
+    def operand(self) -> Tuple:
+        kind, token = self.peek()
+        if kind == 'value':
+            self.next()
+            if token not in self.values:
+                raise _validation_error(f'An expression attribute value used in expression is not defined: {token}')
+            return ('value', self.values[token])
+        elif kind == 'ident' and self.peek(1)[1] == '(':
+            function = token.lower()
+            self.next()
+            self.expect('(')
+            if function == 'size':
+                argument = self.path()
+                self.expect(')')
+                return ('size', argument)
+            elif function == 'if_not_exists':
+                argument = self.path()
+                self.expect(',')
+                default = self.operand()
+                self.expect(')')
+                return ('if_not_exists', argument, default)
+            raise _validation_error(f'Invalid function name: {token}')
+        return self.path()
+
+    def value_expression(self) -> Tuple:
+        left = self.operand()
+        kind, token = self.peek()
+        if token in ('+', '-'):
+            self.next()
+            return ('arith', token, left, self.operand())
+        return left
+
+    def condition(self) -> Tuple:
+        left = self.and_condition()
+        while self.at_keyword('OR'):
+            self.next()
+            left = ('or', left, self.and_condition())
+        return left
+
+    def and_condition(self) -> Tuple:
+        left = self.not_condition()
+        while self.at_keyword('AND'):
+            self.next()
+            left = ('and', left, self.not_condition())
+        return left
+
+    def not_condition(self) -> Tuple:
+        if self.at_keyword('NOT'):
+            self.next()
+            return ('not', self.not_condition())
+        return self.primary_condition()
+
+    def primary_condition(self) -> Tuple:
+        kind, token = self.peek()
+        if token == '(':
+            self.next()
+            condition = self.condition()
+            self.expect(')')
+            return condition
+        if (kind == 'ident' and self.peek(1)[1] == '('
+                and token.lower() in ('attribute_exists', 'attribute_not_exists', 'begins_with', 'contains')):
+            function = token.lower()
+            self.next()
+            self.expect('(')
+            arguments = [self.path()]
+            while self.peek()[1] == ',':
+                self.next()
+                arguments.append(self.operand())
+            self.expect(')')
+            return ('func', function, arguments)
+
+        left = self.operand()
+        if self.at_keyword('BETWEEN'):
+            self.next()
+            low = self.operand()
+            self.expect('AND')
+            return ('between', left, low, self.operand())
+        elif self.at_keyword('IN'):
+            self.next()
+            self.expect('(')
+            options = [self.operand()]
+            while self.peek()[1] == ',':
+                self.next()
+                options.append(self.operand())
+            self.expect(')')
+            return ('in', left, options)
+        kind, op = self.next()
+        if op not in ('=', '<>', '<', '<=', '>', '>='):
+            raise _validation_error(f'Invalid expression: expected a comparator, found "{op}"')
+        return ('cmp', op, left, self.operand())
+
+
+def _parse_condition(expression: str, names: Dict[str, str], values: Dict[str, Any]) -> Tuple:
+    parser = _Parser(expression, names, values)
+    condition = parser.condition()
+    if not parser.done():
+        raise _validation_error(f'Invalid expression: unexpected token "{parser.peek()[1]}"')
+    return condition
+
+
+def _parse_projection(kwargs: Dict[str, Any]) -> Optional[List[str]]:
+    '''Returns the attribute names in the request's ProjectionExpression, if it has one.'''
+    if 'ProjectionExpression' not in kwargs:
+        return None
+    parser = _Parser(kwargs['ProjectionExpression'], kwargs.get('ExpressionAttributeNames', {}), {})
+    attributes = [parser.path()[1]]
+    while not parser.done():
+        parser.expect(',')
+        attributes.append(parser.path()[1])
+    return attributes
+
+def _project(item: Dict[str, Any], attributes: Optional[List[str]]) -> Dict[str, Any]:
+    if attributes is None:
+        return item
+    return {name: value for name, value in item.items() if name in attributes}
+
+
+def _resolve(operand: Tuple, item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    kind = operand[0]
+    if kind == 'value':
+        return operand[1]
+    elif kind == 'path':
+        return item.get(operand[1])
+    elif kind == 'size':
+        value = item.get(operand[1][1])
+        if value is None:
+            return None
+        (type_, raw), = value.items()
+        return {'N': str(len(raw))}
+    elif kind == 'if_not_exists':
+        value = item.get(operand[1][1])
+        return value if value is not None else _resolve(operand[2], item)
+    elif kind == 'arith':
+        left, right = _resolve(operand[2], item), _resolve(operand[3], item)
+        if left is None or right is None or 'N' not in left or 'N' not in right:
+            raise _validation_error('An operand in the update expression has an incorrect data type')
+        result = Decimal(left['N']) + Decimal(right['N']) if operand[1] == '+' \
+            else Decimal(left['N']) - Decimal(right['N'])
+        return {'N': str(result)}
+    raise _validation_error('Invalid operand')
+
+def _compare(op: str, left: Optional[Dict[str, Any]], right: Optional[Dict[str, Any]]) -> bool:
+    if left is None or right is None:
+        return op == '<>'
+    left_type, left_value = _comparable(left)
+    right_type, right_value = _comparable(right)
+    if op == '=':
+        return left_type == right_type and left_value == right_value
+    elif op == '<>':
+        return left_type != right_type or left_value != right_value
+    if left_type != right_type or left_type not in ('S', 'N', 'B'):
+        return False
+    return {
+        '<': left_value < right_value,
+        '<=': left_value <= right_value,
+        '>': left_value > right_value,
+        '>=': left_value >= right_value,
+    }[op]
+
+def _evaluate(condition: Tuple, item: Dict[str, Any]) -> bool:
+    kind = condition[0]
+    if kind == 'and':
+        return _evaluate(condition[1], item) and _evaluate(condition[2], item)
+    elif kind == 'or':
+        return _evaluate(condition[1], item) or _evaluate(condition[2], item)
+    elif kind == 'not':
+        return not _evaluate(condition[1], item)
+    elif kind == 'cmp':
+        return _compare(condition[1], _resolve(condition[2], item), _resolve(condition[3], item))
+    elif kind == 'between':
+        value = _resolve(condition[1], item)
+        return (_compare('>=', value, _resolve(condition[2], item))
+                and _compare('<=', value, _resolve(condition[3], item)))
+    elif kind == 'in':
+        value = _resolve(condition[1], item)
+        return any(_compare('=', value, _resolve(option, item)) for option in condition[2])
+
+    function, arguments = condition[1], condition[2]
+    value = _resolve(arguments[0], item)
+    if function == 'attribute_exists':
+        return value is not None
+    elif function == 'attribute_not_exists':
+        return value is None
+    elif value is None:
+        return False
+    operand = _resolve(arguments[1], item)
+    (type_, raw), = value.items()
+    (operand_type, operand_raw), = operand.items()
+    if function == 'begins_with':
+        return type_ == operand_type and type_ in ('S', 'B') and raw.startswith(operand_raw)
+    # contains
+    if type_ in ('SS', 'NS', 'BS'):
+        return operand_raw in raw
+    elif type_ == 'L':
+        return operand in raw
+    return type_ == operand_type and type_ in ('S', 'B') and operand_raw in raw
+
+
+def _apply_update(item: Dict[str, Any], expression: str, names: Dict[str, str], values: Dict[str, Any]):
+    parser = _Parser(expression, names, values)
+    actions = []
+    while not parser.done():
+        kind, clause = parser.next()
+        clause = clause.upper()
+        if clause not in ('SET', 'REMOVE', 'ADD', 'DELETE'):
+            raise _validation_error(f'Invalid UpdateExpression: unexpected token "{clause}"')
+        while True:
+            path = parser.path()
+            if clause == 'SET':
+                parser.expect('=')
+                actions.append((clause, path[1], parser.value_expression()))
+            elif clause == 'REMOVE':
+                actions.append((clause, path[1], None))
+            else:
+                actions.append((clause, path[1], parser.operand()))
+            if parser.peek()[1] != ',':
+                break
+            parser.next()
+
+    # Every value is computed from the item as it was before the update
+    original = dict(item)
+    for clause, name, operand in actions:
+        if name in ('PK', 'SK'):
+            raise _validation_error(f'Cannot update attribute {name}. This attribute is part of the key')
+        if clause == 'SET':
+            item[name] = copy.deepcopy(_resolve(operand, original))
+        elif clause == 'REMOVE':
+            item.pop(name, None)
+        elif clause == 'ADD':
+            value = operand[1]
+            current = original.get(name)
+            if current is None:
+                item[name] = copy.deepcopy(value)
+            elif 'N' in value and 'N' in current:
+                item[name] = {'N': str(Decimal(current['N']) + Decimal(value['N']))}
+            else:
+                (type_, raw), = value.items()
+                if type_ not in current:
+                    raise _validation_error('An operand in the update expression has an incorrect data type')
+                item[name] = {type_: sorted(set(current[type_]) | set(raw))}
+        else:  # DELETE
+            current = original.get(name)
+            (type_, raw), = operand[1].items()
+            if current is not None and type_ in current:
+                remaining = sorted(set(current[type_]) - set(raw))
+                if remaining:
+                    item[name] = {type_: remaining}
+                else:
+                    item.pop(name, None)
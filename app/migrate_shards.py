@@ -0,0 +1,89 @@
+'''Rewrites the EntityType of existing items to match a number of entity shards.
+
+Run it after changing BLOG_ENTITY_SHARDS, with the same value:
+
+    python migrate_shards.py --shards 8
+
+Until it has finished, items written before the change keep their old
+EntityType and don't show up in the listings. The table is scanned in
+parallel segments. Each item is updated with a condition on its current
+EntityType, so the migration can be rerun and doesn't overwrite concurrent
+changes or recreate deleted items.
+'''
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+from typing import Dict
+
+from botocore.exceptions import ClientError
+
+import store
+
+ENTITY_TYPES = ('Post', 'Comment', 'User')
+
+
+def migrate_segment(segment: int, total_segments: int, shards: int, dry_run: bool=False) -> Dict[str, int]:
+    counts = {'scanned': 0, 'migrated': 0, 'skipped': 0}
+    args = {
+        'TableName': os.environ['BLOG_TABLE'],
+        'ProjectionExpression': 'PK, SK, EntityType',
+        'FilterExpression': 'attribute_exists(EntityType)',
+        'Segment': segment,
+        'TotalSegments': total_segments,
+    }
+    while True:
+        response = store.dynamodb.scan(**args)
+        for item in response['Items']:
+            counts['scanned'] += 1
+            current = item['EntityType']['S']
+            entityType = current.split('#')[0]
+            if entityType not in ENTITY_TYPES:
+                continue
+            target = store._entity_type(entityType, item['PK']['S'], item['SK']['S'], shards)
+            if target == current:
+                continue
+
+            if not dry_run:
+                try:
+                    store.dynamodb.update_item(
+                        TableName=os.environ['BLOG_TABLE'],
+                        Key={'PK': item['PK'], 'SK': item['SK']},
+                        UpdateExpression='SET EntityType=:target',
+                        ConditionExpression='EntityType = :current',
+                        ExpressionAttributeValues={
+                            ':target': {'S': target},
+                            ':current': {'S': current},
+                        },
+                    )
+                except ClientError as e:
+                    if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                        counts['skipped'] += 1
+                        continue
+                    else:
+                        raise
+            counts['migrated'] += 1
+
+        if 'LastEvaluatedKey' not in response:
+            break
+        args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return counts
+
+
+def migrate(shards: int, segments: int=4, dry_run: bool=False) -> Dict[str, int]:
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        results = list(executor.map(
+            lambda segment: migrate_segment(segment, segments, shards, dry_run), range(segments)))
+    return {key: sum(counts[key] for counts in results) for key in results[0]}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--shards', type=int, default=store.ENTITY_SHARDS,
+                        help='number of shards, defaults to BLOG_ENTITY_SHARDS')
+    parser.add_argument('--segments', type=int, default=4, help='number of parallel scan segments')
+    parser.add_argument('--dry-run', action='store_true', help="count items to migrate, but don't update them")
+    args = parser.parse_args()
+
+    counts = migrate(args.shards, args.segments, args.dry_run)
+    print(f"Scanned {counts['scanned']} items, migrated {counts['migrated']}, "
+          f"skipped {counts['skipped']} that changed during the migration")
@@ -1,9 +1,48 @@
 from datetime import datetime
-from dateutil.parser import isoparse
-from typing import Any, Dict, List, Optional
+import functools
+import json
+from typing import Any, ClassVar, Dict, List, Optional, Tuple, Type
 
 import pydantic
 
+import content
+
+try:
+    import orjson
+except ImportError:  # serialized with the json module instead
+    orjson = None
+
+
+def parse_timestamp(value: str) -> datetime:
+    '''Parses a CreatedAt or UpdatedAt value.
+
+    The store writes them with datetime.isoformat(), which fromisoformat reads
+    back much faster than dateutil; other ISO 8601 forms fall back to it.'''
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        from dateutil.parser import isoparse
+        return isoparse(value)
+
+def _default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def dumps(value: Any) -> bytes:
+    '''Serializes JSON types and datetimes, as BaseModel.dict() returns them, to compact JSON.'''
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, allow_nan=False, separators=(',', ':'), default=_default).encode()
+
+def comment_counters(item: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    '''CommentCount and LastCommentAt of a post item. Posts written before the
+    counters were kept have neither, until reconciled (see reconcile_comment_counts.py).'''
+    counters: Dict[str, Any] = {'comment_count': int(item['CommentCount']['N']) if 'CommentCount' in item else 0}
+    if 'LastCommentAt' in item:
+        counters['last_comment_at'] = parse_timestamp(item['LastCommentAt']['S'])
+    return counters
+
 class UpdatedPost(pydantic.BaseModel):
     title: str
     author_email: str
@@ -15,33 +54,61 @@ class NewPost(UpdatedPost):
 class Post(NewPost):
     created_at: datetime
     updated_at: datetime
+    # Kept by the comment writes, in the same transaction
+    comment_count: int = 0
+    last_comment_at: Optional[datetime]  # when the newest comment was created
+
+    # DynamoDB attribute each field is read from, for fields= projections
+    FIELD_ATTRIBUTES: ClassVar[Dict[str, str]] = {
+        'slug': 'Slug', 'title': 'Title', 'content': 'Content', 'author_email': 'AuthorEmail',
+        'created_at': 'CreatedAt', 'updated_at': 'UpdatedAt',
+        'comment_count': 'CommentCount', 'last_comment_at': 'LastCommentAt',
+    }
 
     @classmethod
     def from_dynamo_item(cls, item: Dict[str, Dict[str, Any]]) -> 'Post':
-        return cls(
+        # Like the other models read from the table, built without validation,
+        # since the items were written from validated models
+        return cls.construct(
             slug=item['Slug']['S'],
             title=item['Title']['S'],
-            content=item['Content']['S'],
+            content=content.decode(item),
             author_email=item['AuthorEmail']['S'],
-            created_at=isoparse(item['CreatedAt']['S']),
-            updated_at=isoparse(item['UpdatedAt']['S']),
+            created_at=parse_timestamp(item['CreatedAt']['S']),
+            updated_at=parse_timestamp(item['UpdatedAt']['S']),
+            **comment_counters(item),
         )
 
+class Author(pydantic.BaseModel):
+    email: str
+    first_name: str
+    last_name: str
+
 class PostListItem(pydantic.BaseModel):
     title: str
     author_email: str
     slug: str
     created_at: datetime
     updated_at: datetime
+    comment_count: int = 0
+    last_comment_at: Optional[datetime]
+    author: Optional[Author]  # only set with expand=author
+
+    FIELD_ATTRIBUTES: ClassVar[Dict[str, str]] = {
+        'slug': 'Slug', 'title': 'Title', 'author_email': 'AuthorEmail',
+        'created_at': 'CreatedAt', 'updated_at': 'UpdatedAt',
+        'comment_count': 'CommentCount', 'last_comment_at': 'LastCommentAt',
+    }
 
     @classmethod
     def from_dynamo_item(cls, item: Dict[str, Dict[str, Any]]) -> 'PostListItem':
-        return cls(
+        return cls.construct(
             slug=item['Slug']['S'],
             title=item['Title']['S'],
             author_email=item['AuthorEmail']['S'],
-            created_at=isoparse(item['CreatedAt']['S']),
-            updated_at=isoparse(item['UpdatedAt']['S']),
+            created_at=parse_timestamp(item['CreatedAt']['S']),
+            updated_at=parse_timestamp(item['UpdatedAt']['S']),
+            **comment_counters(item),
         )
 
 class PostList(pydantic.BaseModel):
@@ -49,6 +116,14 @@ class PostList(pydantic.BaseModel):
     nextPageToken: Optional[str]
     prevPageToken: Optional[str]
 
+class PostSearchItem(PostListItem):
+    score: float  # BM25 relevance to the query, higher is better
+
+class PostSearchResult(pydantic.BaseModel):
+    posts: List[PostSearchItem]
+    total: int  # posts matching the query
+    nextPageToken: Optional[str]
+
 class UpdateComment(pydantic.BaseModel):
     content: str
 
@@ -59,15 +134,21 @@ class Comment(NewComment):
     post_slug: str
     created_at: datetime
     updated_at: datetime
+    author: Optional[Author]  # only set with expand=author
+
+    FIELD_ATTRIBUTES: ClassVar[Dict[str, str]] = {
+        'post_slug': 'Slug', 'author_email': 'AuthorEmail', 'content': 'Comment',
+        'created_at': 'CreatedAt', 'updated_at': 'UpdatedAt',
+    }
 
     @classmethod
     def from_dynamo_item(cls, item: Dict[str, Dict[str, Any]]) -> 'Comment':
-        return cls(
+        return cls.construct(
             post_slug=item['Slug']['S'],
             author_email=item['AuthorEmail']['S'],
-            created_at=isoparse(item['CreatedAt']['S']),
-            updated_at=isoparse(item['UpdatedAt']['S']),
-            content=item['Content']['S'],
+            created_at=parse_timestamp(item['CreatedAt']['S']),
+            updated_at=parse_timestamp(item['UpdatedAt']['S']),
+            content=item['Comment']['S'],
         )
 
 class CommentList(pydantic.BaseModel):
@@ -87,18 +168,109 @@ class User(NewUser):
     created_at: datetime
     updated_at: datetime
 
+    # email is read from the key, without its U# prefix
+    FIELD_ATTRIBUTES: ClassVar[Dict[str, str]] = {
+        'email': 'PK', 'first_name': 'FirstName', 'last_name': 'LastName', 'role': 'Role',
+        'created_at': 'CreatedAt', 'updated_at': 'UpdatedAt',
+    }
+
     @classmethod
     def from_dynamo_item(cls, item: Dict[str, Dict[str, Any]]) -> 'User':
-        return cls(
+        return cls.construct(
             first_name=item['FirstName']['S'],
             last_name=item['LastName']['S'],
             role=item['Role']['S'],
             email=item['PK']['S'][2:],
-            created_at=isoparse(item['CreatedAt']['S']),
-            updated_at=isoparse(item['UpdatedAt']['S']),
+            created_at=parse_timestamp(item['CreatedAt']['S']),
+            updated_at=parse_timestamp(item['UpdatedAt']['S']),
         )
 
 class UserList(pydantic.BaseModel):
     users: List[User]
     nextPageToken: Optional[str]
     prevPageToken: Optional[str]
+
+class Deletion(pydantic.BaseModel):
+    kind: str  # 'post' or 'user'
+    target: str  # slug or email
+    status: str  # 'running', 'done' or 'failed'
+    deleted: int  # items deleted so far, besides the post or user itself
+    attempts: int  # runs of the job so far
+    error: Optional[str]
+    created_at: datetime
+    updated_at: datetime
+
+    @classmethod
+    def from_dynamo_item(cls, item: Dict[str, Dict[str, Any]]) -> 'Deletion':
+        return cls.construct(
+            kind=item['Kind']['S'],
+            target=item['Target']['S'],
+            status=item['Status']['S'],
+            deleted=int(item['Deleted']['N']),
+            attempts=int(item['Attempts']['N']) if 'Attempts' in item else 0,
+            error=item['Error']['S'] if 'Error' in item else None,
+            created_at=parse_timestamp(item['CreatedAt']['S']),
+            updated_at=parse_timestamp(item['UpdatedAt']['S']),
+        )
+
+@functools.lru_cache(maxsize=None)
+def partial_model(model: Type[pydantic.BaseModel], fields: Tuple[str, ...]) -> Type[pydantic.BaseModel]:
+    '''Returns a model with only the given fields of model.'''
+    definitions = {}
+    for name in fields:
+        field = model.__fields__[name]
+        definitions[name] = (field.outer_type_, ... if field.required else field.default)
+    return pydantic.create_model(f'Partial{model.__name__}', **definitions)
+
+def partial_from_model(obj: pydantic.BaseModel, fields: Tuple[str, ...]) -> pydantic.BaseModel:
+    return partial_model(type(obj), fields).construct(**obj.dict(include=set(fields)))
+
+def partial_from_dynamo_item(model: Type[pydantic.BaseModel], fields: Tuple[str, ...],
+    item: Dict[str, Dict[str, Any]]) -> pydantic.BaseModel:
+    '''Builds a partial model from an item read with a projection of its fields.
+
+    Fields that aren't stored in the item, like author, are left unset, and
+    so are the comment counters of posts that don't have them yet.'''
+    values = {}
+    for name in fields:
+        attribute = model.FIELD_ATTRIBUTES.get(name)
+        if attribute is None or attribute not in item:
+            continue
+        if attribute == 'Content':
+            values[name] = content.decode(item)
+        elif attribute == 'CommentCount':
+            values[name] = int(item[attribute]['N'])
+        else:
+            value = item[attribute]['S']
+            values[name] = value.split('#', 1)[1] if attribute == 'PK' else value
+    for name in ('created_at', 'updated_at', 'last_comment_at'):
+        if name in values:
+            values[name] = parse_timestamp(values[name])
+    return partial_model(model, fields).construct(**values)
+
+class BatchItemResult(pydantic.BaseModel):
+    index: int
+    status: str  # 'created', 'conflict', 'invalid' or 'failed'
+    error: Optional[str]
+
+class PostBatchItemResult(BatchItemResult):
+    post: Optional[Post]
+
+class PostBatchResult(pydantic.BaseModel):
+    results: List[PostBatchItemResult]
+
+class CommentBatchItemResult(BatchItemResult):
+    comment: Optional[Comment]
+
+class CommentBatchResult(pydantic.BaseModel):
+    results: List[CommentBatchItemResult]
+
+class PostWithComments(Post):
+    comments: Optional[List[Comment]]
+    commentsNextPageToken: Optional[str]
+
+class UserBatchItemResult(BatchItemResult):
+    user: Optional[User]
+
+class UserBatchResult(pydantic.BaseModel):
+    results: List[UserBatchItemResult]
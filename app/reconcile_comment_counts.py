@@ -0,0 +1,121 @@
+'''Recounts the comments of every post, and fixes CommentCount and LastCommentAt where they drifted.
+
+Comment writes keep the counters in the same transaction, so they only drift
+when comments are written or deleted without them: by batch creates without
+transactions, by interrupted deletions of users, or before the counters were
+kept at all. Run it once after deploying the counters, and then from time to
+time:
+
+    python reconcile_comment_counts.py --segments 8
+
+The table is scanned for posts in parallel segments. Each post's counters are
+read, its comments counted, and the counters set on condition that they are
+still as read, so a post that gets a comment in the meantime is skipped rather
+than miscounted; run it again to pick those up.
+'''
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+from typing import Any, Dict, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+import store
+
+
+def count_comments(pk: Dict[str, Any]) -> Tuple[int, Optional[Dict[str, Any]]]:
+    '''Number of comments of a post, and the CreatedAt of its newest one.'''
+    count, newest = 0, None
+    for items in store._query_pages({
+        'TableName': os.environ['BLOG_TABLE'],
+        'KeyConditionExpression': 'PK = :pk AND begins_with(SK, :comment)',
+        'ExpressionAttributeValues': {':pk': pk, ':comment': {'S': 'C#'}},
+        'ProjectionExpression': 'CreatedAt',
+        # Newest first, as comment sort keys start with their creation date
+        'ScanIndexForward': False,
+        'ConsistentRead': True,
+    }):
+        if newest is None and items:
+            newest = items[0]['CreatedAt']
+        count += len(items)
+    return count, newest
+
+
+def _seen_condition(name: str, value: Optional[Dict[str, Any]], values: Dict[str, Any]) -> str:
+    if value is None:
+        return f'attribute_not_exists({name})'
+    values[f':seen_{name}'] = value
+    return f'{name} = :seen_{name}'
+
+
+def reconcile_post(key: Dict[str, Any], dry_run: bool=False) -> Dict[str, int]:
+    counts = {'posts': 1, 'fixed': 0, 'skipped': 0, 'drift': 0}
+    result = store.dynamodb.get_item(TableName=os.environ['BLOG_TABLE'], Key=key, ConsistentRead=True,
+                                     ProjectionExpression='CommentCount, LastCommentAt')
+    if 'Item' not in result:
+        return {**counts, 'posts': 0}
+    seen_count, seen_last = result['Item'].get('CommentCount'), result['Item'].get('LastCommentAt')
+    count, newest = count_comments(key['PK'])
+    if seen_count == {'N': str(count)} and seen_last == newest:
+        return counts
+    counts['drift'] = abs(count - int(seen_count['N'] if seen_count else 0))
+    if dry_run:
+        return {**counts, 'fixed': 1}
+
+    values: Dict[str, Any] = {':count': {'N': str(count)}}
+    update = 'SET CommentCount = :count'
+    if newest is not None:
+        update += ', LastCommentAt = :newest'
+        values[':newest'] = newest
+    else:
+        update += ' REMOVE LastCommentAt'
+    condition = ' AND '.join(['attribute_exists(PK)', _seen_condition('CommentCount', seen_count, values),
+                              _seen_condition('LastCommentAt', seen_last, values)])
+    try:
+        store.dynamodb.update_item(TableName=os.environ['BLOG_TABLE'], Key=key, UpdateExpression=update,
+                                   ConditionExpression=condition, ExpressionAttributeValues=values)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return {**counts, 'skipped': 1, 'drift': 0}
+        raise
+    store.post_cache.invalidate(key['PK']['S'][2:])
+    return {**counts, 'fixed': 1}
+
+
+def reconcile_segment(segment: int, total_segments: int, dry_run: bool=False) -> Dict[str, int]:
+    counts = {'posts': 0, 'fixed': 0, 'skipped': 0, 'drift': 0}
+    args = {
+        'TableName': os.environ['BLOG_TABLE'],
+        'ProjectionExpression': 'PK, SK',
+        # Posts are the items whose sort key is P#<slug>, like their partition key
+        'FilterExpression': 'begins_with(SK, :post)',
+        'ExpressionAttributeValues': {':post': {'S': 'P#'}},
+        'Segment': segment,
+        'TotalSegments': total_segments,
+    }
+    while True:
+        response = store.dynamodb.scan(**args)
+        for item in response['Items']:
+            for name, value in reconcile_post({'PK': item['PK'], 'SK': item['SK']}, dry_run).items():
+                counts[name] += value
+        if 'LastEvaluatedKey' not in response:
+            break
+        args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return counts
+
+
+def reconcile(segments: int=4, dry_run: bool=False) -> Dict[str, int]:
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        results = list(executor.map(lambda segment: reconcile_segment(segment, segments, dry_run), range(segments)))
+    return {key: sum(counts[key] for counts in results) for key in results[0]}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--segments', type=int, default=4, help='number of parallel scan segments')
+    parser.add_argument('--dry-run', action='store_true', help="count posts to fix, but don't update them")
+    args = parser.parse_args()
+
+    counts = reconcile(args.segments, args.dry_run)
+    print(f"Recounted {counts['posts']} posts, fixed {counts['fixed']} (off by {counts['drift']} comments "
+          f"in total), skipped {counts['skipped']} that got comments during the recount")
@@ -0,0 +1,431 @@
+'''Full-text search of posts, by their titles and content.
+
+A SearchIndex is an inverted index: for each term, the posts it occurs in and
+how often. Queries are ranked with BM25, with terms in a title counting
+TITLE_WEIGHT times as much as in the content.
+
+An index is built with a parallel scan of the table's posts, and kept up to
+date from then on by put and remove, or by applying DynamoDB Streams records
+of the table (with NEW_IMAGE or NEW_AND_OLD_IMAGES). store.py keeps one per
+worker, updated by the worker's own writes. It is saved as a compressed file
+of its postings, which loads much faster than a scan:
+
+    python search.py build ./search-index --segments 8
+    python search.py follow ./search-index --interval 5
+    python search.py replay ./search-index records.jsonl
+    python search.py query ./search-index "single table design"
+
+follow reads the table's stream and saves the index with its changes every
+interval, along with how far it read each shard, to carry on from there when
+restarted. Workers reload the file when it changes (see store.py). replay
+applies Streams records, one JSON record per line, as
+`aws dynamodbstreams get-records` returns them, to a saved index.
+'''
+from array import array
+import base64
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+from itertools import accumulate
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import content
+from models import dumps
+
+TITLE_WEIGHT = 3
+# BM25 parameters: how quickly repeated terms saturate, and how much longer
+# posts are penalized
+K1 = 1.2
+B = 0.75
+# Terms of a query beyond these are ignored
+MAX_QUERY_TERMS = 32
+MAX_TERM_LENGTH = 64
+# Term frequencies are saved in two bytes. BM25 barely tells counts that high apart.
+MAX_COUNT = 0xFFFF
+
+FORMAT = b'blog-search-index/1\n'
+# The default level takes several times as long to save a large index, for files under a tenth smaller
+COMPRESSION_LEVEL = 1
+# Stream position of a shard that was read to its end
+SHARD_CLOSED = 'closed'
+
+_WORD = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> List[str]:
+    '''Case-folded words of text, the terms it is indexed and searched by.'''
+    return [term for term in _WORD.findall(text.casefold()) if len(term) <= MAX_TERM_LENGTH]
+
+
+class SearchIndex:
+    '''A thread-safe inverted index of posts by slug.
+
+    Posts are numbered in the order they were indexed. Replacing or removing
+    one leaves its number behind, unused, until the index is compacted, which
+    happens once there are more of those than posts.
+
+    A loaded index keeps the postings of its terms packed as they were saved,
+    and only unpacks those of terms that are searched for or changed.'''
+    def __init__(self):
+        # Slug and length of each post by number, None for replaced and removed posts
+        self._slugs: List[Optional[str]] = []
+        self._lengths: List[int] = []
+        self._numbers: Dict[str, int] = {}
+        # Term frequency by post number, by term
+        self._postings: Dict[str, Dict[int, int]] = {}
+        # Postings as loaded: the span of each term in the arrays of the
+        # differences between consecutive post numbers and of the frequencies
+        self._packed: Dict[str, Tuple[int, int]] = {}
+        self._packed_gaps = array('I')
+        self._packed_counts = array('H')
+        self._total_length = 0
+        self._unused = 0
+        self._lock = threading.Lock()
+        self.changes = 0
+        # Time (epoch seconds) up to which the table's writes are in the index
+        self.applied_until = 0.0
+        # Last sequence number applied by shard of the table's stream, see follow
+        self.stream_positions: Dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return len(self._numbers)
+
+    def put(self, slug: str, title: str, text: str):
+        '''Indexes a post, replacing what was indexed for it before.'''
+        counts = Counter(tokenize(text))
+        for term in tokenize(title):
+            counts[term] += TITLE_WEIGHT
+        with self._lock:
+            self._remove(slug)
+            number = len(self._slugs)
+            length = sum(counts.values())
+            self._slugs.append(slug)
+            self._lengths.append(length)
+            self._numbers[slug] = number
+            self._total_length += length
+            for term, count in counts.items():
+                self._term_postings(term)[number] = min(count, MAX_COUNT)
+            self.changes += 1
+            self._compact_if_sparse()
+
+    def remove(self, slug: str):
+        with self._lock:
+            self._remove(slug)
+            self.changes += 1
+            self._compact_if_sparse()
+
+    def _remove(self, slug: str):
+        number = self._numbers.pop(slug, None)
+        if number is None:
+            return
+        self._slugs[number] = None
+        self._total_length -= self._lengths[number]
+        self._unused += 1
+
+    def _unpacked(self, start: int, end: int) -> Iterator[Tuple[int, int]]:
+        return zip(accumulate(self._packed_gaps[start:end]), self._packed_counts[start:end])
+
+    def _term_postings(self, term: str) -> Dict[int, int]:
+        '''The postings of a term, to change them.'''
+        postings = self._postings.get(term)
+        if postings is None:
+            span = self._packed.pop(term, None)
+            postings = self._postings[term] = dict(self._unpacked(*span)) if span else {}
+        return postings
+
+    def _posts(self, term: str) -> Iterable[Tuple[int, int]]:
+        '''Numbers and term frequencies of the posts with a term, including unused numbers.'''
+        postings = self._postings.get(term)
+        if postings is not None:
+            return postings.items()
+        span = self._packed.get(term)
+        return self._unpacked(*span) if span else ()
+
+    def _compact_if_sparse(self):
+        if self._unused > max(1024, len(self._numbers)):
+            self._compact()
+
+    def _compact(self):
+        for term in list(self._packed):
+            self._term_postings(term)
+        self._packed_gaps, self._packed_counts = array('I'), array('H')
+        renumbered = {}
+        for number, slug in enumerate(self._slugs):
+            if slug is not None:
+                renumbered[number] = len(renumbered)
+        postings = {}
+        for term, posts in self._postings.items():
+            kept = {renumbered[number]: count for number, count in posts.items() if number in renumbered}
+            if kept:
+                postings[term] = kept
+        self._lengths = [self._lengths[number] for number in renumbered]
+        self._slugs = [self._slugs[number] for number in renumbered]
+        self._numbers = {slug: number for number, slug in enumerate(self._slugs)}
+        self._postings = postings
+        self._unused = 0
+
+    def search(self, query: str, limit: int, offset: int = 0) -> Tuple[List[Tuple[str, float]], int]:
+        '''Slugs and scores of the posts ranked offset to offset + limit for
+        the query, best first, and the number of posts matching any of its terms.'''
+        terms = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+        scores: Dict[int, float] = {}
+        with self._lock:
+            count = len(self._numbers)
+            if not count:
+                return [], 0
+            average_length = self._total_length / count
+            slugs, lengths = self._slugs, self._lengths
+            for term in terms:
+                posts = [(number, frequency) for number, frequency in self._posts(term) if slugs[number] is not None]
+                if not posts:
+                    continue
+                idf = math.log(1 + (count - len(posts) + 0.5) / (len(posts) + 0.5))
+                for number, frequency in posts:
+                    norm = K1 * (1 - B + B * lengths[number] / average_length)
+                    scores[number] = scores.get(number, 0.0) + idf * frequency * (K1 + 1) / (frequency + norm)
+            ranked = heapq.nsmallest(offset + limit, scores.items(), key=lambda item: (-item[1], slugs[item[0]]))
+            return [(slugs[number], score) for number, score in ranked[offset:]], len(scores)
+
+    def apply(self, records: Iterable[Dict[str, Any]]):
+        '''Applies DynamoDB Streams records of the table. Records of items other than posts are skipped.'''
+        for record in records:
+            change = record['dynamodb']
+            pk, sk = change['Keys']['PK']['S'], change['Keys']['SK']['S']
+            if pk != sk or not pk.startswith('P#'):
+                continue
+            if record['eventName'] == 'REMOVE':
+                self.remove(pk[2:])
+                continue
+            if 'NewImage' not in change:
+                raise ValueError('Stream records need the new image of items')
+            item = change['NewImage']
+            self.put(pk[2:], item['Title']['S'], content.decode(item))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'posts': len(self._numbers), 'terms': len(self._postings) + len(self._packed),
+                    'unused': self._unused, 'changes': self.changes}
+
+    def dump(self) -> bytes:
+        '''The index in the format save writes: a JSON header of the posts and
+        terms, and the packed postings of each term in turn, compressed.'''
+        with self._lock:
+            terms, sizes = [], []
+            gaps, counts = array('I'), array('H')
+            for term, (start, end) in self._packed.items():
+                gaps.extend(self._packed_gaps[start:end])
+                counts.extend(self._packed_counts[start:end])
+                terms.append(term)
+                sizes.append(end - start)
+            for term, posts in self._postings.items():
+                numbers = sorted(posts)
+                gaps.extend(number - previous for number, previous in zip(numbers, [0] + numbers))
+                counts.extend(posts[number] for number in numbers)
+                terms.append(term)
+                sizes.append(len(numbers))
+            header = dumps({'slugs': self._slugs, 'lengths': self._lengths, 'terms': terms, 'sizes': sizes,
+                            'byteorder': sys.byteorder, 'applied_until': self.applied_until,
+                            'stream_positions': self.stream_positions})
+        data = len(header).to_bytes(8, 'little') + header + gaps.tobytes() + counts.tobytes()
+        return FORMAT + zlib.compress(data, COMPRESSION_LEVEL)
+
+    @classmethod
+    def loads(cls, data: bytes) -> 'SearchIndex':
+        if not data.startswith(FORMAT):
+            raise ValueError('Not a search index, or one of an older format')
+        data = zlib.decompress(data[len(FORMAT):])
+        header_end = 8 + int.from_bytes(data[:8], 'little')
+        header = json.loads(data[8:header_end])
+        index = cls()
+        index._slugs, index._lengths = header['slugs'], header['lengths']
+        index.applied_until = header.get('applied_until', 0.0)
+        index.stream_positions = header.get('stream_positions', {})
+        index._numbers = {slug: number for number, slug in enumerate(index._slugs) if slug is not None}
+        index._unused = len(index._slugs) - len(index._numbers)
+        index._total_length = sum(length for slug, length in zip(index._slugs, index._lengths) if slug is not None)
+        postings = sum(header['sizes'])
+        index._packed_gaps.frombytes(data[header_end:header_end + postings * index._packed_gaps.itemsize])
+        index._packed_counts.frombytes(data[header_end + postings * index._packed_gaps.itemsize:])
+        if header['byteorder'] != sys.byteorder:
+            index._packed_gaps.byteswap()
+            index._packed_counts.byteswap()
+        starts = [0, *accumulate(header['sizes'])]
+        index._packed = {term: (starts[i], starts[i + 1]) for i, term in enumerate(header['terms'])}
+        return index
+
+    def save(self, path: str):
+        '''Writes the index to path, replacing the file at once so that readers never see part of it.'''
+        data = self.dump()
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'SearchIndex':
+        with open(path, 'rb') as f:
+            return cls.loads(f.read())
+
+
+def _scan_segment(client: Any, index: SearchIndex, segment: int, total_segments: int):
+    args = {
+        'TableName': os.environ['BLOG_TABLE'],
+        'ProjectionExpression': 'PK, Title, Content, ContentEncoding',
+        # Posts are the items whose sort key is P#<slug>, like their partition key
+        'FilterExpression': 'begins_with(SK, :post)',
+        'ExpressionAttributeValues': {':post': {'S': 'P#'}},
+        'Segment': segment,
+        'TotalSegments': total_segments,
+    }
+    while True:
+        response = client.scan(**args)
+        for item in response['Items']:
+            index.put(item['PK']['S'][2:], item['Title']['S'], content.decode(item))
+        if 'LastEvaluatedKey' not in response:
+            break
+        args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def build(client: Any, segments: int = 4) -> SearchIndex:
+    '''Indexes the posts of the table, read with a scan in parallel segments.'''
+    index = SearchIndex()
+    index.applied_until = time.time()
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        for result in [executor.submit(_scan_segment, client, index, segment, segments)
+                       for segment in range(segments)]:
+            result.result()
+    index.changes = 0
+    return index
+
+
+def _stream_shards(streams: Any, stream_arn: str) -> List[Dict[str, Any]]:
+    '''Shards of a stream, each after its parent, as their records follow the parent's.'''
+    shards: List[Dict[str, Any]] = []
+    args = {'StreamArn': stream_arn}
+    while True:
+        description = streams.describe_stream(**args)['StreamDescription']
+        shards.extend(description['Shards'])
+        if 'LastEvaluatedShardId' not in description:
+            break
+        args['ExclusiveStartShardId'] = description['LastEvaluatedShardId']
+    by_id = {shard['ShardId']: shard for shard in shards}
+    ordered: Dict[str, Dict[str, Any]] = {}
+    def add(shard: Dict[str, Any]):
+        parent = by_id.get(shard.get('ParentShardId'))
+        if parent is not None and parent['ShardId'] not in ordered:
+            add(parent)
+        ordered[shard['ShardId']] = shard
+    for shard in shards:
+        if shard['ShardId'] not in ordered:
+            add(shard)
+    return list(ordered.values())
+
+def _read_shard(streams: Any, stream_arn: str, shard_id: str, index: SearchIndex):
+    '''Applies the records of a shard after its saved position, up to the end
+    of the shard, or of the records written so far if it is still open.'''
+    position = index.stream_positions.get(shard_id)
+    if position == SHARD_CLOSED:
+        return
+    args = {'StreamArn': stream_arn, 'ShardId': shard_id, 'ShardIteratorType': 'TRIM_HORIZON'}
+    if position is not None:
+        args.update(ShardIteratorType='AFTER_SEQUENCE_NUMBER', SequenceNumber=position)
+    iterator = streams.get_shard_iterator(**args)['ShardIterator']
+    while iterator is not None:
+        response = streams.get_records(ShardIterator=iterator)
+        index.apply(response['Records'])
+        if response['Records']:
+            index.stream_positions[shard_id] = response['Records'][-1]['dynamodb']['SequenceNumber']
+        iterator = response.get('NextShardIterator')
+        if iterator is None:
+            index.stream_positions[shard_id] = SHARD_CLOSED
+        elif not response['Records']:
+            break
+
+def follow(client: Any, streams: Any, index: SearchIndex, path: str, interval: float):
+    '''Applies the records of the table's stream to the index, and saves it to
+    path every interval seconds, until interrupted.'''
+    stream_arn = client.describe_table(TableName=os.environ['BLOG_TABLE'])['Table'].get('LatestStreamArn')
+    if stream_arn is None:
+        raise ValueError('The table has no stream')
+    while True:
+        started = time.time()
+        positions = dict(index.stream_positions)
+        shards = _stream_shards(streams, stream_arn)
+        for shard in shards:
+            _read_shard(streams, stream_arn, shard['ShardId'], index)
+        # Shards past the stream's 24 hour retention are no longer listed
+        listed = {shard['ShardId'] for shard in shards}
+        index.stream_positions = {shard: position for shard, position in index.stream_positions.items()
+                                  if shard in listed}
+        index.applied_until = started
+        # Workers reload the file whenever it is saved
+        if index.changes or index.stream_positions != positions or not os.path.exists(path):
+            index.save(path)
+            index.changes = 0
+        time.sleep(interval)
+
+
+def _stream_record(line: str) -> Dict[str, Any]:
+    '''Parses a record in the JSON of the Streams API, whose binary values are base64 encoded.'''
+    record = json.loads(line)
+    for image in ('NewImage', 'OldImage'):
+        for value in record['dynamodb'].get(image, {}).values():
+            if 'B' in value:
+                value['B'] = base64.b64decode(value['B'])
+    return record
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_parser = commands.add_parser('build', help='index the posts of the table')
+    build_parser.add_argument('index', help='file to write the index to')
+    build_parser.add_argument('--segments', type=int, default=8, help='number of parallel scan segments')
+    follow_parser = commands.add_parser('follow', help="apply the table's stream to an index as it changes")
+    follow_parser.add_argument('index', help='file of the index, built with a scan if there is none')
+    follow_parser.add_argument('--interval', type=float, default=5.0, help='seconds between saves')
+    replay_parser = commands.add_parser('replay', help='apply DynamoDB Streams records to an index')
+    replay_parser.add_argument('index', help='file of the index')
+    replay_parser.add_argument('records', help='file of records, one JSON record per line')
+    query_parser = commands.add_parser('query', help='search an index')
+    query_parser.add_argument('index', help='file of the index')
+    query_parser.add_argument('query')
+    query_parser.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    if args.command == 'build':
+        import store
+        index = build(store.dynamodb, args.segments)
+        index.save(args.index)
+        print(f'Indexed {len(index)} posts in {time.monotonic() - started:.1f}s, '
+              f'{os.path.getsize(args.index)} bytes')
+    elif args.command == 'follow':
+        import store
+        from botocore.session import get_session
+        index = SearchIndex.load(args.index) if os.path.exists(args.index) else build(store.dynamodb)
+        follow(store.dynamodb, get_session().create_client('dynamodbstreams'), index, args.index, args.interval)
+    elif args.command == 'replay':
+        index = SearchIndex.load(args.index)
+        with open(args.records) as f:
+            index.apply(_stream_record(line) for line in f if line.strip())
+        index.save(args.index)
+        print(f'Applied {index.changes} changes, {len(index)} posts indexed')
+    else:
+        index = SearchIndex.load(args.index)
+        loaded = time.monotonic()
+        results, total = index.search(args.query, args.limit)
+        print(f'Loaded {len(index)} posts in {(loaded - started) * 1000:.0f}ms, '
+              f'{total} match ({(time.monotonic() - loaded) * 1000:.1f}ms)')
+        for slug, score in results:
+            print(f'{score:8.3f}  {slug}')
@@ -0,0 +1,125 @@
+'''Serves the API with uvicorn on hosts of our own, rather than on Lambda.
+
+    python server.py --workers 0 --port 8080
+
+Runs --workers worker processes (default BLOG_WORKERS, or 1), sharing the
+listening socket; 0 runs one per CPU core the container may use. Workers are
+started fresh rather than forked, so each imports api.py itself and opens its
+own DynamoDB client and connection pool. uvloop and httptools are used when
+they are installed (`pip install uvloop httptools`), as they serve several
+times as many requests per core as asyncio and h11.
+
+On SIGTERM, workers stop accepting connections and finish the requests they
+have, then wait up to BLOG_SHUTDOWN_TIMEOUT seconds for the DynamoDB calls
+still in flight (prefetches, snapshot builds, background deletions) before
+closing their clients, see api.close_store.
+'''
+import argparse
+import importlib.util
+import logging
+import os
+import signal
+from typing import Any, Optional
+
+import uvicorn
+from uvicorn.subprocess import get_subprocess
+from uvicorn.supervisors import Multiprocess
+
+# Longer than the 60 second idle timeout of AWS load balancers, so that they
+# close idle connections rather than reuse one as the server closes it
+KEEP_ALIVE = int(os.environ.get('BLOG_KEEP_ALIVE', '65'))
+# Connections queued for the workers to accept, within net.core.somaxconn
+BACKLOG = int(os.environ.get('BLOG_BACKLOG', '4096'))
+
+logger = logging.getLogger('uvicorn.error')
+
+
+def cpu_count() -> int:
+    '''CPU cores the process may use: its CPU affinity, limited by the cgroup
+    CPU quota of the container, which os.cpu_count doesn't see.'''
+    count = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    quota = _cgroup_cpu_quota()
+    return max(1, min(count, int(quota))) if quota else count
+
+def _cgroup_cpu_quota() -> Optional[float]:
+    try:
+        # cgroup v2: '<quota> <period>', or 'max <period>'
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        return None if quota == 'max' else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        return quota / period if quota > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def _installed(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+class WorkerSupervisor(Multiprocess):
+    '''uvicorn's supervisor of worker processes, which also tells them to stop.
+
+    A container is stopped with a SIGTERM to its main process alone, which the
+    workers wouldn't get. A SIGINT from a terminal goes to all of them, so it
+    isn't passed on, as a second signal makes a worker quit without draining.'''
+    def signal_handler(self, sig: int, frame: Any):
+        if sig == signal.SIGTERM:
+            for process in self.processes:
+                process.terminate()
+        super().signal_handler(sig, frame)
+
+    def startup(self):
+        logger.info('Started parent process [%d]', self.pid)
+        signal.signal(signal.SIGINT, self.signal_handler)
+        signal.signal(signal.SIGTERM, self.signal_handler)
+        for index in range(self.config.workers):
+            # Tells the worker which one it is, see api.resume_deletions
+            os.environ['BLOG_WORKER'] = str(index)
+            process = get_subprocess(config=self.config, target=self.target, sockets=self.sockets)
+            process.start()
+            self.processes.append(process)
+
+
+def serve(app: Any, host: str = '0.0.0.0', port: int = 8080, workers: int = 1, keep_alive: int = KEEP_ALIVE,
+    backlog: int = BACKLOG, access_log: bool = True):
+    '''Runs app, an ASGI app or, with more than one worker, its import string.'''
+    config = uvicorn.Config(
+        app, host=host, port=port, workers=workers,
+        loop='uvloop' if _installed('uvloop') else 'asyncio',
+        http='httptools' if _installed('httptools') else 'h11',
+        timeout_keep_alive=keep_alive, backlog=backlog, access_log=access_log, log_level='info',
+    )
+    logger.info('Serving with %d worker(s), %s event loop and %s HTTP parser', workers, config.loop, config.http)
+    if workers > 1:
+        WorkerSupervisor(config, target=uvicorn.Server(config).run, sockets=[config.bind_socket()]).run()
+    else:
+        uvicorn.Server(config).run()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('BLOG_WORKERS', '1')),
+                        help='worker processes, 0 for one per CPU core')
+    parser.add_argument('--keep-alive', type=int, default=KEEP_ALIVE, help='seconds idle connections are kept open')
+    parser.add_argument('--backlog', type=int, default=BACKLOG, help='connections queued for the workers to accept')
+    parser.add_argument('--no-access-log', action='store_true', help="don't log every request")
+    parser.add_argument('--storage', choices=['dynamodb', 'memory'], default=None,
+                        help='storage engine, defaults to BLOG_STORAGE_ENGINE or dynamodb')
+    args = parser.parse_args()
+
+    if args.storage:
+        # Read by each worker as it imports the store
+        os.environ['BLOG_STORAGE_ENGINE'] = args.storage
+    workers = args.workers or cpu_count()
+    if workers > 1 and os.environ.get('BLOG_STORAGE_ENGINE') == 'memory':
+        logger.warning('Each worker has an in-memory table of its own')
+    serve('api:app', args.host, args.port, workers, args.keep_alive, args.backlog, not args.no_access_log)
@@ -0,0 +1,106 @@
+'''Pre-serialized first pages of the busiest listings, rebuilt in the background
+when older than BLOG_SNAPSHOT_TTL seconds or invalidated by a write.
+'''
+import asyncio
+import contextvars
+import logging
+import math
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from conditional import body_etag
+
+SNAPSHOT_PAGES = int(os.environ.get('BLOG_SNAPSHOT_PAGES', '2'))
+SNAPSHOT_TTL = float(os.environ.get('BLOG_SNAPSHOT_TTL', '5'))
+# Index queries lag writes by a fraction of a second, so after a write no
+# snapshot is built for a while, not to keep one that misses the write
+SETTLE_SECONDS = 1.0
+
+logger = logging.getLogger(__name__)
+
+# Reads a page of a listing: its body and ETag by the page token, and the next page token
+PageFetch = Callable[[Optional[str]], Awaitable[Tuple[bytes, Optional[str]]]]
+
+
+class PageSnapshot:
+    '''The first `pages` pages of a listing, read with `fetch`. A `pages` of 0 disables it.'''
+    def __init__(self, fetch: PageFetch, pages: int = SNAPSHOT_PAGES, ttl: float = SNAPSHOT_TTL):
+        self.pages = pages
+        self.ttl = ttl
+        self._fetch = fetch
+        # Body and ETag by page token, None for the first page
+        self._bodies: Dict[Optional[str], Tuple[bytes, str]] = {}
+        self._built = -math.inf
+        self._not_before = -math.inf
+        # Counts invalidations, so that a build that overlaps one is dropped
+        self._generation = 0
+        self._building: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.expirations = 0
+        self.builds = 0
+
+    def get(self, page_token: Optional[str]) -> Optional[Tuple[bytes, str]]:
+        '''Body and ETag of the page, or None if it isn't in a current snapshot,
+        in which case a new one is started.'''
+        if self.pages <= 0:
+            return None
+        if self._bodies and time.monotonic() - self._built >= self.ttl:
+            self._bodies = {}
+            self.expirations += 1
+        page = self._bodies.get(page_token)
+        if page is not None:
+            self.hits += 1
+            return page
+        self.misses += 1
+        if not self._bodies:
+            self._start_build()
+        return None
+
+    def invalidate(self):
+        self._bodies = {}
+        self._generation += 1
+        self._not_before = time.monotonic() + SETTLE_SECONDS
+        self.invalidations += 1
+
+    def _start_build(self):
+        if time.monotonic() < self._not_before:
+            return
+        loop = asyncio.get_running_loop()
+        if self._building is not None and not self._building.done() and self._building.get_loop() is loop:
+            return
+        # In a context of its own, so the reads don't count towards, or share
+        # the deadline of, the request that happened to start it
+        self._building = contextvars.Context().run(loop.create_task, self._build())
+
+    async def _build(self):
+        generation = self._generation
+        bodies: Dict[Optional[str], Tuple[bytes, str]] = {}
+        page_token: Optional[str] = None
+        try:
+            for _ in range(self.pages):
+                body, next_token = await self._fetch(page_token)
+                bodies[page_token] = (body, body_etag(body))
+                if next_token is None:
+                    break
+                page_token = next_token
+        except Exception:
+            logger.warning('Building a page snapshot failed', exc_info=True)
+            return
+        if generation == self._generation:
+            self._bodies, self._built = bodies, time.monotonic()
+            self.builds += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._bodies),
+            'maxsize': self.pages,
+            'hits': self.hits,
+            'misses': self.misses,
+            # Snapshots dropped by writes
+            'evictions': self.invalidations,
+            'expirations': self.expirations,
+            'builds': self.builds,
+        }
@@ -1,17 +1,57 @@
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from datetime import datetime, timedelta
+import heapq
+import itertools
+import logging
 import os
 import json
 import base64
-from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+import random
+import threading
+import time
+import zlib
+from typing import Any, Callable, Deque, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
 
-import boto3
 from botocore.exceptions import ClientError
 
-from models import NewPost, Post, PostList, PostListItem, UpdatedPost
+from models import NewPost, Post, PostList, PostListItem, UpdatedPost, PostWithComments
 from models import Comment, CommentList, NewComment, UpdateComment
-from models import UpdateUser, NewUser, User, UserList
+from models import UpdateUser, NewUser, User, UserList, Author
+from models import PostBatchItemResult, PostBatchResult, CommentBatchItemResult, CommentBatchResult
+from models import UserBatchItemResult, UserBatchResult, Deletion
+from models import PostSearchItem, PostSearchResult
+from models import comment_counters, dumps, parse_timestamp, partial_from_dynamo_item, partial_from_model
+from backends import StorageBackend, create_backend
+from cache import LRUCache, SingleFlight
+import content
+import instrumentation
+import search
+import throttling
 
-dynamodb = boto3.client('dynamodb')
+logger = logging.getLogger(__name__)
+
+dynamodb = create_backend()
+
+def _after_fork():
+    '''Gives a forked worker process a client and thread pools of its own.'''
+    global dynamodb, _fanout_executor, _prefetch_executor, _deletion_executor, _queued_deletions
+    if not isinstance(dynamodb, StorageBackend):
+        dynamodb = create_backend('dynamodb')
+    _fanout_executor = _prefetch_executor = _deletion_executor = None
+    _queued_deletions = set()
+
+if hasattr(os, 'register_at_fork'):  # not on Windows
+    os.register_at_fork(after_in_child=_after_fork)
+
+def warm_up():
+    '''Opens a connection to DynamoDB, so that the next request doesn't wait for one.'''
+    dynamodb.get_item(
+        TableName=os.environ['BLOG_TABLE'],
+        Key={'PK': {'S': 'WARMUP'}, 'SK': {'S': 'WARMUP'}},
+        ProjectionExpression='PK',
+    )
 
 class NotFoundError(ValueError):
     pass
@@ -22,85 +62,293 @@ class ResourceAlreadyExistsError(ValueError):
 class InvalidPageTokenError(ValueError):
     pass
 
-def get_post(slug: str) -> Post:
-    result = dynamodb.get_item(
-        TableName=os.environ['BLOG_TABLE'],
-        Key={'PK': {'S': f'P#{slug}'}, 'SK': {'S': f'P#{slug}'}},
-    )
+class InvalidFieldsError(ValueError):
+    pass
+
+class UserNotFoundError(NotFoundError):
+    '''The author of a post or comment doesn't exist.'''
+
+class NotAnAuthorError(ValueError):
+    '''The author of a post doesn't have the Author role.'''
+
+class PostNotFoundError(NotFoundError):
+    '''The post of a comment doesn't exist.'''
+
+# Read-through caches for point reads of users and posts. Writes through this
+# module invalidate them; changes made elsewhere show up once entries expire.
+CACHE_SIZE = int(os.environ.get('BLOG_CACHE_SIZE', '1024'))
+CACHE_TTL = float(os.environ.get('BLOG_CACHE_TTL', '60'))
+user_cache = LRUCache(CACHE_SIZE, CACHE_TTL)
+post_cache = LRUCache(CACHE_SIZE, CACHE_TTL)
+
+def cache_stats() -> Dict[str, Dict[str, int]]:
+    return {'users': user_cache.stats(), 'posts': post_cache.stats(), 'pages': page_cache.stats()}
+
+# Concurrent identical point reads and page queries share one DynamoDB call
+COALESCE_READS = os.environ.get('BLOG_COALESCE_READS', '1') == '1'
+get_item_flights = SingleFlight()
+query_flights = SingleFlight()
+
+def coalescing_stats() -> Dict[str, Dict[str, int]]:
+    return {'GetItem': get_item_flights.stats(), 'Query': query_flights.stats()}
+
+def _flight_key(args: Dict[str, Any]) -> str:
+    return json.dumps(args, sort_keys=True, default=str)
+
+def _coalesced(flights: SingleFlight, call: Callable[..., Dict[str, Any]], args: Dict[str, Any]) -> Dict[str, Any]:
+    if not COALESCE_READS:
+        return call(**args)
+    return flights.do(_flight_key(args), lambda: call(**args))
+
+# Thread pool for fanning out DynamoDB calls within a request (shard queries,
+# batch chunks). Tasks in it must not wait on other tasks in it.
+FANOUT_THREADS = int(os.environ.get('BLOG_FANOUT_THREADS', '16'))
+_fanout_executor = None
+
+def _executor() -> ThreadPoolExecutor:
+    global _fanout_executor
+    if _fanout_executor is None:
+        _fanout_executor = ThreadPoolExecutor(max_workers=FANOUT_THREADS)
+    return _fanout_executor
+
+def _fanout(fn: Callable[[Any], Any], args: List[Any]) -> Iterator[Any]:
+    '''Maps fn over args in the fanout pool. Each task runs in a copy of the
+    caller's context, so its DynamoDB calls count towards the caller's request.'''
+    tasks = [(contextvars.copy_context(), arg) for arg in args]
+    return _executor().map(lambda task: task[0].run(fn, task[1]), tasks)
+
+# Number of EntityType-CreatedAt-IndexV2 partitions per entity type, e.g. 'Post#3'
+ENTITY_SHARDS = int(os.environ.get('BLOG_ENTITY_SHARDS', '1'))
+
+def _entity_type(entityType: str, pk: str, sk: str, shards: Optional[int] = None) -> str:
+    shards = ENTITY_SHARDS if shards is None else shards
+    if shards <= 1:
+        return entityType
+    return f'{entityType}#{zlib.crc32(f"{pk}|{sk}".encode()) % shards}'
+
+# Sparse fieldsets: fields= reads only the attributes behind the requested fields
+PAGE_ATTRIBUTES = ('PK', 'SK', 'CreatedAt', 'EntityType', 'AuthorEmail_EntityType')
+
+Fields = Optional[Tuple[str, ...]]
+
+def parse_fields(model: Any, fields: Optional[str]) -> Fields:
+    '''Parses a comma-separated list of field names of model, in model order.'''
+    if fields is None:
+        return None
+    names = set(name.strip() for name in fields.split(','))
+    unknown = names - set(model.FIELD_ATTRIBUTES)
+    if unknown:
+        raise InvalidFieldsError(f'Unknown fields: {", ".join(sorted(unknown))}')
+    return tuple(name for name in model.FIELD_ATTRIBUTES if name in names)
+
+def _projection_args(model: Any, fields: Tuple[str, ...], extra_attributes: Tuple[str, ...] = ()
+    ) -> Dict[str, Any]:
+    attributes = [model.FIELD_ATTRIBUTES[name] for name in fields if name in model.FIELD_ATTRIBUTES]
+    if 'Content' in attributes:
+        attributes.append('ContentEncoding')
+    attributes += [attribute for attribute in extra_attributes if attribute not in attributes]
+    # Names are aliased, as some (Comment, Role) are reserved words
+    names = {f'#a{i}': attribute for i, attribute in enumerate(attributes)}
+    return {'ProjectionExpression': ', '.join(names), 'ExpressionAttributeNames': names}
+
+def _page_projection(model: Any, fields: Fields, expand_author: bool = False) -> Optional[Dict[str, Any]]:
+    if fields is None:
+        return None
+    return _projection_args(model, _item_fields(fields, expand_author), PAGE_ATTRIBUTES)
+
+def _item_fields(fields: Tuple[str, ...], expand_author: bool) -> Tuple[str, ...]:
+    '''Fields of partial list items; expanding authors needs their email.'''
+    if not expand_author:
+        return fields
+    return tuple(dict.fromkeys(fields + ('author_email', 'author')))
+
+def _parse_page_items(model: Any, items: List[Any], fields: Fields, expand_author: bool = False) -> List[Any]:
+    if fields is None:
+        return [model.from_dynamo_item(item) for item in items]
+    item_fields = _item_fields(fields, expand_author)
+    return [partial_from_dynamo_item(model, item_fields, item) for item in items]
+
+def _get_post_args(slug: str, fields: Fields) -> Dict[str, Any]:
+    return {
+        'TableName': os.environ['BLOG_TABLE'],
+        'Key': {'PK': {'S': f'P#{slug}'}, 'SK': {'S': f'P#{slug}'}},
+        **(_projection_args(Post, fields) if fields is not None else {}),
+    }
+
+def get_post(slug: str, fields: Fields = None) -> Post:
+    post = post_cache.get(slug)
+    if post is not None:
+        return partial_from_model(post, fields) if fields is not None else post
+
+    result = _coalesced(get_item_flights, dynamodb.get_item, _get_post_args(slug, fields))
     if 'Item' not in result:
         raise NotFoundError
-    return Post.from_dynamo_item(result['Item'])
+    if fields is not None:
+        return partial_from_dynamo_item(Post, fields, result['Item'])
+    post = Post.from_dynamo_item(result['Item'])
+    post_cache.put(slug, post)
+    return post
 
 
-def create_post(post: NewPost) -> Post:
-    created_at = datetime.now().isoformat()
-    item = {
+def _new_post_item(post: NewPost, created_at: str) -> Dict[str, Dict[str, Any]]:
+    return {
         'PK': {'S': f'P#{post.slug}'},
         'SK': {'S': f'P#{post.slug}'},
-        'EntityType': {'S': 'Post'},
+        'EntityType': {'S': _entity_type('Post', f'P#{post.slug}', f'P#{post.slug}')},
         'Slug': {'S': post.slug},
         'Title': {'S': post.title},
         'AuthorEmail': {'S': post.author_email},
-        'Content': {'S': post.content},
+        **content.encode(post.content),
         'CreatedAt': {'S': created_at},
         'UpdatedAt': {'S': created_at},
         'AuthorEmail_EntityType': {'S': f'{post.author_email}#Post'},
+        'CommentCount': {'N': '0'},
+    }
+
+
+# Validated writes
+#
+# Posts and comments are written in a transaction with a ConditionCheck on
+# their author, its first item, so author errors are reported before conflicts.
+
+def _author_check(email: str, require_author: bool) -> Dict[str, Any]:
+    check = {
+        'TableName': os.environ['BLOG_TABLE'],
+        'Key': {'PK': {'S': f'U#{email}'}, 'SK': {'S': f'U#{email}'}},
+        'ConditionExpression': 'attribute_exists(PK)',
+        # The user is returned if the check fails, which tells a missing user
+        # from one that isn't an author
+        'ReturnValuesOnConditionCheckFailure': 'ALL_OLD',
     }
+    if require_author:
+        check['ConditionExpression'] += ' AND #role = :author'
+        check['ExpressionAttributeNames'] = {'#role': 'Role'}
+        check['ExpressionAttributeValues'] = {':author': {'S': 'Author'}}
+    return {'ConditionCheck': check}
+
+def _author_error(reason: Dict[str, Any]) -> Exception:
+    return NotAnAuthorError() if 'Item' in reason else UserNotFoundError()
+
+def _raise_cancellation(e: ClientError, errors: List[Any]):
+    '''Raises the error for the first transaction item whose condition failed.'''
+    if e.response['Error']['Code'] == 'TransactionCanceledException':
+        for reason, error in zip(e.response.get('CancellationReasons', []), errors):
+            if reason.get('Code') == 'ConditionalCheckFailed':
+                raise error(reason) from e
+    raise e
+
+def _create_transaction(item: Dict[str, Any], require_author: bool) -> List[Dict[str, Any]]:
+    return [
+        _author_check(item['AuthorEmail']['S'], require_author),
+        {'Put': {
+            'TableName': os.environ['BLOG_TABLE'],
+            'Item': item,
+            'ConditionExpression': 'attribute_not_exists(PK)', # Prevent overwriting
+        }},
+    ]
+
+CREATE_ERRORS = [_author_error, lambda reason: ResourceAlreadyExistsError()]
+
+def create_post(post: NewPost) -> Post:
+    item = _new_post_item(post, datetime.now().isoformat())
     try:
-        dynamodb.put_item(
-            TableName=os.environ['BLOG_TABLE'],
-            Item=item,
-            ConditionExpression='attribute_not_exists(PK)', # Prevent overwriting
-        )
-    except ClientError as e:  
-        if e.response['Error']['Code'] == 'ConditionalCheckFailedException': 
-            raise ResourceAlreadyExistsError
-        else:
-            raise
+        dynamodb.transact_write_items(TransactItems=_create_transaction(item, require_author=True))
+    except ClientError as e:
+        _raise_cancellation(e, CREATE_ERRORS)
+    _listings_changed('Post')
+
+    post = Post.from_dynamo_item(item)
+    _post_indexed(post)
+    return post
+
 
-    return Post.from_dynamo_item(item)
+def _update_post_transaction(slug: str, post: UpdatedPost, updated_at: str) -> List[Dict[str, Any]]:
+    content_attributes = content.encode(post.content)
+    update = ('SET Title=:title, AuthorEmail=:author_email, Content=:content, '
+              'UpdatedAt=:updated_at, AuthorEmail_EntityType=:author_key')
+    values = {
+        ':title': {'S': post.title},
+        ':author_email': {'S': post.author_email},
+        ':content': content_attributes['Content'],
+        ':updated_at': {'S': updated_at},
+        ':author_key': {'S': f'{post.author_email}#Post'},
+    }
+    if 'ContentEncoding' in content_attributes:
+        update += ', ContentEncoding=:content_encoding'
+        values[':content_encoding'] = content_attributes['ContentEncoding']
+    else:
+        update += ' REMOVE ContentEncoding'
+    return [
+        _author_check(post.author_email, require_author=True),
+        {'Update': {
+            'TableName': os.environ['BLOG_TABLE'],
+            'Key': {'PK': {'S': f'P#{slug}'}, 'SK': {'S': f'P#{slug}'}},
+            'UpdateExpression': update,
+            'ConditionExpression': 'attribute_exists(PK)',
+            'ExpressionAttributeValues': values,
+        }},
+    ]
 
+UPDATE_POST_ERRORS = [_author_error, lambda reason: NotFoundError()]
+
+# Post fields an update doesn't write. They are read concurrently with the
+# transaction, which can't return the item it writes as update_item does.
+UNCHANGED_POST_FIELDS = ('created_at', 'comment_count', 'last_comment_at')
+
+def _unchanged_post_args(slug: str) -> Dict[str, Any]:
+    return {**_get_post_args(slug, UNCHANGED_POST_FIELDS), 'ConsistentRead': True}
+
+def _updated_post(slug: str, post: UpdatedPost, updated_at: str, unchanged: Dict[str, Any]) -> Post:
+    if 'Item' not in unchanged:
+        raise NotFoundError
+    return Post.construct(slug=slug, **post.dict(), created_at=parse_timestamp(unchanged['Item']['CreatedAt']['S']),
+                          updated_at=parse_timestamp(updated_at), **comment_counters(unchanged['Item']))
 
 def update_post(slug: str, post: UpdatedPost) -> Post:
-    result = dynamodb.update_item(
-        TableName=os.environ['BLOG_TABLE'],
-        ReturnValues='ALL_NEW',
-        Key={'PK': {'S': f'P#{slug}'}, 'SK': {'S': f'P#{slug}'}},
-        UpdateExpression='SET Title=:title, AuthorEmail=:author_email, Content=:content, '
-                         'UpdatedAt=:updated_at, AuthorEmail_EntityType=:author_key',
-        ExpressionAttributeValues={
-            ':title': {'S': post.title},
-            ':author_email': {'S': post.author_email},
-            ':content': {'S': post.content},
-            ':updated_at': {'S': datetime.now().isoformat()},
-            ':author_key': {'S': f'{post.author_email}#Post'},
-        },
-    )
-    return Post.from_dynamo_item(result['Attributes'])
+    '''Updates a post, in one round trip: the fields it doesn't change are read
+    at the same time as the transaction.'''
+    updated_at = datetime.now().isoformat()
+    unchanged = _executor().submit(contextvars.copy_context().run, dynamodb.get_item, **_unchanged_post_args(slug))
+    try:
+        dynamodb.transact_write_items(TransactItems=_update_post_transaction(slug, post, updated_at))
+    except ClientError as e:
+        _raise_cancellation(e, UPDATE_POST_ERRORS)
+    post_cache.invalidate(slug)
+    _listings_changed('Post')
 
+    result = unchanged.result()
+    if 'Item' not in result:
+        # Created after the read and before the transaction
+        result = dynamodb.get_item(**_unchanged_post_args(slug))
+    updated = _updated_post(slug, post, updated_at, result)
+    _post_indexed(updated)
+    return updated
 
 def delete_post(slug: str):
-    dynamodb.delete_item(
-        TableName=os.environ['BLOG_TABLE'],
-        Key={'PK': {'S': f'P#{slug}'}, 'SK': {'S': f'P#{slug}'}},
-    )
+    '''Deletes a post, and starts a background job deleting its comments.'''
+    dynamodb.transact_write_items(TransactItems=_start_deletion_transaction('post', slug, f'P#{slug}'))
+    post_cache.invalidate(slug)
+    _listings_changed('Post')
+    _post_unindexed(slug)
+    schedule_deletion('post', slug)
 
 
 class PageToken(NamedTuple):
-    last_evaluated_key: Dict
+    last_evaluated_key: Optional[Dict]
     scan_forward: bool
+    # For sharded listings, the last key read from each shard (by shard number)
+    shard_keys: Optional[Dict[str, Optional[Dict]]] = None
 
     @classmethod
     def decode(cls, token: str) -> 'PageToken':
         data = json.loads(base64.b64decode(token.encode()).decode())
-        return cls(data['last_evaluated_key'], data['scan_forward'])
+        return cls(data.get('last_evaluated_key'), data['scan_forward'], data.get('shard_keys'))
 
     def encode(self) -> str:
-        data = self._asdict()
+        data = {key: value for key, value in self._asdict().items() if value is not None}
         return base64.b64encode(json.dumps(data).encode()).decode()
 
-def get_page_for_entity(entityType: str, page_token: Optional[PageToken], limit: int=20
-    ) -> Tuple[List[Any], Optional[PageToken], Optional[PageToken]]:
+def _entity_page_query(entityType: str) -> Tuple[Dict[str, Any], List[str]]:
     base_args = {
         'TableName': os.environ['BLOG_TABLE'],
         'IndexName': os.environ['BLOG_TABLE_ENTITY_INDEX'],
@@ -110,10 +358,9 @@ def get_page_for_entity(entityType: str, page_token: Optional[PageToken], limit:
         }
     }
     index_keys = ['PK', 'SK', 'CreatedAt', 'EntityType']
-    return _get_page(base_args, index_keys, page_token, limit)
+    return base_args, index_keys
 
-def get_page_for_author_entity(author: str, entityType: str, page_token: Optional[PageToken],
-    limit: int=20) -> Tuple[List[Any], Optional[PageToken], Optional[PageToken]]:
+def _author_entity_page_query(author: str, entityType: str) -> Tuple[Dict[str, Any], List[str]]:
     base_args = {
         'TableName': os.environ['BLOG_TABLE'],
         'IndexName': os.environ['BLOG_TABLE_AUTHOR_INDEX'],
@@ -123,12 +370,113 @@ def get_page_for_author_entity(author: str, entityType: str, page_token: Optiona
         }
     }
     index_keys = ['PK', 'SK', 'AuthorEmail_EntityType', 'CreatedAt']
-    return _get_page(base_args, index_keys, page_token, limit)
+    return base_args, index_keys
 
-def _get_page(base_args: Dict[str, Any], index_keys: List[str], page_token: Optional[PageToken], limit: int=20
-    ) -> Tuple[List[Any], Optional[PageToken], Optional[PageToken]]:
+def _post_comments_page_query(post_slug: str) -> Tuple[Dict[str, Any], List[str]]:
+    base_args = {
+        'TableName': os.environ['BLOG_TABLE'],
+        'KeyConditionExpression': 'PK = :pk AND begins_with(SK, :prefix)',
+        'ExpressionAttributeValues': {
+            ':pk': {'S': f'P#{post_slug}'},
+            ':prefix': {'S': 'C#'}
+        }
+    }
+    index_keys = ['PK', 'SK']
+    return base_args, index_keys
+
+Page = Tuple[List[Any], Optional[PageToken], Optional[PageToken]]
+
+# Prefetching of the next page of listings into page_cache. Writes drop the
+# prefetched pages of the entity types they change by bumping their generation.
+PREFETCH_PAGES = os.environ.get('BLOG_PREFETCH_PAGES', '0') == '1'
+page_cache = LRUCache(int(os.environ.get('BLOG_PREFETCH_CACHE_SIZE', '256')),
+                      float(os.environ.get('BLOG_PREFETCH_TTL', '10')))
+_listing_generations: Dict[str, int] = {}
+_prefetching: set = set()
+_prefetching_lock = threading.Lock()
+
+def _listings_changed(*entityTypes: str):
+    '''Drops the prefetched pages of the listings of these entity types.'''
+    for entityType in entityTypes:
+        _listing_generations[entityType] = _listing_generations.get(entityType, 0) + 1
+
+def _page_cache_key(entityType: str, base_args: Dict[str, Any], page_token: PageToken, limit: int) -> Tuple:
+    return (entityType, _listing_generations.get(entityType, 0), _flight_key(base_args), limit, page_token.encode())
+
+def _prefetched_page(entityType: str, base_args: Dict[str, Any], page_token: Optional[PageToken], limit: int
+    ) -> Optional[Page]:
+    if not PREFETCH_PAGES or page_token is None:
+        return None
+    page = page_cache.get(_page_cache_key(entityType, base_args, page_token, limit))
+    if page is not None:
+        instrumentation.PAGE_PREFETCH_HITS.inc((('entity', entityType),))
+    return page
+
+def _next_page_key(entityType: str, base_args: Dict[str, Any], page: Page, limit: int) -> Optional[Tuple]:
+    '''Key of the page after page, if it should be prefetched: not while
+    DynamoDB throttles calls, and not if it is being prefetched already.'''
+    if not PREFETCH_PAGES or page[1] is None or throttling.limiter.rate is not None:
+        return None
+    key = _page_cache_key(entityType, base_args, page[1], limit)
+    with _prefetching_lock:
+        if key in _prefetching or key in page_cache:
+            return None
+        _prefetching.add(key)
+    return key
+
+def _store_prefetched(entityType: str, key: Tuple, page: Page, metrics: instrumentation.RequestMetrics):
+    page_cache.put(key, page)
+    instrumentation.PAGE_PREFETCHES.inc((('entity', entityType),))
+    capacity = sum(capacity for _, _, capacity in metrics.by_operation().values())
+    if capacity:
+        instrumentation.PAGE_PREFETCH_CAPACITY.inc((('entity', entityType),), capacity)
+
+def _prefetch(entityType: str, key: Tuple, read: Callable[[], Page]):
+    try:
+        with instrumentation.recording(instrumentation.RequestMetrics()) as metrics:
+            page = read()
+        _store_prefetched(entityType, key, page, metrics)
+    except Exception:
+        logger.warning('Prefetching a page of %s failed', entityType, exc_info=True)
+    finally:
+        with _prefetching_lock:
+            _prefetching.discard(key)
+
+def _read_page(entityType: str, base_args: Dict[str, Any], page_token: Optional[PageToken], limit: int,
+    read: Callable[[Optional[PageToken]], Page]) -> Page:
+    '''Reads a page of a listing with read, unless it was prefetched, and prefetches the next one.'''
+    page = _prefetched_page(entityType, base_args, page_token, limit) or read(page_token)
+    key = _next_page_key(entityType, base_args, page, limit)
+    if key is not None:
+        # In a context of its own, so the read doesn't count towards the request
+        _background_executor().submit(contextvars.Context().run, _prefetch, entityType, key,
+                                      lambda: read(page[1]))
+    return page
+
+def get_page_for_entity(entityType: str, page_token: Optional[PageToken], limit: int=20,
+    projection: Optional[Dict[str, Any]]=None) -> Page:
+    _check_shard_keys(page_token)
+    base_args = {**_entity_page_query(entityType)[0], **(projection or {})}
+    return _read_page(entityType, base_args, page_token, limit,
+                      lambda token: _get_entity_page(entityType, token, limit, projection))
+
+def _get_entity_page(entityType: str, page_token: Optional[PageToken], limit: int=20,
+    projection: Optional[Dict[str, Any]]=None) -> Page:
+    if ENTITY_SHARDS > 1:
+        return _get_sharded_page(entityType, page_token, limit, projection)
+    base_args, index_keys = _entity_page_query(entityType)
+    return _get_page({**base_args, **(projection or {})}, index_keys, page_token, limit)
+
+def get_page_for_author_entity(author: str, entityType: str, page_token: Optional[PageToken],
+    limit: int=20, projection: Optional[Dict[str, Any]]=None) -> Page:
+    base_args, index_keys = _author_entity_page_query(author, entityType)
+    base_args = {**base_args, **(projection or {})}
+    return _read_page(entityType, base_args, page_token, limit,
+                      lambda token: _get_page(base_args, index_keys, token, limit))
+
+def _page_query_args(base_args: Dict[str, Any], page_token: Optional[PageToken], limit: int=20
+    ) -> Dict[str, Any]:
     ascending = False
-    count = 0
     args = {
         **base_args,
         'ScanIndexForward': page_token.scan_forward if page_token else ascending,
@@ -137,10 +485,19 @@ def _get_page(base_args: Dict[str, Any], index_keys: List[str], page_token: Opti
     }
     if page_token and page_token.last_evaluated_key:
         args['ExclusiveStartKey'] = page_token.last_evaluated_key
-    
+    return args
+
+def _get_page(base_args: Dict[str, Any], index_keys: List[str], page_token: Optional[PageToken], limit: int=20
+    ) -> Tuple[List[Any], Optional[PageToken], Optional[PageToken]]:
+    args = _page_query_args(base_args, page_token, limit)
+    results = _query_page_items(args, limit)
+    return _build_page(results, index_keys, page_token, limit)
+
+def _query_page_items(args: Dict[str, Any], limit: int) -> List[Any]:
+    count = 0
     results = []
     while True:
-        response = dynamodb.query(**args)
+        response = _coalesced(query_flights, dynamodb.query, args)
         results.extend(response['Items'])
         count += len(response['Items'])
         if count >= limit:
@@ -150,7 +507,11 @@ def _get_page(base_args: Dict[str, Any], index_keys: List[str], page_token: Opti
         else:
             args['Limit'] = limit - count
             args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return results
 
+def _build_page(results: List[Any], index_keys: List[str], page_token: Optional[PageToken], limit: int=20
+    ) -> Tuple[List[Any], Optional[PageToken], Optional[PageToken]]:
+    ascending = False
     if len(results) == 0:
         return [], None, None
 
@@ -174,29 +535,94 @@ def _get_page(base_args: Dict[str, Any], index_keys: List[str], page_token: Opti
 
     return results, nextPageToken, prevPageToken
 
+def _get_sharded_page(entityType: str, page_token: Optional[PageToken], limit: int=20,
+    projection: Optional[Dict[str, Any]]=None) -> Tuple[List[Any], Optional[PageToken], Optional[PageToken]]:
+    '''Queries every shard of the entity type in parallel and merges them into one page.'''
+    shard_args = [_shard_page_args(entityType, shard, page_token, limit, projection)
+                  for shard in range(ENTITY_SHARDS)]
+    shard_results = list(_fanout(lambda args: _query_page_items(args, limit), shard_args))
+    return _merge_shard_pages(shard_results, page_token, limit)
+
+def _check_shard_keys(page_token: Optional[PageToken]):
+    '''Rejects tokens from a listing that was sharded differently.'''
+    if page_token is not None and (page_token.shard_keys is None) != (ENTITY_SHARDS <= 1):
+        raise InvalidPageTokenError
+
+def _shard_page_args(entityType: str, shard: int, page_token: Optional[PageToken], limit: int=20,
+    projection: Optional[Dict[str, Any]]=None) -> Dict[str, Any]:
+    base_args, _ = _entity_page_query(f'{entityType}#{shard}')
+    if page_token:
+        page_token = PageToken(page_token.shard_keys.get(str(shard)), page_token.scan_forward)
+    return _page_query_args({**base_args, **(projection or {})}, page_token, limit)
+
+def _merge_shard_pages(shard_results: List[List[Any]], page_token: Optional[PageToken], limit: int=20
+    ) -> Tuple[List[Any], Optional[PageToken], Optional[PageToken]]:
+    ascending = False
+    index_keys = ['PK', 'SK', 'CreatedAt', 'EntityType']
+    scan_forward = page_token.scan_forward if page_token else ascending
+    merged = list(itertools.islice(
+        heapq.merge(*shard_results, key=lambda item: (item['CreatedAt']['S'], item['PK']['S'], item['SK']['S']),
+                    reverse=not scan_forward),
+        limit + 1))
+    if len(merged) == 0:
+        return [], None, None
+
+    # Each shard gets a cursor to continue from and one to go back from
+    on_page = set(id(item) for item in merged[:limit])
+    continue_keys, back_keys = {}, {}
+    for shard, items in enumerate(shard_results):
+        shard_on_page = [item for item in items if id(item) in on_page]
+        if shard_on_page:
+            continue_keys[str(shard)] = {key: shard_on_page[-1][key] for key in index_keys}
+        else:
+            continue_keys[str(shard)] = page_token.shard_keys.get(str(shard)) if page_token else None
+        back_keys[str(shard)] = {key: items[0][key] for key in index_keys} if items else None
+
+    if scan_forward == ascending:
+        hasMoreItemsNext = len(merged) > limit
+        hasMoreItemsPrev = page_token is not None
+        results = merged[:limit]
+        next_keys, prev_keys = continue_keys, back_keys
+    else:
+        hasMoreItemsNext = page_token is not None
+        hasMoreItemsPrev = len(merged) > limit
+        # If we go to previous page, shards are scanned opposite of sort direction
+        results = list(reversed(merged[:limit]))
+        next_keys, prev_keys = back_keys, continue_keys
+
+    nextPageToken = PageToken(None, ascending, next_keys) if hasMoreItemsNext else None
+    prevPageToken = PageToken(None, not ascending, prev_keys) if hasMoreItemsPrev else None
+
+    return results, nextPageToken, prevPageToken
 
-def list_posts(pageToken: Optional[str] = None, limit: int = 2) -> PostList:
+def _decode_page_token(pageToken: Optional[str]) -> Optional[PageToken]:
     try:
-        page = PageToken.decode(pageToken) if pageToken else None
+        return PageToken.decode(pageToken) if pageToken else None
     except:
         raise InvalidPageTokenError
 
-    items, nextToken, prevToken = get_page_for_entity('Post', page, limit=limit)
 
-    parsed_items = [PostListItem.from_dynamo_item(item) for item in items]
-    return PostList(
+def list_posts(pageToken: Optional[str] = None, limit: int = 2, expand_author: bool = False, fields: Fields=None) -> PostList:
+    page = _decode_page_token(pageToken)
+
+    items, nextToken, prevToken = get_page_for_entity('Post', page, limit=limit,
+        projection=_page_projection(PostListItem, fields, expand_author))
+
+    parsed_items = _parse_page_items(PostListItem, items, fields, expand_author)
+    if expand_author:
+        _expand_authors(parsed_items)
+    return PostList.construct(
         posts=parsed_items,
         nextPageToken=nextToken.encode() if nextToken else None,
         prevPageToken=prevToken.encode() if prevToken else None,
     )
 
 
-def create_comment(post_slug: str, comment: NewComment) -> Comment:
-    created_at = datetime.now().isoformat()
-    item = {
+def _new_comment_item(post_slug: str, comment: NewComment, created_at: str) -> Dict[str, Dict[str, Any]]:
+    return {
         'PK': {'S': f'P#{post_slug}'},
         'SK': {'S': f'C#{created_at}#{comment.author_email}'},
-        'EntityType': {'S': 'Comment'},
+        'EntityType': {'S': _entity_type('Comment', f'P#{post_slug}', f'C#{created_at}#{comment.author_email}')},
         'Slug': {'S': post_slug},
         'AuthorEmail': {'S': comment.author_email},
         'Comment': {'S': comment.content},
@@ -204,17 +630,45 @@ def create_comment(post_slug: str, comment: NewComment) -> Comment:
         'UpdatedAt': {'S': created_at},
         'AuthorEmail_EntityType': {'S': f'{comment.author_email}#Comment'}
     }
+
+# Comment counters
+#
+# Posts keep a CommentCount and LastCommentAt, updated in the comment write's
+# transaction on condition that the post exists. reconcile_comment_counts.py
+# recounts both.
+
+def _comment_counter_update(post_slug: str, delta: int, last_comment_at: Optional[str] = None) -> Dict[str, Any]:
+    update = 'ADD CommentCount :delta'
+    values = {':delta': {'N': str(delta)}}
+    if last_comment_at is not None:
+        update += ' SET LastCommentAt = :last_comment_at'
+        values[':last_comment_at'] = {'S': last_comment_at}
+    return {'Update': {
+        'TableName': os.environ['BLOG_TABLE'],
+        'Key': {'PK': {'S': f'P#{post_slug}'}, 'SK': {'S': f'P#{post_slug}'}},
+        'UpdateExpression': update,
+        'ConditionExpression': 'attribute_exists(PK)',
+        'ExpressionAttributeValues': values,
+    }}
+
+def _count_new_comments(items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    '''Counter update for new comments of one post.'''
+    return _comment_counter_update(items[0]['Slug']['S'], len(items), max(item['CreatedAt']['S'] for item in items))
+
+def _create_comment_transaction(item: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return _create_transaction(item, require_author=False) + [_count_new_comments([item])]
+
+CREATE_COMMENT_ERRORS = CREATE_ERRORS + [lambda reason: PostNotFoundError()]
+
+def create_comment(post_slug: str, comment: NewComment) -> Comment:
+    item = _new_comment_item(post_slug, comment, datetime.now().isoformat())
     try:
-        dynamodb.put_item(
-            TableName=os.environ['BLOG_TABLE'],
-            Item=item,
-            ConditionExpression='attribute_not_exists(PK)', # Prevent overwriting
-        )
-    except ClientError as e:  
-        if e.response['Error']['Code'] == 'ConditionalCheckFailedException': 
-            raise ResourceAlreadyExistsError
-        else:
-            raise
+        dynamodb.transact_write_items(TransactItems=_create_comment_transaction(item))
+    except ClientError as e:
+        _raise_cancellation(e, CREATE_COMMENT_ERRORS)
+    post_cache.invalidate(post_slug)
+    # Post listings include comment counters
+    _listings_changed('Comment', 'Post')
 
     return Comment.from_dynamo_item(item)
 
@@ -229,76 +683,144 @@ def update_comment(post_slug: str, author: str, date: datetime, comment: UpdateC
             ':updated_at': {'S': datetime.now().isoformat()},
         },
     )
+    _listings_changed('Comment')
     return Comment.from_dynamo_item(result['Attributes'])
 
+def _comment_key_args(post_slug: str, author: str, date: datetime) -> Dict[str, Any]:
+    return {
+        'TableName': os.environ['BLOG_TABLE'],
+        'Key': {'PK': {'S': f'P#{post_slug}'}, 'SK': {'S': f'C#{date.isoformat()}#{author}'}},
+    }
+
+def _delete_comment_transaction(post_slug: str, author: str, date: datetime) -> List[Dict[str, Any]]:
+    return [
+        {'Delete': {**_comment_key_args(post_slug, author, date), 'ConditionExpression': 'attribute_exists(PK)'}},
+        _comment_counter_update(post_slug, -1),
+    ]
+
+DELETE_COMMENT_ERRORS = [lambda reason: NotFoundError(), lambda reason: PostNotFoundError()]
+
 def delete_comment(post_slug: str, author: str, date: datetime) -> None:
-    dynamodb.delete_item(
-        TableName=os.environ['BLOG_TABLE'],
-        Key={'PK': {'S': f'P#{post_slug}'}, 'SK': {'S': f'C#{date.isoformat()}#{author}'}},
+    try:
+        try:
+            dynamodb.transact_write_items(TransactItems=_delete_comment_transaction(post_slug, author, date))
+        except ClientError as e:
+            _raise_cancellation(e, DELETE_COMMENT_ERRORS)
+    except PostNotFoundError:
+        # The post was deleted, and its comments are being deleted with it
+        dynamodb.delete_item(**_comment_key_args(post_slug, author, date))
+    except NotFoundError:
+        # Deleting a comment that doesn't exist does nothing
+        pass
+    post_cache.invalidate(post_slug)
+    _listings_changed('Comment', 'Post')
+
+def list_comments_for_post(post_slug: str, pageToken: Optional[str]=None, limit: int=20, expand_author: bool=False, fields: Fields=None) -> CommentList:
+    page = _decode_page_token(pageToken)
+
+    base_args, index_keys = _post_comments_page_query(post_slug)
+    base_args = {**base_args, **(_page_projection(Comment, fields, expand_author) or {})}
+    items, nextToken, prevToken = _read_page('Comment', base_args, page, limit,
+                                             lambda token: _get_page(base_args, index_keys, token, limit))
+
+    parsed_items = _parse_page_items(Comment, items, fields, expand_author)
+    if expand_author:
+        _expand_authors(parsed_items)
+    return CommentList.construct(
+        comments=parsed_items,
+        nextPageToken=nextToken.encode() if nextToken else None,
+        prevPageToken=prevToken.encode() if prevToken else None,
     )
 
-def list_comments_for_post(post_slug: str, pageToken: Optional[str]=None, limit: int=20) -> CommentList:
-    try:
-        page = PageToken.decode(pageToken) if pageToken else None
-    except:
-        raise InvalidPageTokenError
-    
-    base_args = {
+def _post_with_comments_args(post_slug: str, limit: int) -> Dict[str, Any]:
+    # Comment sort keys (C#...) sort before the post's (P#...), so reading the
+    # partition backwards returns the post followed by its newest comments.
+    return {
         'TableName': os.environ['BLOG_TABLE'],
-        'KeyConditionExpression': 'PK = :pk AND starts_with(SK, :prefix)',
+        'KeyConditionExpression': 'PK = :pk AND SK BETWEEN :comments AND :post',
         'ExpressionAttributeValues': {
             ':pk': {'S': f'P#{post_slug}'},
-            ':prefix': {'S': 'C#'}
-        }
+            ':comments': {'S': 'C#'},
+            ':post': {'S': f'P#{post_slug}'},
+        },
+        'ScanIndexForward': False,
+        # the post, the page of comments, and one more to know if there are more
+        'Limit': limit + 2,
     }
-    index_keys = ['PK', 'SK']
-    items, nextToken, prevToken = _get_page(base_args, index_keys, page, limit)
 
-    parsed_items = [Comment.from_dynamo_item(item) for item in items]
-    return CommentList(
-        comments=parsed_items,
-        nextPageToken=nextToken.encode() if nextToken else None,
-        prevPageToken=prevToken.encode() if prevToken else None,
+def _split_post_and_comments(post_slug: str, items: List[Any], limit: int) -> PostWithComments:
+    post_items = [item for item in items if item['SK']['S'] == f'P#{post_slug}']
+    if not post_items:
+        raise NotFoundError
+    comment_items = [item for item in items if item['SK']['S'].startswith('C#')]
+    # Tokens are the same as those of list_comments_for_post
+    comment_items, nextToken, _ = _build_page(comment_items, ['PK', 'SK'], None, limit)
+
+    post = Post.from_dynamo_item(post_items[0])
+    post_cache.put(post_slug, post)
+    return PostWithComments.construct(
+        **post.dict(),
+        comments=[Comment.from_dynamo_item(item) for item in comment_items],
+        commentsNextPageToken=nextToken.encode() if nextToken else None,
     )
 
-def list_comments(pageToken: Optional[str]=None, limit: int=20) -> CommentList:
-    try:
-        page = PageToken.decode(pageToken) if pageToken else None
-    except:
-        raise InvalidPageTokenError
+def get_post_with_comments(post_slug: str, limit: int=20) -> PostWithComments:
+    '''Gets a post and the first page of its comments with a single query.'''
+    items = _query_page_items(_post_with_comments_args(post_slug, limit), limit + 1)
+    return _split_post_and_comments(post_slug, items, limit)
 
-    items, nextToken, prevToken = get_page_for_entity('Comment', page, limit=limit)
+def list_comments(pageToken: Optional[str]=None, limit: int=20, expand_author: bool=False, fields: Fields=None) -> CommentList:
+    page = _decode_page_token(pageToken)
 
-    parsed_items = [Comment.from_dynamo_item(item) for item in items]
-    return CommentList(
+    items, nextToken, prevToken = get_page_for_entity('Comment', page, limit=limit,
+        projection=_page_projection(Comment, fields, expand_author))
+
+    parsed_items = _parse_page_items(Comment, items, fields, expand_author)
+    if expand_author:
+        _expand_authors(parsed_items)
+    return CommentList.construct(
         comments=parsed_items,
         nextPageToken=nextToken.encode() if nextToken else None,
         prevPageToken=prevToken.encode() if prevToken else None,
     )
 
 
-def get_user(email: str) -> User:
-    result = dynamodb.get_item(
-        TableName=os.environ['BLOG_TABLE'],
-        Key={'PK': {'S': f'U#{email}'}, 'SK': {'S': f'U#{email}'}},
-    )
+def _get_user_args(email: str, fields: Fields) -> Dict[str, Any]:
+    return {
+        'TableName': os.environ['BLOG_TABLE'],
+        'Key': {'PK': {'S': f'U#{email}'}, 'SK': {'S': f'U#{email}'}},
+        **(_projection_args(User, fields) if fields is not None else {}),
+    }
+
+def get_user(email: str, fields: Fields = None) -> User:
+    user = user_cache.get(email)
+    if user is not None:
+        return partial_from_model(user, fields) if fields is not None else user
+
+    result = _coalesced(get_item_flights, dynamodb.get_item, _get_user_args(email, fields))
     if 'Item' not in result:
         raise NotFoundError
+    if fields is not None:
+        return partial_from_dynamo_item(User, fields, result['Item'])
 
-    return User.from_dynamo_item(result['Item'])
+    user = User.from_dynamo_item(result['Item'])
+    user_cache.put(email, user)
+    return user
 
-def create_user(user: NewUser) -> User:
-    created_at = datetime.now().isoformat()
-    item = {
+def _new_user_item(user: NewUser, created_at: str) -> Dict[str, Dict[str, Any]]:
+    return {
         'PK': {'S': f'U#{user.email}'},
         'SK': {'S': f'U#{user.email}'},
-        'EntityType': {'S': 'User'},
+        'EntityType': {'S': _entity_type('User', f'U#{user.email}', f'U#{user.email}')},
         'FirstName': {'S': user.first_name},
         'LastName': {'S': user.last_name},
         'Role': {'S': user.role},
         'CreatedAt': {'S': created_at},
         'UpdatedAt': {'S': created_at},
     }
+
+def create_user(user: NewUser) -> User:
+    item = _new_user_item(user, datetime.now().isoformat())
     try:
         dynamodb.put_item(
             TableName=os.environ['BLOG_TABLE'],
@@ -310,6 +832,7 @@ def create_user(user: NewUser) -> User:
             raise ResourceAlreadyExistsError
         else:
             raise
+    _listings_changed('User')
 
     return User.from_dynamo_item(item)
 
@@ -326,55 +849,669 @@ def update_user(email: str, user: UpdateUser) -> User:
             ':updated_at': {'S': datetime.now().isoformat()},
         },
     )
+    user_cache.invalidate(email)
+    _listings_changed('User')
     return User.from_dynamo_item(result['Attributes'])
 
 def delete_user(email: str):
-    dynamodb.delete_item(
-        TableName=os.environ['BLOG_TABLE'],
-        Key={'PK': {'S': f'U#{email}'}, 'SK': {'S': f'U#{email}'}},
-    )
+    '''Deletes a user, and starts a background job deleting their posts and comments.'''
+    dynamodb.transact_write_items(TransactItems=_start_deletion_transaction('user', email, f'U#{email}'))
+    user_cache.invalidate(email)
+    _listings_changed('User')
+    schedule_deletion('user', email)
 
-def list_users(pageToken: Optional[str]=None, limit: int=20) -> UserList:
-    try:
-        page = PageToken.decode(pageToken) if pageToken else None
-    except:
-        raise InvalidPageTokenError
+def list_users(pageToken: Optional[str]=None, limit: int=20, fields: Fields=None) -> UserList:
+    page = _decode_page_token(pageToken)
 
-    items, nextToken, prevToken = get_page_for_entity('User', page, limit=limit)
+    items, nextToken, prevToken = get_page_for_entity('User', page, limit=limit,
+        projection=_page_projection(User, fields))
 
-    parsed_items = [User.from_dynamo_item(item) for item in items]
-    return UserList(
+    parsed_items = _parse_page_items(User, items, fields)
+    return UserList.construct(
         users=parsed_items,
         nextPageToken=nextToken.encode() if nextToken else None,
         prevPageToken=prevToken.encode() if prevToken else None,
     )
 
-def list_posts_for_author(email: str, pageToken: Optional[str]=None, limit: int=20) -> PostList:
-    try:
-        page = PageToken.decode(pageToken) if pageToken else None
-    except:
-        raise InvalidPageTokenError
+def list_posts_for_author(email: str, pageToken: Optional[str]=None, limit: int=20, expand_author: bool=False, fields: Fields=None) -> PostList:
+    page = _decode_page_token(pageToken)
 
-    items, nextToken, prevToken = get_page_for_author_entity(email, 'Post', page, limit=limit)
+    items, nextToken, prevToken = get_page_for_author_entity(email, 'Post', page, limit=limit,
+        projection=_page_projection(PostListItem, fields, expand_author))
 
-    parsed_items = [PostListItem.from_dynamo_item(item) for item in items]
-    return PostList(
+    parsed_items = _parse_page_items(PostListItem, items, fields, expand_author)
+    if expand_author:
+        _expand_authors(parsed_items)
+    return PostList.construct(
         posts=parsed_items,
         nextPageToken=nextToken.encode() if nextToken else None,
         prevPageToken=prevToken.encode() if prevToken else None,
     )
 
-def list_comments_for_author(email: str, pageToken: Optional[str]=None, limit: int=20) -> CommentList:
-    try:
-        page = PageToken.decode(pageToken) if pageToken else None
-    except:
-        raise InvalidPageTokenError
+def list_comments_for_author(email: str, pageToken: Optional[str]=None, limit: int=20, fields: Fields=None) -> CommentList:
+    page = _decode_page_token(pageToken)
 
-    items, nextToken, prevToken = get_page_for_author_entity(email, 'Comment', page, limit=limit)
+    items, nextToken, prevToken = get_page_for_author_entity(email, 'Comment', page, limit=limit,
+        projection=_page_projection(Comment, fields))
 
-    parsed_items = [Comment.from_dynamo_item(item) for item in items]
-    return CommentList(
+    parsed_items = _parse_page_items(Comment, items, fields)
+    return CommentList.construct(
         comments=parsed_items,
         nextPageToken=nextToken.encode() if nextToken else None,
         prevPageToken=prevToken.encode() if prevToken else None,
     )
+
+
+# Full-text search of posts, see search.py. The index is loaded from
+# BLOG_SEARCH_INDEX (or built with a scan), updated by this worker's writes,
+# and reloaded when `search.py follow` updates the file.
+SEARCH_INDEX_PATH = os.environ.get('BLOG_SEARCH_INDEX') or None
+SEARCH_SCAN_SEGMENTS = int(os.environ.get('BLOG_SEARCH_SCAN_SEGMENTS', '4'))
+SEARCH_RELOAD_INTERVAL = float(os.environ.get('BLOG_SEARCH_RELOAD_INTERVAL', '10'))
+# Own writes this close to a reloaded index's applied_until are applied again
+SEARCH_REAPPLY_MARGIN = 5.0
+# At most this many own writes are kept to apply to a reloaded index
+SEARCH_RECENT_CHANGES = 10000
+# Results beyond these can't be paged to
+MAX_SEARCH_RESULTS = 1000
+search_index: Optional[search.SearchIndex] = None
+# Post writes made while the index is loaded or built, applied to it once it is
+_search_changes: Optional[List[Callable[[search.SearchIndex], None]]] = None
+_search_changes_lock = threading.Lock()
+_search_load_lock = threading.Lock()
+# Post writes of the worker by time, to apply again to a reloaded index
+_search_recent: Deque[Tuple[float, Callable[[search.SearchIndex], None]]] = deque(maxlen=SEARCH_RECENT_CHANGES)
+# Modification time of the file the index was loaded from, and when it was last checked
+_search_file_mtime: Optional[float] = None
+_search_checked_at = 0.0
+
+def get_search_index() -> search.SearchIndex:
+    global search_index, _search_changes
+    if search_index is not None:
+        _reload_search_index()
+        return search_index
+    with _search_load_lock:
+        if search_index is not None:
+            return search_index
+        with _search_changes_lock:
+            _search_changes = []
+        try:
+            index = _load_search_index()
+        except BaseException:
+            with _search_changes_lock:
+                _search_changes = None
+            raise
+        with _search_changes_lock:
+            for change in _search_changes:
+                change(index)
+            search_index, _search_changes = index, None
+    return index
+
+def _load_search_index() -> search.SearchIndex:
+    global _search_file_mtime
+    if SEARCH_INDEX_PATH is not None:
+        try:
+            mtime = os.stat(SEARCH_INDEX_PATH).st_mtime
+            index = search.SearchIndex.load(SEARCH_INDEX_PATH)
+            _search_file_mtime = mtime
+            return index
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            logger.warning('Rebuilding the search index, %s is not one', SEARCH_INDEX_PATH)
+    index = search.build(dynamodb, SEARCH_SCAN_SEGMENTS)
+    _save_search_index(index)
+    return index
+
+def _reload_search_index():
+    '''Replaces the index with the file's, if it changed since it was loaded.'''
+    global search_index, _search_file_mtime, _search_checked_at
+    now = time.monotonic()
+    if SEARCH_INDEX_PATH is None or SEARCH_RELOAD_INTERVAL <= 0 or now - _search_checked_at < SEARCH_RELOAD_INTERVAL:
+        return
+    # Searches go on with the current index while one thread reloads it
+    if not _search_load_lock.acquire(blocking=False):
+        return
+    try:
+        _search_checked_at = now
+        try:
+            mtime = os.stat(SEARCH_INDEX_PATH).st_mtime
+            if mtime == _search_file_mtime:
+                return
+            index = search.SearchIndex.load(SEARCH_INDEX_PATH)
+        except (OSError, ValueError):
+            logger.warning('Reloading the search index from %s failed', SEARCH_INDEX_PATH, exc_info=True)
+            return
+        with _search_changes_lock:
+            for written_at, change in _search_recent:
+                if written_at >= index.applied_until - SEARCH_REAPPLY_MARGIN:
+                    change(index)
+            index.changes = 0
+            search_index, _search_file_mtime = index, mtime
+    finally:
+        _search_load_lock.release()
+
+def save_search_index():
+    '''Saves the index, if it was loaded and changed since, so that the next worker starts with these changes.'''
+    if search_index is not None and search_index.changes:
+        _save_search_index(search_index)
+
+def _save_search_index(index: search.SearchIndex):
+    if SEARCH_INDEX_PATH is None:
+        return
+    try:
+        index.save(SEARCH_INDEX_PATH)
+        index.changes = 0
+    except OSError:
+        # On Lambda, next to the code is read-only
+        logger.warning('Saving the search index to %s failed', SEARCH_INDEX_PATH, exc_info=True)
+
+def _search_changed(change: Callable[[search.SearchIndex], None]):
+    '''Applies a change to the index, or queues it while the index is loaded.
+    Before that, there's nothing to change: loading reads the posts as they are.'''
+    with _search_changes_lock:
+        if SEARCH_INDEX_PATH is not None:
+            _search_recent.append((time.time(), change))
+        if _search_changes is not None:
+            _search_changes.append(change)
+            return
+        index = search_index
+    if index is not None:
+        change(index)
+
+def _post_indexed(post: Post):
+    _search_changed(lambda index: index.put(post.slug, post.title, post.content))
+
+def _post_unindexed(slug: str):
+    _search_changed(lambda index: index.remove(slug))
+
+def _decode_search_token(q: str, pageToken: Optional[str]) -> int:
+    '''Offset of the page. Tokens are only valid for the query they were returned for.'''
+    if not pageToken:
+        return 0
+    try:
+        data = json.loads(base64.b64decode(pageToken.encode()).decode())
+        offset = data['offset']
+    except Exception:
+        raise InvalidPageTokenError
+    if data.get('q') != q or not isinstance(offset, int) or not 0 < offset < MAX_SEARCH_RESULTS:
+        raise InvalidPageTokenError
+    return offset
+
+def search_posts(q: str, pageToken: Optional[str]=None, limit: int=20) -> PostSearchResult:
+    '''Posts matching any word of q, the most relevant first.'''
+    offset = _decode_search_token(q, pageToken)
+    limit = min(limit, MAX_SEARCH_RESULTS - offset)
+    ranked, total = get_search_index().search(q, limit, offset)
+    projection = ', '.join(PostListItem.FIELD_ATTRIBUTES.values())
+    items = {item['Slug']['S']: item for item in _batch_get(
+        [{'PK': {'S': f'P#{slug}'}, 'SK': {'S': f'P#{slug}'}} for slug, _ in ranked], projection)}
+    posts = [PostSearchItem.construct(**PostListItem.from_dynamo_item(items[slug]).dict(exclude_unset=True),
+                                      score=round(score, 4))
+             for slug, score in ranked if slug in items]
+    next_offset = offset + limit
+    more = next_offset < min(total, MAX_SEARCH_RESULTS)
+    return PostSearchResult.construct(
+        posts=posts,
+        total=total,
+        nextPageToken=base64.b64encode(json.dumps({'q': q, 'offset': next_offset}).encode()).decode()
+            if more else None,
+    )
+
+
+# Streaming listings as NDJSON, fetching the next page while one is sent
+STREAM_PAGE_SIZE = 100
+_prefetch_executor = None
+
+PageFetch = Callable[[Optional[PageToken]], Page]
+
+def _background_executor() -> ThreadPoolExecutor:
+    '''Thread pool for reading pages ahead. Not the fanout pool, since sharded
+    pages fan out into it themselves.'''
+    global _prefetch_executor
+    if _prefetch_executor is None:
+        _prefetch_executor = ThreadPoolExecutor(max_workers=FANOUT_THREADS)
+    return _prefetch_executor
+
+def _stream_pages(fetch: PageFetch) -> Iterator[List[Any]]:
+    future = _background_executor().submit(contextvars.copy_context().run, fetch, None)
+    while future is not None:
+        items, nextToken, _ = future.result()
+        future = (_background_executor().submit(contextvars.copy_context().run, fetch, nextToken)
+                  if nextToken else None)
+        yield items
+
+def _ndjson(model: Any, items: List[Any]) -> bytes:
+    return b''.join(dumps(model.from_dynamo_item(item).dict()) + b'\n' for item in items)
+
+def stream_posts() -> Iterator[bytes]:
+    for items in _stream_pages(lambda token: _get_entity_page('Post', token, STREAM_PAGE_SIZE)):
+        yield _ndjson(PostListItem, items)
+
+def stream_comments() -> Iterator[bytes]:
+    for items in _stream_pages(lambda token: _get_entity_page('Comment', token, STREAM_PAGE_SIZE)):
+        yield _ndjson(Comment, items)
+
+def stream_users() -> Iterator[bytes]:
+    for items in _stream_pages(lambda token: _get_entity_page('User', token, STREAM_PAGE_SIZE)):
+        yield _ndjson(User, items)
+
+
+# Batch writes
+#
+# BatchWriteItem takes no condition, so existing keys are looked up first and
+# reported as conflicts (racy), or with transactional=True each chunk is
+# written with TransactWriteItems and attribute_not_exists(PK) (exact).
+
+BATCH_WRITE_SIZE = 25
+BATCH_GET_SIZE = 100
+
+BatchStatus = Tuple[str, Optional[str]]
+CREATED: BatchStatus = ('created', None)
+
+def _item_key(item: Dict[str, Any]) -> Tuple[str, str]:
+    return item['PK']['S'], item['SK']['S']
+
+def _batch_timestamps(count: int) -> List[str]:
+    '''Returns distinct, increasing creation times for the items of a batch.'''
+    now = datetime.now()
+    return [(now + timedelta(microseconds=i)).isoformat() for i in range(count)]
+
+def _batch_get(keys: List[Dict[str, Any]], projection: Optional[str]=None) -> List[Dict[str, Any]]:
+    '''Fetches items with BatchGetItem, in concurrent chunks of 100 keys.'''
+    chunks = [keys[i:i + BATCH_GET_SIZE] for i in range(0, len(keys), BATCH_GET_SIZE)]
+    if len(chunks) == 1:
+        return _batch_get_chunk(chunks[0], projection)
+    return [item for items in _fanout(lambda chunk: _batch_get_chunk(chunk, projection), chunks)
+            for item in items]
+
+def _batch_get_chunk(keys: List[Dict[str, Any]], projection: Optional[str]=None) -> List[Dict[str, Any]]:
+    table = os.environ['BLOG_TABLE']
+    request: Dict[str, Any] = {'Keys': keys}
+    if projection:
+        request['ProjectionExpression'] = projection
+    items = []
+    attempt = 0
+    while True:
+        started = time.monotonic()
+        response = dynamodb.batch_get_item(RequestItems={table: request})
+        items.extend(response['Responses'].get(table, []))
+        unprocessed = response.get('UnprocessedKeys', {}).get(table)
+        if not unprocessed:
+            return items
+        delay = throttling.unprocessed_backoff('BatchGetItem', attempt, time.monotonic() - started)
+        if delay is None:
+            raise throttling.Overloaded(throttling.OVERLOADED_RETRY_AFTER)
+        time.sleep(delay)
+        request = unprocessed
+        attempt += 1
+
+def _batch_write(requests: List[Dict[str, Any]]) -> List[BatchStatus]:
+    '''Sends put/delete requests with BatchWriteItem, returning a status for each.'''
+    chunks = [requests[i:i + BATCH_WRITE_SIZE] for i in range(0, len(requests), BATCH_WRITE_SIZE)]
+    return [status for statuses in _fanout(_batch_write_chunk, chunks) for status in statuses]
+
+def _request_key(request: Dict[str, Any]) -> Tuple[str, str]:
+    if 'PutRequest' in request:
+        return _item_key(request['PutRequest']['Item'])
+    return _item_key(request['DeleteRequest']['Key'])
+
+def _batch_write_chunk(requests: List[Dict[str, Any]]) -> List[BatchStatus]:
+    table = os.environ['BLOG_TABLE']
+    pending = requests
+    attempt = 0
+    while pending:
+        started = time.monotonic()
+        response = dynamodb.batch_write_item(RequestItems={table: pending})
+        pending = response.get('UnprocessedItems', {}).get(table, [])
+        if pending:
+            delay = throttling.unprocessed_backoff('BatchWriteItem', attempt, time.monotonic() - started)
+            if delay is None:
+                break
+            time.sleep(delay)
+            attempt += 1
+
+    unprocessed = set(_request_key(request) for request in pending)
+    failed = ('failed', f'Not processed after {attempt + 1} attempts')
+    return [failed if _request_key(request) in unprocessed else CREATED for request in requests]
+
+# Builds a transaction item to write along with new items, e.g. a counter update
+Counter = Callable[[List[Dict[str, Any]]], Dict[str, Any]]
+
+def _transact_create_chunk(items: List[Dict[str, Any]], counter: Optional[Counter] = None) -> List[BatchStatus]:
+    '''Puts the items in one transaction, retrying without any that conflict.'''
+    statuses: List[BatchStatus] = [CREATED] * len(items)
+    pending = list(range(len(items)))
+    while pending:
+        try:
+            dynamodb.transact_write_items(TransactItems=[{
+                'Put': {
+                    'TableName': os.environ['BLOG_TABLE'],
+                    'Item': items[i],
+                    'ConditionExpression': 'attribute_not_exists(PK)', # Prevent overwriting
+                },
+            } for i in pending] + ([counter([items[i] for i in pending])] if counter is not None else []))
+            break
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            reasons = e.response.get('CancellationReasons', [])
+            if counter is not None and len(reasons) > len(pending) and \
+                    reasons[len(pending)].get('Code') == 'ConditionalCheckFailed':
+                raise PostNotFoundError from e
+            conflicts = [i for i, reason in zip(pending, reasons) if reason.get('Code') == 'ConditionalCheckFailed']
+            if code == 'TransactionCanceledException' and conflicts:
+                for i in conflicts:
+                    statuses[i] = ('conflict', 'Already exists')
+                pending = [i for i in pending if i not in conflicts]
+                continue
+            elif code != 'TransactionCanceledException' and code not in throttling.THROTTLING_ERRORS:
+                raise
+            # Cancelled for another reason (e.g. a conflicting transaction), or
+            # throttled past the client's retries outside of a request
+            codes = [reason.get('Code') for reason in reasons if reason.get('Code') not in (None, 'None')]
+            for i in pending:
+                statuses[i] = ('failed', codes[0] if codes else code)
+            break
+    return statuses
+
+def _batch_create(items: List[Dict[str, Any]], rejected: Dict[int, BatchStatus], transactional: bool=False,
+    counter: Optional[Counter] = None) -> List[BatchStatus]:
+    '''Creates new items in bulk, skipping the rejected ones, without overwriting existing ones.'''
+    statuses: List[Optional[BatchStatus]] = [rejected.get(i) for i in range(len(items))]
+    seen = set()
+    for i, item in enumerate(items):
+        if statuses[i] is None:
+            if _item_key(item) in seen:
+                statuses[i] = ('conflict', 'Duplicate of an earlier item in the batch')
+            seen.add(_item_key(item))
+
+    candidates = [i for i in range(len(items)) if statuses[i] is None]
+    if transactional:
+        chunks = [candidates[i:i + BATCH_WRITE_SIZE] for i in range(0, len(candidates), BATCH_WRITE_SIZE)]
+        chunk_statuses = _fanout(lambda chunk: _transact_create_chunk([items[i] for i in chunk], counter), chunks)
+        for chunk, chunk_status in zip(chunks, chunk_statuses):
+            for i, status in zip(chunk, chunk_status):
+                statuses[i] = status
+        return statuses
+
+    existing = set(_item_key(item) for item in _batch_get(
+        [{'PK': items[i]['PK'], 'SK': items[i]['SK']} for i in candidates], projection='PK, SK'))
+    to_write = []
+    for i in candidates:
+        if _item_key(items[i]) in existing:
+            statuses[i] = ('conflict', 'Already exists')
+        else:
+            to_write.append(i)
+    for i, status in zip(to_write, _batch_write([{'PutRequest': {'Item': items[i]}} for i in to_write])):
+        statuses[i] = status
+    written = [items[i] for i in to_write if statuses[i] == CREATED]
+    if counter is not None and written:
+        _update_if_exists(counter(written)['Update'])
+    return statuses
+
+def _update_if_exists(update: Dict[str, Any]):
+    '''Runs an update whose condition is that the item exists, unless it doesn't.'''
+    try:
+        dynamodb.update_item(**update)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+def _check_authors(emails: List[str], require_author: bool) -> Dict[str, str]:
+    '''Returns the reason each invalid author email can't be used, by email.'''
+    def check(email: str) -> Optional[str]:
+        try:
+            user = get_user(email)
+        except NotFoundError:
+            return 'User does not exist'
+        if require_author and user.role != 'Author':
+            return 'User is not an author'
+        return None
+
+    unique_emails = sorted(set(emails))
+    return {email: error for email, error in zip(unique_emails, _fanout(check, unique_emails))
+            if error is not None}
+
+def _expand_authors(items: List[Any]):
+    '''Sets the author of each post or comment, fetching uncached ones with BatchGetItem.'''
+    users, missing = _cached_authors(items)
+    _set_authors(items, users, _batch_get(_user_keys(missing)))
+
+def _cached_authors(items: List[Any]) -> Tuple[Dict[str, User], List[str]]:
+    '''The cached authors of posts or comments by email, and the emails of the others.'''
+    emails = set(item.author_email for item in items)
+    users = {}
+    for email in emails:
+        user = user_cache.get(email)
+        if user is not None:
+            users[email] = user
+    return users, sorted(emails - set(users))
+
+def _user_keys(emails: List[str]) -> List[Dict[str, Any]]:
+    return [{'PK': {'S': f'U#{email}'}, 'SK': {'S': f'U#{email}'}} for email in emails]
+
+def _set_authors(items: List[Any], users: Dict[str, User], fetched: List[Dict[str, Any]]):
+    for item in fetched:
+        user = User.from_dynamo_item(item)
+        user_cache.put(user.email, user)
+        users[user.email] = user
+
+    for item in items:
+        user = users.get(item.author_email)
+        item.author = Author(email=user.email, first_name=user.first_name, last_name=user.last_name) if user else None
+
+def batch_create_posts(posts: List[NewPost], transactional: bool=False) -> PostBatchResult:
+    invalid_authors = _check_authors([post.author_email for post in posts], require_author=True)
+    items = [_new_post_item(post, created_at) for post, created_at in zip(posts, _batch_timestamps(len(posts)))]
+    rejected = {i: ('invalid', invalid_authors[post.author_email])
+                for i, post in enumerate(posts) if post.author_email in invalid_authors}
+    statuses = _batch_create(items, rejected, transactional)
+    _listings_changed('Post')
+    created = {i: Post.from_dynamo_item(item) for i, (item, (status, _)) in enumerate(zip(items, statuses))
+               if status == 'created'}
+    for post in created.values():
+        _post_indexed(post)
+    return PostBatchResult(results=[
+        PostBatchItemResult(index=i, status=status, error=error, post=created.get(i))
+        for i, (status, error) in enumerate(statuses)
+    ])
+
+def batch_create_comments(post_slug: str, comments: List[NewComment], transactional: bool=False
+    ) -> CommentBatchResult:
+    try:
+        get_post(post_slug, fields=('slug',))
+    except NotFoundError as e:
+        raise PostNotFoundError from e
+    invalid_authors = _check_authors([comment.author_email for comment in comments], require_author=False)
+    items = [_new_comment_item(post_slug, comment, created_at)
+             for comment, created_at in zip(comments, _batch_timestamps(len(comments)))]
+    rejected = {i: ('invalid', invalid_authors[comment.author_email])
+                for i, comment in enumerate(comments) if comment.author_email in invalid_authors}
+    statuses = _batch_create(items, rejected, transactional, counter=_count_new_comments)
+    post_cache.invalidate(post_slug)
+    _listings_changed('Comment', 'Post')
+    return CommentBatchResult(results=[
+        CommentBatchItemResult(index=i, status=status, error=error,
+                               comment=Comment.from_dynamo_item(item) if status == 'created' else None)
+        for i, (item, (status, error)) in enumerate(zip(items, statuses))
+    ])
+
+def batch_create_users(users: List[NewUser], transactional: bool=False) -> UserBatchResult:
+    items = [_new_user_item(user, created_at) for user, created_at in zip(users, _batch_timestamps(len(users)))]
+    statuses = _batch_create(items, {}, transactional)
+    _listings_changed('User')
+    return UserBatchResult(results=[
+        UserBatchItemResult(index=i, status=status, error=error,
+                            user=User.from_dynamo_item(item) if status == 'created' else None)
+        for i, (item, (status, error)) in enumerate(zip(items, statuses))
+    ])
+
+
+# Cascading deletes
+#
+# Deleting a post or user writes a DeleteJob item, and a background job then
+# deletes the content created up to the deletion. Unfinished jobs are resumed
+# until done or DELETION_MAX_ATTEMPTS runs failed.
+DELETION_THREADS = int(os.environ.get('BLOG_DELETION_THREADS', '2'))
+DELETION_MAX_ATTEMPTS = int(os.environ.get('BLOG_DELETION_MAX_ATTEMPTS', '3'))
+DELETION_PAGE_SIZE = 100
+_deletion_executor = None
+# Jobs submitted to the executor and not started yet
+_queued_deletions: Set[Tuple[str, str]] = set()
+_deletion_lock = threading.Lock()
+
+def _deletion_key(kind: str, target: str) -> Dict[str, Dict[str, str]]:
+    return {'PK': {'S': f'J#{kind}#{target}'}, 'SK': {'S': f'J#{kind}#{target}'}}
+
+def _start_deletion_transaction(kind: str, target: str, pk: str) -> List[Dict[str, Any]]:
+    now = datetime.now().isoformat()
+    job = {
+        **_deletion_key(kind, target),
+        'EntityType': {'S': 'DeleteJob'},
+        'Kind': {'S': kind},
+        'Target': {'S': target},
+        'Status': {'S': 'running'},
+        'Deleted': {'N': '0'},
+        'Attempts': {'N': '0'},
+        'DeletedAt': {'S': now},
+        'CreatedAt': {'S': now},
+        'UpdatedAt': {'S': now},
+    }
+    return [
+        {'Put': {'TableName': os.environ['BLOG_TABLE'], 'Item': job}},
+        {'Delete': {'TableName': os.environ['BLOG_TABLE'], 'Key': {'PK': {'S': pk}, 'SK': {'S': pk}}}},
+    ]
+
+def get_deletion(kind: str, target: str) -> Deletion:
+    result = dynamodb.get_item(TableName=os.environ['BLOG_TABLE'], Key=_deletion_key(kind, target))
+    if 'Item' not in result:
+        raise NotFoundError
+    return Deletion.from_dynamo_item(result['Item'])
+
+def schedule_deletion(kind: str, target: str) -> bool:
+    '''Runs the deletion job in the background, unless it is queued already.'''
+    global _deletion_executor
+    with _deletion_lock:
+        if (kind, target) in _queued_deletions:
+            return False
+        _queued_deletions.add((kind, target))
+        if _deletion_executor is None:
+            _deletion_executor = ThreadPoolExecutor(max_workers=DELETION_THREADS)
+    _deletion_executor.submit(_run_queued_deletion, kind, target)
+    return True
+
+def _run_queued_deletion(kind: str, target: str):
+    # A deletion made while the job runs queues it again, to run with its cutoff
+    with _deletion_lock:
+        _queued_deletions.discard((kind, target))
+    run_deletion(kind, target)
+
+def resume_deletions() -> List[Tuple[str, str]]:
+    '''Schedules every unfinished deletion job, returning the kinds and targets of those not queued already.'''
+    base_args, _ = _entity_page_query('DeleteJob')
+    jobs = []
+    for items in _query_pages(base_args):
+        for item in items:
+            kind, target = item['PK']['S'].split('#', 2)[1:]
+            if schedule_deletion(kind, target):
+                jobs.append((kind, target))
+    return jobs
+
+def run_deletion(kind: str, target: str):
+    '''Deletes what a deleted post or user left behind.'''
+    attempts = 0
+    try:
+        job = _update_deletion(kind, target, 'SET #status=:status, UpdatedAt=:now ADD Attempts :one REMOVE #error',
+                               {':status': {'S': 'running'}, ':one': {'N': '1'}}, ReturnValues='ALL_NEW')['Attributes']
+        attempts = int(job['Attempts']['N'])
+        # Jobs written before DeletedAt was kept were created by the deletion
+        before = job.get('DeletedAt', job['CreatedAt'])['S']
+        if kind == 'post':
+            _delete_comments(kind, target, f'P#{target}', before)
+        else:
+            _delete_author_items(kind, target, before)
+    except Exception as e:
+        logger.exception('Deletion of %s %s failed', kind, target)
+        # Left in the index to be resumed, until it has failed too often
+        give_up = ' REMOVE EntityType' if attempts >= DELETION_MAX_ATTEMPTS else ''
+        _update_deletion(kind, target, 'SET #status=:status, #error=:error, UpdatedAt=:now' + give_up,
+                         {':status': {'S': 'failed'}, ':error': {'S': str(e) or type(e).__name__}})
+        return
+    _update_deletion(kind, target, 'SET #status=:status, UpdatedAt=:now REMOVE EntityType',
+                     {':status': {'S': 'done'}})
+
+def _update_deletion(kind: str, target: str, update: str, values: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+    names = {name: name[1:].capitalize() for name in ('#status', '#error') if name in update}
+    return dynamodb.update_item(
+        TableName=os.environ['BLOG_TABLE'],
+        Key=_deletion_key(kind, target),
+        UpdateExpression=update,
+        ExpressionAttributeValues={**values, ':now': {'S': datetime.now().isoformat()}},
+        **({'ExpressionAttributeNames': names} if names else {}),
+        **kwargs,
+    )
+
+def _query_pages(args: Dict[str, Any]) -> Iterator[List[Dict[str, Any]]]:
+    args = dict(args)
+    while True:
+        response = dynamodb.query(**args)
+        yield response['Items']
+        if 'LastEvaluatedKey' not in response:
+            break
+        args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def _delete_items(kind: str, target: str, items: List[Dict[str, Any]]):
+    if not items:
+        return
+    statuses = _batch_write([{'DeleteRequest': {'Key': {'PK': item['PK'], 'SK': item['SK']}}} for item in items])
+    _listings_changed('Post', 'Comment')
+    failed = [error for status, error in statuses if (status, error) != CREATED]
+    # Deleting already deleted items does nothing, so on a resume the count
+    # includes items deleted before the interruption again
+    _update_deletion(kind, target, 'ADD Deleted :count SET UpdatedAt=:now',
+                     {':count': {'N': str(len(items) - len(failed))}})
+    if failed:
+        raise RuntimeError(failed[0])
+
+def _delete_comments(kind: str, target: str, pk: str, before: str):
+    '''Deletes the comments of a post created up to before.'''
+    for items in _query_pages({
+        'TableName': os.environ['BLOG_TABLE'],
+        'KeyConditionExpression': 'PK = :pk AND begins_with(SK, :comment)',
+        'FilterExpression': 'CreatedAt <= :before',
+        'ExpressionAttributeValues': {':pk': {'S': pk}, ':comment': {'S': 'C#'}, ':before': {'S': before}},
+        'ProjectionExpression': 'PK, SK',
+        'Limit': DELETION_PAGE_SIZE,
+    }):
+        _delete_items(kind, target, items)
+
+def _delete_author_items(kind: str, email: str, before: str):
+    for entityType in ('Comment', 'Post'):
+        base_args, _ = _author_entity_page_query(email, entityType)
+        for items in _query_pages({
+            **base_args,
+            'KeyConditionExpression': base_args['KeyConditionExpression'] + ' AND CreatedAt <= :before',
+            'ExpressionAttributeValues': {**base_args['ExpressionAttributeValues'], ':before': {'S': before}},
+            'ProjectionExpression': 'PK, SK',
+            'Limit': DELETION_PAGE_SIZE,
+        }):
+            if entityType == 'Post':
+                # Comments first, so that an interrupted job finds the post again
+                for item in items:
+                    _delete_comments(kind, email, item['PK']['S'], before)
+                _delete_items(kind, email, items)
+                for item in items:
+                    post_cache.invalidate(item['PK']['S'][2:])
+                    _post_unindexed(item['PK']['S'][2:])
+            else:
+                _delete_items(kind, email, items)
+                _uncount_comments(items)
+
+def _uncount_comments(items: List[Dict[str, Any]]):
+    '''Takes deleted comments off the counters of their posts.'''
+    counts: Dict[str, int] = {}
+    for item in items:
+        counts[item['PK']['S'][2:]] = counts.get(item['PK']['S'][2:], 0) + 1
+    for slug, count in counts.items():
+        _update_if_exists(_comment_counter_update(slug, -count)['Update'])
+        post_cache.invalidate(slug)
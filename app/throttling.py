@@ -0,0 +1,314 @@
+'''Client-side flow control of DynamoDB calls: an adaptive rate limit, retries
+bounded by the deadline of the request (replacing botocore's), and load shedding.
+'''
+import asyncio
+from contextvars import ContextVar
+import functools
+import math
+import os
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError, HTTPClientError
+
+import instrumentation
+from instrumentation import OPERATIONS
+
+REQUEST_DEADLINE = float(os.environ.get('BLOG_REQUEST_DEADLINE', '2.5'))
+MAX_ATTEMPTS = int(os.environ.get('BLOG_DYNAMODB_MAX_ATTEMPTS', '3'))
+# Kept from the remaining time of a Lambda invocation, to send the response
+LAMBDA_MARGIN = 0.2
+BACKOFF_BASE = 0.025
+BACKOFF_CAP = 1.0
+# Retry-After of Overloaded responses
+OVERLOADED_RETRY_AFTER = 1.0
+
+THROTTLING_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+# Cancellation reasons of transactions that were throttled
+THROTTLING_REASONS = ('ThrottlingError', 'ProvisionedThroughputExceeded')
+TRANSIENT_ERRORS = ('InternalServerError', 'ServiceUnavailable')
+
+
+class Shed(Exception):
+    '''A call given up on so that its request fails fast. Clients may retry after retry_after seconds.'''
+    def __init__(self, retry_after: float):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+class RateLimited(Shed):
+    '''The rate limit wouldn't let the call through before the request's deadline.'''
+
+class Overloaded(Shed):
+    '''The call was throttled until it ran out of attempts or time.'''
+
+
+class AdaptiveRateLimiter:
+    '''Token bucket whose rate is cut on throttles and grows back without them.'''
+    def __init__(self, decrease: float = 0.7, increase: float = 0.1, cooldown: float = 0.1,
+        recovery: float = 10.0, min_rate: float = 1.0):
+        self.decrease = decrease
+        self.increase = increase
+        self.cooldown = cooldown
+        self.recovery = recovery
+        self.min_rate = min_rate
+        self.rate: Optional[float] = None
+        self._tokens = 0.0
+        self._refilled = 0.0
+        self._last_throttle = -math.inf
+        self._last_decrease = -math.inf
+        # Calls sent in the current window of about a second, and the rate of the last one
+        self._window_started = time.monotonic()
+        self._window_calls = 0
+        self._sent_rate = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait: Optional[float] = None) -> Tuple[float, bool]:
+        '''Takes a token. Returns how long to wait for it, and whether it was taken,
+        which it isn't if the wait would be longer than max_wait.'''
+        with self._lock:
+            now = time.monotonic()
+            wait = 0.0
+            if self.rate is not None:
+                self._refill(now)
+            if self.rate is not None:
+                wait = max(0.0, (1 - self._tokens) / self.rate)
+                if wait > 0 and max_wait is not None and wait > max_wait:
+                    return wait, False
+                self._tokens -= 1
+            self._count_sent(now)
+            return wait, True
+
+    def on_throttle(self):
+        with self._lock:
+            now = time.monotonic()
+            self._last_throttle = now
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            sent = self._measured_rate(now)
+            if self.rate is None:
+                self._tokens = 0.0
+                rate = sent
+            else:
+                self._refill(now)
+                rate = min(self.rate, sent) if sent else self.rate
+            self._set_rate(max(self.min_rate, rate * self.decrease))
+            self._refilled = now
+
+    def _refill(self, now: float):
+        if now - self._last_throttle > self.recovery:
+            self._set_rate(None)
+            return
+        elapsed = now - self._refilled
+        # At most a second's worth of calls in a burst
+        self._tokens = min(max(1.0, self.rate), self._tokens + elapsed * self.rate)
+        self._set_rate(self.rate * (1 + self.increase) ** elapsed)
+        self._refilled = now
+
+    def _set_rate(self, rate: Optional[float]):
+        self.rate = rate
+        instrumentation.DYNAMODB_RATE_LIMIT.set((), rate or 0.0)
+
+    def _count_sent(self, now: float):
+        elapsed = now - self._window_started
+        if elapsed >= 1.0:
+            self._sent_rate = self._window_calls / elapsed
+            self._window_started, self._window_calls = now, 0
+        self._window_calls += 1
+
+    def _measured_rate(self, now: float) -> float:
+        '''Calls per second sent lately.'''
+        current = self._window_calls / max(0.1, now - self._window_started)
+        return max(self._sent_rate, current)
+
+
+# Shared by the sync and async clients of the worker, which use the same table
+limiter = AdaptiveRateLimiter()
+
+
+_deadline: ContextVar[Optional[float]] = ContextVar('deadline', default=None)
+
+def remaining() -> Optional[float]:
+    '''Seconds left until the deadline of the request being handled, None outside of requests.'''
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+class DeadlineMiddleware:
+    '''ASGI middleware that sets the deadline of each HTTP request.'''
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        budget = REQUEST_DEADLINE
+        # The Lambda context, passed on by Mangum
+        context = scope.get('aws.context')
+        if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+            budget = min(budget, context.get_remaining_time_in_millis() / 1000 - LAMBDA_MARGIN)
+        token = _deadline.set(time.monotonic() + budget)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _deadline.reset(token)
+
+
+def _is_throttle(error: Exception) -> bool:
+    if not isinstance(error, ClientError):
+        return False
+    code = error.response.get('Error', {}).get('Code')
+    if code == 'TransactionCanceledException':
+        return any(reason.get('Code') in THROTTLING_REASONS for reason in error.response.get('CancellationReasons', []))
+    return code in THROTTLING_ERRORS
+
+def _is_transient(error: Exception) -> bool:
+    if isinstance(error, (BotocoreConnectionError, HTTPClientError)):
+        return True
+    if not isinstance(error, ClientError):
+        return False
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+    return error.response.get('Error', {}).get('Code') in TRANSIENT_ERRORS or status >= 500
+
+def _acquire(operation: str) -> float:
+    '''Seconds to wait for the rate limiter before a call. Raises RateLimited
+    rather than waiting past the deadline.'''
+    wait, taken = limiter.reserve(remaining())
+    if not taken:
+        instrumentation.DYNAMODB_SHED.inc((('operation', operation), ('reason', 'rate_limited')))
+        raise RateLimited(wait)
+    if wait:
+        instrumentation.DYNAMODB_LIMITER_WAIT_SECONDS.inc((('operation', operation),), wait)
+    return wait
+
+def _retry_delay(operation: str, reason: str, attempt: int, call_seconds: float) -> Optional[float]:
+    '''Jittered delay before another attempt, None when out of attempts or time.'''
+    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+    left = remaining()
+    # Another attempt should take about as long as this one did
+    if attempt + 1 < MAX_ATTEMPTS and (left is None or delay + call_seconds < left):
+        instrumentation.DYNAMODB_RETRIES.inc((('operation', operation), ('reason', reason)))
+        return delay
+    return None
+
+def _backoff(operation: str, error: Exception, attempt: int, call_seconds: float) -> Optional[float]:
+    '''Delay before retrying a failed call, None if its error should be raised.'''
+    throttled = _is_throttle(error)
+    if throttled:
+        limiter.on_throttle()
+    elif not _is_transient(error):
+        return None
+    delay = _retry_delay(operation, 'throttled' if throttled else 'error', attempt, call_seconds)
+    if delay is None and throttled and remaining() is not None:
+        instrumentation.DYNAMODB_SHED.inc((('operation', operation), ('reason', 'overloaded')))
+        raise Overloaded(OVERLOADED_RETRY_AFTER) from error
+    return delay
+
+def unprocessed_backoff(operation: str, attempt: int, call_seconds: float) -> Optional[float]:
+    '''Delay before resending what a batch call left unprocessed, None when out of attempts or time.'''
+    limiter.on_throttle()
+    return _retry_delay(operation, 'unprocessed', attempt, call_seconds)
+
+
+class _InFlight:
+    '''Number of guarded calls running, in every thread and event loop of the worker.'''
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self, delta: int):
+        with self._lock:
+            self.count += delta
+            instrumentation.DYNAMODB_IN_FLIGHT.set((), self.count)
+
+in_flight = _InFlight()
+
+async def drain(timeout: float, interval: float = 0.01) -> int:
+    '''Waits up to timeout seconds for the calls in flight to finish. Returns how many are left.'''
+    deadline = time.monotonic() + timeout
+    while in_flight.count and time.monotonic() < deadline:
+        await asyncio.sleep(interval)
+    return in_flight.count
+
+
+def _operation(name: str) -> str:
+    return ''.join(part.title() for part in name.split('_'))
+
+def _guarded(name: str, method: Callable[..., Dict[str, Any]]) -> Callable[..., Dict[str, Any]]:
+    operation = _operation(name)
+
+    @functools.wraps(method)
+    def call(**kwargs):
+        in_flight.add(1)
+        try:
+            attempt = 0
+            while True:
+                wait = _acquire(operation)
+                if wait:
+                    time.sleep(wait)
+                started = time.monotonic()
+                try:
+                    return method(**kwargs)
+                except Exception as e:
+                    delay = _backoff(operation, e, attempt, time.monotonic() - started)
+                    if delay is None:
+                        raise
+                time.sleep(delay)
+                attempt += 1
+        finally:
+            in_flight.add(-1)
+    return call
+
+def _guarded_async(name: str, method: Callable[..., Any]) -> Callable[..., Any]:
+    operation = _operation(name)
+
+    @functools.wraps(method)
+    async def call(**kwargs):
+        in_flight.add(1)
+        try:
+            attempt = 0
+            while True:
+                wait = _acquire(operation)
+                if wait:
+                    await asyncio.sleep(wait)
+                started = time.monotonic()
+                try:
+                    return await method(**kwargs)
+                except Exception as e:
+                    delay = _backoff(operation, e, attempt, time.monotonic() - started)
+                    if delay is None:
+                        raise
+                await asyncio.sleep(delay)
+                attempt += 1
+        finally:
+            in_flight.add(-1)
+    return call
+
+
+def guard(client: Any) -> Any:
+    '''Puts the calls of a DynamoDB client or in-process backend under flow control. Returns it.'''
+    for name in OPERATIONS:
+        setattr(client, name, _guarded(name, getattr(client, name)))
+    return client
+
+def guard_async(client: Any) -> Any:
+    '''guard for aiobotocore clients, and other clients with coroutine methods.'''
+    for name in OPERATIONS:
+        setattr(client, name, _guarded_async(name, getattr(client, name)))
+    return client
+
+class _Unguarded:
+    def __init__(self, client: Any):
+        self._client = client
+
+    def __getattr__(self, name: str):
+        method = getattr(self._client, name)
+        return getattr(method, '__wrapped__', method)
+
+def unguarded(client: Any) -> Any:
+    '''The operations of a guarded client, without flow control.'''
+    return _Unguarded(client)
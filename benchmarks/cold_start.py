@@ -0,0 +1,126 @@
+'''Measures the cold start of the Lambda handler.
+
+Each run starts a fresh interpreter that imports api (with -X importtime) and
+sends requests through api.handler, the way Lambda does. Reported are the
+import time of each module api imports, and the latency of the first and
+second requests, and of the first OpenAPI document request, generated and
+prebuilt (python app/api.py --write-openapi).
+
+The DynamoDB client is created as in production, from botocore with dummy
+credentials, but requests are served by the in-memory engine, so nothing
+goes over the network and runs are comparable.
+
+    python benchmarks/cold_start.py --runs 10
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+
+TABLE_ENV = {
+    'BASE_PATH': 'blog',
+    'BLOG_TABLE': 'BlogBenchmark',
+    'BLOG_TABLE_ENTITY_INDEX': 'EntityType-CreatedAt-IndexV2',
+    'BLOG_TABLE_AUTHOR_INDEX': 'AuthorEmail_EntityType-CreatedAt-IndexV3',
+}
+
+CHILD = '''
+import json, time
+started = time.perf_counter()
+import api
+imported = time.perf_counter()
+
+from backends import create_backend
+import store
+store.dynamodb = create_backend('memory')
+
+def request(path):
+    event = {'httpMethod': 'GET', 'path': path, 'headers': {}, 'multiValueQueryStringParameters': None,
+             'requestContext': {}, 'body': None, 'isBase64Encoded': False}
+    start = time.perf_counter()
+    response = api.handler(event, None)
+    assert response['statusCode'] == 200, response
+    return time.perf_counter() - start
+
+timings = {'import api': imported - started}
+timings['first GET /posts'] = request('/blog/posts')
+timings['second GET /posts'] = request('/blog/posts')
+timings['first GET /openapi.json'] = request('/blog/openapi.json')
+print(json.dumps(timings))
+'''
+
+
+def module_import_times(importtime: str) -> Dict[str, float]:
+    '''Cumulative import time of each module imported directly by api, in seconds.'''
+    times: Dict[str, float] = {}
+    for line in importtime.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are indented by two spaces per level, and listed
+        # before the module that imports them
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            if name.strip() == 'api':
+                return times
+            times = {}
+        elif depth == 1:
+            times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def run_once(prebuilt_openapi: bool) -> Dict[str, float]:
+    env = dict(os.environ, **TABLE_ENV, BLOG_STORAGE_ENGINE='dynamodb', BLOG_WARM_ON_INIT='0',
+               AWS_DEFAULT_REGION='us-east-1', AWS_ACCESS_KEY_ID='benchmark', AWS_SECRET_ACCESS_KEY='benchmark')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHILD], cwd=APP, env=env,
+                            capture_output=True, text=True, check=True)
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    if prebuilt_openapi:
+        timings['first GET /openapi.json (prebuilt)'] = timings.pop('first GET /openapi.json')
+    else:
+        timings['first GET /openapi.json (generated)'] = timings.pop('first GET /openapi.json')
+    for name, seconds in module_import_times(result.stderr).items():
+        timings[f'  import {name}'] = seconds
+    return timings
+
+
+def write_openapi():
+    env = dict(os.environ, **TABLE_ENV, BLOG_STORAGE_ENGINE='memory')
+    subprocess.run([sys.executable, 'api.py', '--write-openapi'], cwd=APP, env=env, check=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10, help='fresh interpreters per configuration')
+    args = parser.parse_args()
+
+    openapi_path = os.path.join(APP, 'openapi.json')
+    existing = os.path.exists(openapi_path)
+    if existing:
+        os.rename(openapi_path, openapi_path + '.bak')
+    runs: List[Dict[str, float]] = []
+    try:
+        runs += [run_once(prebuilt_openapi=False) for _ in range(args.runs)]
+        write_openapi()
+        runs += [run_once(prebuilt_openapi=True) for _ in range(args.runs)]
+    finally:
+        if os.path.exists(openapi_path):
+            os.remove(openapi_path)
+        if existing:
+            os.rename(openapi_path + '.bak', openapi_path)
+
+    stages = list(dict.fromkeys(stage for timings in runs for stage in timings))
+    # Modules first imported by api, largest first, after the overall import time
+    modules = sorted((stage for stage in stages if stage.startswith('  ')),
+                     key=lambda stage: -statistics.median(t[stage] for t in runs if stage in t))
+    requests = [stage for stage in stages if not stage.startswith(' ') and stage != 'import api']
+    print(f'{args.runs} runs per configuration, {sys.version.split()[0]}\n')
+    print(f'{"stage":<40} {"median":>9} {"max":>9}')
+    for stage in ['import api'] + modules + requests:
+        samples = [timings[stage] for timings in runs if stage in timings]
+        print(f'{stage:<40} {statistics.median(samples) * 1000:>7.1f}ms {max(samples) * 1000:>7.1f}ms')
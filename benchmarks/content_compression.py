@@ -0,0 +1,125 @@
+'''Compares storing post content plain and compressed.
+
+Generates a corpus of article-like posts and, for each storage mode, reports
+the DynamoDB capacity units a write and a read of each post consume, and the
+latency of create_post and get_post against the in-memory engine (which
+includes compressing and decompressing, but not the network transfer that
+smaller items also save).
+
+    python benchmarks/content_compression.py --posts 500
+'''
+import argparse
+import math
+import os
+import random
+import statistics
+import sys
+import time
+from typing import Any, Dict, List
+
+os.environ.setdefault('BLOG_TABLE', 'BlogBenchmark')
+os.environ.setdefault('BLOG_TABLE_ENTITY_INDEX', 'EntityType-CreatedAt-IndexV2')
+os.environ.setdefault('BLOG_TABLE_AUTHOR_INDEX', 'AuthorEmail_EntityType-CreatedAt-IndexV3')
+os.environ['BLOG_STORAGE_ENGINE'] = 'memory'
+os.environ['BLOG_CACHE_SIZE'] = '0'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+import content
+import store
+from backends import create_backend
+from models import NewPost
+
+WORDS = ('the of and to in is that for it as with was on be by this are or from at an not have which but '
+         'data table query index partition key item read write capacity request latency throughput cache '
+         'python function service deploy lambda api gateway client server response error retry batch '
+         'performance cost scale design pattern model schema access single value attribute sort range '
+         'time user post comment author page token limit result example code test build release').split()
+
+
+def article(rng: random.Random, size: int) -> str:
+    '''Markdown-ish text with a Zipf-like word distribution, headings and code blocks.'''
+    weights = [1 / (rank + 1) for rank in range(len(WORDS))]
+    parts, length = [], 0
+    while length < size:
+        kind = rng.random()
+        if kind < 0.1:
+            text = '## ' + ' '.join(rng.choices(WORDS, weights, k=rng.randint(3, 7))).capitalize()
+        elif kind < 0.2:
+            text = '```python\n' + '\n'.join(
+                f'{rng.choice(WORDS)}_{rng.choice(WORDS)} = {rng.choice(WORDS)}({rng.randint(0, 999)})'
+                for _ in range(rng.randint(2, 8))) + '\n```'
+        else:
+            sentences = [' '.join(rng.choices(WORDS, weights, k=rng.randint(8, 24))).capitalize() + '.'
+                         for _ in range(rng.randint(2, 6))]
+            text = ' '.join(sentences)
+        parts.append(text)
+        length += len(text) + 2
+    return '\n\n'.join(parts)[:size]
+
+
+def corpus(count: int, seed: int=42) -> List[NewPost]:
+    # Post lengths are roughly log-normal, from short notes to long articles
+    rng = random.Random(seed)
+    return [NewPost(slug=f'post-{i}', title=f'Post {i}', author_email='author@example.com',
+                    content=article(rng, min(600_000, int(rng.lognormvariate(math.log(6000), 1.0)))))
+            for i in range(count)]
+
+
+def item_size(item: Dict[str, Dict[str, Any]]) -> int:
+    '''Item size as DynamoDB counts it: attribute names plus values.'''
+    size = 0
+    for name, value in item.items():
+        (type_, raw), = value.items()
+        size += len(name.encode()) + (len(raw) if type_ == 'B' else len(str(raw).encode()))
+    return size
+
+
+def run(posts: List[NewPost], compression: str, threshold: int) -> Dict[str, float]:
+    content.COMPRESSION, content.COMPRESSION_THRESHOLD = compression, threshold
+    store.dynamodb = create_backend('memory')
+
+    sizes, write_times, read_times = [], [], []
+    for post in posts:
+        start = time.perf_counter()
+        store.create_post(post)
+        write_times.append(time.perf_counter() - start)
+    for post in posts:
+        start = time.perf_counter()
+        store.get_post(post.slug)
+        read_times.append(time.perf_counter() - start)
+        item = store.dynamodb.get_item(
+            TableName=os.environ['BLOG_TABLE'],
+            Key={'PK': {'S': f'P#{post.slug}'}, 'SK': {'S': f'P#{post.slug}'}},
+        )['Item']
+        sizes.append(item_size(item))
+
+    return {
+        'size': statistics.mean(sizes),
+        # Writes use 1 WCU per KB, eventually consistent reads 0.5 RCU per 4 KB
+        'wcu': sum(math.ceil(size / 1024) for size in sizes),
+        'rcu': sum(math.ceil(size / 4096) * 0.5 for size in sizes),
+        'write_ms': statistics.median(write_times) * 1000,
+        'read_ms': statistics.median(read_times) * 1000,
+        'over_limit': sum(size > 400 * 1024 for size in sizes),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--posts', type=int, default=500)
+    parser.add_argument('--threshold', type=int, default=content.COMPRESSION_THRESHOLD)
+    args = parser.parse_args()
+
+    posts = corpus(args.posts)
+    print(f'{len(posts)} posts, median content {statistics.median(len(p.content) for p in posts)} bytes, '
+          f'threshold {args.threshold} bytes\n')
+    print(f'{"mode":<6} {"avg item":>10} {"WCU":>8} {"RCU":>8} {"write p50":>10} {"read p50":>10} {">400KB":>7}')
+    baseline = None
+    for compression in ['none'] + list(content.CODECS):
+        result = run(posts, compression, args.threshold)
+        baseline = baseline or result
+        print(f'{compression:<6} {result["size"]:>9.0f}B {result["wcu"]:>8} {result["rcu"]:>8.1f} '
+              f'{result["write_ms"]:>8.3f}ms {result["read_ms"]:>8.3f}ms {result["over_limit"]:>7}'
+              + ('' if result is baseline else
+                 f'   ({1 - result["wcu"] / baseline["wcu"]:.0%} fewer WCU, '
+                 f'{1 - result["rcu"] / baseline["rcu"]:.0%} fewer RCU)'))
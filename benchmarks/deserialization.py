@@ -0,0 +1,115 @@
+'''Compares turning a page of DynamoDB items into a JSON response, validated and trusted.
+
+"validated" is how pages were served before: each item parsed with dateutil
+and validated into its model, the page validated into its list model, and
+the response validated against the response_model and encoded by FastAPI.
+"trusted" is the current path: from_dynamo_item (fromisoformat and
+construct()), an unvalidated list model, and api.model_response.
+
+    python benchmarks/deserialization.py --seconds 1
+'''
+import argparse
+import asyncio
+from datetime import datetime, timedelta
+import os
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+os.environ.setdefault('BASE_PATH', 'blog')
+os.environ.setdefault('BLOG_TABLE', 'BlogBenchmark')
+os.environ.setdefault('BLOG_TABLE_ENTITY_INDEX', 'EntityType-CreatedAt-IndexV2')
+os.environ.setdefault('BLOG_TABLE_AUTHOR_INDEX', 'AuthorEmail_EntityType-CreatedAt-IndexV3')
+os.environ['BLOG_STORAGE_ENGINE'] = 'memory'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from dateutil.parser import isoparse
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+import api
+import models
+import store
+from models import (Comment, CommentList, NewComment, NewPost, NewUser, PostList, PostListItem, User,
+    UserList)
+
+PAGES = {
+    'posts': (PostListItem, PostList, 'posts'),
+    'comments': (Comment, CommentList, 'comments'),
+    'users': (User, UserList, 'users'),
+}
+
+
+def items(kind: str, count: int) -> List[Dict[str, Any]]:
+    start = datetime(2021, 3, 1, 12, 0, 0, 123456)
+    created = [(start + timedelta(seconds=i)).isoformat() for i in range(count)]
+    if kind == 'posts':
+        return [store._new_post_item(NewPost(slug=f'post-{i}', title=f'Post number {i}',
+                                             author_email='author@example.com', content='x' * 200), created[i])
+                for i in range(count)]
+    elif kind == 'comments':
+        return [store._new_comment_item('post-1', NewComment(author_email=f'reader{i}@example.com',
+                                                             content='Nice post! ' * 5), created[i])
+                for i in range(count)]
+    return [store._new_user_item(NewUser(email=f'user{i}@example.com', first_name='First', last_name='Last',
+                                         role='Reader'), created[i])
+            for i in range(count)]
+
+
+def validated_item(model: Any, item: Dict[str, Dict[str, Any]]) -> Any:
+    '''from_dynamo_item as it was: dateutil, and the model's validation.'''
+    values = {}
+    for name, attribute in model.FIELD_ATTRIBUTES.items():
+        if attribute not in item:
+            continue
+        if attribute == 'CommentCount':
+            values[name] = int(item[attribute]['N'])
+            continue
+        value = item[attribute]['S']
+        if name in ('created_at', 'updated_at', 'last_comment_at'):
+            values[name] = isoparse(value)
+        else:
+            values[name] = value[2:] if attribute == 'PK' else value
+    return model(**values)
+
+
+def validated(kind: str, page: List[Dict[str, Any]]) -> bytes:
+    model, list_model, name = PAGES[kind]
+    result = list_model(**{name: [validated_item(model, item) for item in page]}, nextPageToken='token')
+    field = create_response_field(name='Response', type_=list_model)
+    content = asyncio.get_event_loop().run_until_complete(
+        serialize_response(field=field, response_content=result, exclude_unset=kind != 'users'))
+    return JSONResponse(content).body
+
+
+def trusted(kind: str, page: List[Dict[str, Any]]) -> bytes:
+    model, list_model, name = PAGES[kind]
+    result = list_model.construct(**{name: [model.from_dynamo_item(item) for item in page]}, nextPageToken='token')
+    return api.model_response(result, exclude_unset=kind != 'users').body
+
+
+def items_per_second(serve: Callable[[str, List[Dict[str, Any]]], bytes], kind: str,
+    page: List[Dict[str, Any]], seconds: float) -> float:
+    served, started = 0, time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        serve(kind, page)
+        served += len(page)
+    return served / (time.perf_counter() - started)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--seconds', type=float, default=1.0, help='time spent on each measurement')
+    args = parser.parse_args()
+
+    print(f'JSON encoder: {"orjson" if models.orjson is not None else "json"}\n')
+    print(f'{"page":<16} {"validated":>14} {"trusted":>14} {"speedup":>8}')
+    for kind in PAGES:
+        for size in (20, 1000):
+            page = items(kind, size)
+            # The same response either way, apart from the separators the encoders use
+            assert validated(kind, page).replace(b' ', b'') == trusted(kind, page).replace(b' ', b'')
+            before = items_per_second(validated, kind, page, args.seconds)
+            after = items_per_second(trusted, kind, page, args.seconds)
+            print(f'{f"{size} {kind}":<16} {before:>8.0f} items/s {after:>8.0f} items/s {after / before:>7.1f}x')
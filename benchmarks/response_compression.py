@@ -0,0 +1,84 @@
+'''Compares response compression: encodings, and compressing get_post each time or once.
+
+For the article-like posts of content_compression.py, reports the size of
+the GET /posts/{slug} body in each encoding the process supports, the CPU
+time compressing it takes, and the latency of get_post against the
+in-memory engine with the cache of compressed posts and without it.
+
+    python benchmarks/response_compression.py --posts 200
+'''
+import argparse
+import os
+import statistics
+import sys
+import time
+from typing import Dict, List
+
+os.environ.setdefault('BASE_PATH', 'blog')
+os.environ.setdefault('BLOG_TABLE', 'BlogBenchmark')
+os.environ.setdefault('BLOG_TABLE_ENTITY_INDEX', 'EntityType-CreatedAt-IndexV2')
+os.environ.setdefault('BLOG_TABLE_AUTHOR_INDEX', 'AuthorEmail_EntityType-CreatedAt-IndexV3')
+os.environ['BLOG_STORAGE_ENGINE'] = 'memory'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from starlette.testclient import TestClient
+
+import api
+import compression
+from content_compression import corpus
+from models import NewUser
+
+
+def sizes(bodies: List[bytes], encoding: str) -> Dict[str, float]:
+    compressed, seconds = [], []
+    for body in bodies:
+        started = time.thread_time()
+        compressed.append(len(compression.compress(body, encoding)))
+        seconds.append(time.thread_time() - started)
+    return {'ratio': sum(compressed) / sum(len(body) for body in bodies),
+            'cpu_ms': statistics.mean(seconds) * 1000, 'cpu_p99_ms': sorted(seconds)[int(len(seconds) * 0.99)] * 1000}
+
+
+def get_latency(client: TestClient, slugs: List[str], encoding: str, rounds: int) -> float:
+    times = []
+    for _ in range(rounds):
+        for slug in slugs:
+            started = time.perf_counter()
+            response = client.get(f'/blog/posts/{slug}', headers={'Accept-Encoding': encoding})
+            times.append(time.perf_counter() - started)
+            assert response.status_code == 200
+    return statistics.median(times) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--posts', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=5, help='times each post is read')
+    args = parser.parse_args()
+
+    posts = corpus(args.posts)
+    with TestClient(api.app) as client:
+        api.store.create_user(NewUser(email='author@example.com', first_name='A', last_name='Author', role='Author'))
+        for post in posts:
+            api.store.create_post(post)
+        bodies = [client.get(f'/blog/posts/{post.slug}', headers={'Accept-Encoding': 'identity'}).content
+                  for post in posts]
+        print(f'{len(posts)} posts, median body {statistics.median(len(body) for body in bodies):.0f} bytes\n')
+
+        print(f'{"encoding":<9} {"size":>7} {"CPU mean":>10} {"CPU p99":>10}')
+        for encoding in compression.SUPPORTED:
+            result = sizes(bodies, encoding)
+            print(f'{encoding:<9} {result["ratio"]:>7.1%} {result["cpu_ms"]:>8.3f}ms {result["cpu_p99_ms"]:>8.3f}ms')
+
+        print(f'\n{"get_post":<22} {"p50":>10}')
+        slugs = [post.slug for post in posts]
+        print(f'{"identity":<22} {get_latency(client, slugs, "identity", args.rounds):>8.3f}ms')
+        for encoding in compression.SUPPORTED:
+            cache = api.compressed_posts._cache
+            maxsize, cache.maxsize = cache.maxsize, 0
+            uncached = get_latency(client, slugs, encoding, args.rounds)
+            cache.maxsize = maxsize
+            cache.clear()
+            cached = get_latency(client, slugs, encoding, args.rounds)
+            print(f'{encoding + " each time":<22} {uncached:>8.3f}ms')
+            print(f'{encoding + " once":<22} {cached:>8.3f}ms')
@@ -0,0 +1,104 @@
+'''Loads the API past the capacity of a simulated table, to see how it sheds load.
+
+Requests for posts are sent by concurrent threads for a while, to the in-memory
+engine behind a FaultInjectingBackend that throttles calls beyond --capacity
+per second. Caches and the coalescing of reads are off, so every request reads
+the table. Reported are the responses by status, their latencies, and the
+retries, shed calls and rate limit of the throttling module.
+
+    python benchmarks/throttling.py --capacity 200 --concurrency 32 --seconds 5
+'''
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Dict, List, Tuple
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--capacity', type=float, default=200, help='calls per second the table takes')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of calls that fail with a 500')
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds added to each call')
+    parser.add_argument('--concurrency', type=int, default=32, help='requests in flight')
+    parser.add_argument('--seconds', type=float, default=5.0, help='duration of the load')
+    args = parser.parse_args()
+
+    os.environ.update({
+        'BASE_PATH': 'blog',
+        'BLOG_TABLE': 'BlogBenchmark',
+        'BLOG_TABLE_ENTITY_INDEX': 'EntityType-CreatedAt-IndexV2',
+        'BLOG_TABLE_AUTHOR_INDEX': 'AuthorEmail_EntityType-CreatedAt-IndexV3',
+        'BLOG_STORAGE_ENGINE': 'memory',
+        'BLOG_STORAGE_FAULTS': json.dumps({'capacity': args.capacity, 'error_rate': args.error_rate,
+                                           'latency': args.latency}),
+        'BLOG_CACHE_SIZE': '0',
+        'BLOG_COALESCE_READS': '0',
+    })
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from starlette.testclient import TestClient
+
+import api
+import instrumentation
+import store
+import throttling
+from models import NewPost, NewUser
+
+POSTS = 100
+
+
+def seed():
+    '''Writes posts straight to the engine, without the fault injection.'''
+    backend = store.dynamodb._backend
+    created = '2021-03-01T12:00:00.000000'
+    backend.put_item(TableName=os.environ['BLOG_TABLE'], Item=store._new_user_item(
+        NewUser(email='author@example.com', first_name='First', last_name='Last', role='Author'), created))
+    for i in range(POSTS):
+        backend.put_item(TableName=os.environ['BLOG_TABLE'], Item=store._new_post_item(
+            NewPost(slug=f'post-{i}', title=f'Post {i}', author_email='author@example.com', content='x' * 200),
+            created))
+
+
+def load(client: TestClient, concurrency: int, seconds: float) -> List[Tuple[int, float]]:
+    '''Status and latency of each request sent.'''
+    until = time.perf_counter() + seconds
+
+    def worker(n: int) -> List[Tuple[int, float]]:
+        results, i = [], n
+        while time.perf_counter() < until:
+            started = time.perf_counter()
+            response = client.get(f'/blog/posts/post-{i % POSTS}')
+            results.append((response.status_code, time.perf_counter() - started))
+            i += concurrency
+        return results
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return [result for results in executor.map(worker, range(concurrency)) for result in results]
+
+
+def counters(metric: instrumentation.Counter) -> Dict[str, float]:
+    '''Values of a counter by reason, summed over operations.'''
+    totals: Dict[str, float] = {}
+    for labels, value in metric._values.items():
+        reason = dict(labels)['reason']
+        totals[reason] = totals.get(reason, 0.0) + value
+    return totals
+
+
+if __name__ == '__main__':
+    seed()
+    results = load(TestClient(api.app), args.concurrency, args.seconds)
+
+    print(f'{len(results) / args.seconds:.0f} requests/s against a capacity of {args.capacity:g} calls/s\n')
+    print(f'{"status":<8} {"requests":>9} {"p50":>9} {"p99":>9}')
+    for status in sorted({status for status, _ in results}):
+        latencies = sorted(seconds for code, seconds in results if code == status)
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(f'{status:<8} {len(latencies):>9} {statistics.median(latencies) * 1000:>7.1f}ms {p99 * 1000:>7.1f}ms')
+    print(f'\nretries: {counters(instrumentation.DYNAMODB_RETRIES)}')
+    print(f'shed: {counters(instrumentation.DYNAMODB_SHED)}')
+    rate = throttling.limiter.rate
+    print(f'rate limit: {f"{rate:.0f} calls/s" if rate is not None else "none"}')
@@ -0,0 +1,47 @@
+'''Runs the API and stores on the in-memory engine, with a fresh table for each test.
+
+    python -m pytest tests
+'''
+import os
+import sys
+
+os.environ.setdefault('BASE_PATH', 'blog')
+os.environ.setdefault('BLOG_TABLE', 'BlogTest')
+os.environ.setdefault('BLOG_TABLE_ENTITY_INDEX', 'EntityType-CreatedAt-IndexV2')
+os.environ.setdefault('BLOG_TABLE_AUTHOR_INDEX', 'AuthorEmail_EntityType-CreatedAt-IndexV3')
+os.environ['BLOG_STORAGE_ENGINE'] = 'memory'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+import pytest
+from starlette.testclient import TestClient
+
+import api
+import store
+import throttling
+from memory_backend import InMemoryDynamoDB
+from models import NewUser
+from snapshot import PageSnapshot
+
+
+@pytest.fixture(autouse=True)
+def table(monkeypatch) -> InMemoryDynamoDB:
+    '''An empty table, with the caches, snapshots and rate limit of a new worker.'''
+    backend = InMemoryDynamoDB()
+    monkeypatch.setattr(store, 'dynamodb', throttling.guard(backend))
+    monkeypatch.setattr(store, 'search_index', None)
+    monkeypatch.setattr(store, '_listing_generations', {})
+    monkeypatch.setattr(throttling, 'limiter', throttling.AdaptiveRateLimiter())
+    monkeypatch.setattr(api, 'post_pages', PageSnapshot(api._posts_page))
+    monkeypatch.setattr(api, 'comment_pages', PageSnapshot(api._comments_page))
+    for cache in (store.user_cache, store.post_cache, store.page_cache):
+        cache.clear()
+    return backend
+
+@pytest.fixture
+def client() -> TestClient:
+    return TestClient(api.app)
+
+@pytest.fixture
+def author() -> str:
+    store.create_user(NewUser(email='author@example.com', first_name='Ada', last_name='Lovelace', role='Author'))
+    return 'author@example.com'
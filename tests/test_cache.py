@@ -0,0 +1,86 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from cache import SingleFlight
+import store
+from models import NewPost
+
+
+def wait_until(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_concurrent_calls_for_a_key_share_one():
+    flights = SingleFlight()
+    release = threading.Event()
+    calls = []
+    def read():
+        calls.append(1)
+        release.wait(5)
+        return {'Item': len(calls)}
+    with ThreadPoolExecutor(5) as executor:
+        results = [executor.submit(flights.do, 'key', read) for _ in range(5)]
+        wait_until(lambda: flights.stats()['coalesced'] == 4)
+        release.set()
+        assert [result.result() for result in results] == [{'Item': 1}] * 5
+    assert len(calls) == 1
+    assert flights.stats() == {'calls': 1, 'coalesced': 4, 'in_flight': 0}
+    # Later calls are made again
+    assert flights.do('key', read) == {'Item': 2}
+
+def test_an_error_is_raised_to_every_caller():
+    flights = SingleFlight()
+    release = threading.Event()
+    def read():
+        release.wait(5)
+        raise ValueError('read failed')
+    with ThreadPoolExecutor(3) as executor:
+        results = [executor.submit(flights.do, 'key', read) for _ in range(3)]
+        wait_until(lambda: flights.stats()['coalesced'] == 2)
+        release.set()
+        for result in results:
+            with pytest.raises(ValueError, match='read failed'):
+                result.result()
+    assert flights.stats()['in_flight'] == 0
+
+def test_coroutines_share_one_call_and_its_error():
+    flights = SingleFlight()
+    calls = []
+    async def read():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        if len(calls) > 1:
+            raise ValueError('read failed')
+        return 'item'
+    async def run():
+        assert await asyncio.gather(*(flights.do_async('key', read) for _ in range(4))) == ['item'] * 4
+        results = await asyncio.gather(*(flights.do_async('key', read) for _ in range(2)), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+    asyncio.run(run())
+    assert len(calls) == 2 and flights.stats()['coalesced'] == 4
+
+def test_concurrent_reads_of_a_post_make_one_get_item(monkeypatch, table, author):
+    store.create_post(NewPost(slug='hello', title='Hello', author_email=author, content='Hi'))
+    store.post_cache.clear()
+    release = threading.Event()
+    calls = []
+    get_item = table.get_item
+    def slow_get_item(**kwargs):
+        calls.append(kwargs)
+        release.wait(5)
+        return get_item(**kwargs)
+    monkeypatch.setattr(table, 'get_item', slow_get_item)
+    coalesced = store.get_item_flights.stats()['coalesced']
+    with ThreadPoolExecutor(4) as executor:
+        results = [executor.submit(store.get_post, 'hello') for _ in range(4)]
+        wait_until(lambda: store.get_item_flights.stats()['coalesced'] == coalesced + 3)
+        release.set()
+        assert [result.result().slug for result in results] == ['hello'] * 4
+    assert len(calls) == 1
@@ -0,0 +1,157 @@
+import asyncio
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import pytest
+
+import api
+import snapshot
+import store
+import throttling
+from memory_backend import InMemoryDynamoDB
+from models import NewComment, NewPost, NewUser, UpdatedPost
+from snapshot import PageSnapshot
+
+
+def new_post(author: str, i: int) -> NewPost:
+    return NewPost(slug=f'post-{i:02d}', title=f'Post {i}', author_email=author, content='Hi')
+
+def page_through(limit: int) -> List[Tuple[List[str], bool, bool]]:
+    '''The slugs of each page of the posts, and whether it has a next and previous
+    page, going forward to the last page and then back to the first.'''
+    pages = []
+    page = store.list_posts(None, limit)
+    while True:
+        pages.append(([post.slug for post in page.posts], page.nextPageToken is not None,
+                      page.prevPageToken is not None))
+        if page.nextPageToken is None:
+            break
+        page = store.list_posts(page.nextPageToken, limit)
+    while page.prevPageToken is not None:
+        page = store.list_posts(page.prevPageToken, limit)
+        pages.append(([post.slug for post in page.posts], page.nextPageToken is not None,
+                      page.prevPageToken is not None))
+    return pages
+
+
+def test_sharded_listings_page_like_unsharded_ones(monkeypatch, author):
+    listings = {}
+    for shards in (1, 4):
+        monkeypatch.setattr(store, 'dynamodb', throttling.guard(InMemoryDynamoDB()))
+        monkeypatch.setattr(store, 'ENTITY_SHARDS', shards)
+        store.user_cache.clear()
+        store.create_user(NewUser(email=author, first_name='Ada', last_name='Lovelace', role='Author'))
+        for i in range(23):
+            store.create_post(new_post(author, i))
+        listings[shards] = page_through(limit=5)
+
+    assert listings[4] == listings[1]
+    forward = [slug for slugs, _, _ in listings[1][:5] for slug in slugs]
+    assert forward == [f'post-{i:02d}' for i in range(22, -1, -1)]
+    # Back from the last page to the first
+    assert [slugs for slugs, _, _ in listings[1][5:]] == [slugs for slugs, _, _ in listings[1][3::-1]]
+
+def test_page_tokens_of_another_shard_count_are_rejected(monkeypatch, author):
+    for i in range(3):
+        store.create_post(new_post(author, i))
+    token = store.list_posts(None, 2).nextPageToken
+    monkeypatch.setattr(store, 'ENTITY_SHARDS', 4)
+    with pytest.raises(store.InvalidPageTokenError):
+        store.list_posts(token, 2)
+
+
+def build(snap: PageSnapshot):
+    '''Starts building the snapshot, and waits for the build.'''
+    async def start_and_wait():
+        assert snap.get(None) is None
+        await snap._building
+    asyncio.run(start_and_wait())
+
+def test_snapshots_serve_pages_until_a_write(monkeypatch):
+    monkeypatch.setattr(snapshot, 'SETTLE_SECONDS', 60)
+    fetched = []
+    async def fetch(page_token: Optional[str]) -> Tuple[bytes, Optional[str]]:
+        fetched.append(page_token)
+        return (b'first', 'second') if page_token is None else (b'second', None)
+    snap = PageSnapshot(fetch, pages=2, ttl=60)
+    build(snap)
+    assert fetched == [None, 'second']
+    assert snap.get(None)[0] == b'first' and snap.get('second')[0] == b'second'
+
+    snap.invalidate()
+    # Not rebuilt until the write has settled in the index
+    async def get_after_write():
+        return snap.get(None), snap._building
+    page, building = asyncio.run(get_after_write())
+    assert page is None and building.done() and fetched == [None, 'second']
+
+def test_a_build_overlapping_a_write_is_dropped():
+    async def fetch(page_token: Optional[str]) -> Tuple[bytes, Optional[str]]:
+        snap.invalidate()
+        return b'stale', None
+    snap = PageSnapshot(fetch, pages=2, ttl=60)
+    build(snap)
+    assert snap.stats()['builds'] == 0 and snap.stats()['size'] == 0
+
+def test_write_routes_drop_the_snapshots(client, author):
+    client.post('/blog/posts', json={'slug': 'hello', 'title': 'Hello', 'author_email': author, 'content': 'Hi'})
+    assert api.post_pages.invalidations == 1 and api.comment_pages.invalidations == 1
+    client.post('/blog/posts/hello/comments/', json={'author_email': author, 'content': 'Hi'})
+    assert api.post_pages.invalidations == 2 and api.comment_pages.invalidations == 2
+    assert client.get('/blog/posts').json()['posts'][0]['comment_count'] == 1
+
+
+def wait_for_prefetches():
+    deadline = time.monotonic() + 5
+    while store._prefetching and time.monotonic() < deadline:
+        time.sleep(0.005)
+
+def test_prefetched_pages_are_served_until_a_write(monkeypatch, table, author):
+    monkeypatch.setattr(store, 'PREFETCH_PAGES', True)
+    for i in range(12):
+        store.create_post(new_post(author, i))
+    first = store.list_posts(None, 5)
+    wait_for_prefetches()
+
+    # Made by this thread, rather than by prefetches in the background
+    queries = []
+    query = table.query
+    monkeypatch.setattr(table, 'query', lambda **kwargs: queries.append(threading.current_thread()) or query(**kwargs))
+    second = store.list_posts(first.nextPageToken, 5)
+    assert threading.current_thread() not in queries
+    assert [post.slug for post in second.posts] == [f'post-{i:02d}' for i in range(6, 1, -1)]
+
+    wait_for_prefetches()
+    store.update_post('post-05', UpdatedPost(title='Changed', author_email=author, content='Hi'))
+    second = store.list_posts(first.nextPageToken, 5)
+    assert threading.current_thread() in queries
+    assert [post.title for post in second.posts if post.slug == 'post-05'] == ['Changed']
+
+
+def test_a_post_is_read_with_its_first_comments(client, author):
+    store.create_post(new_post(author, 1))
+    for i in range(3):
+        store.create_comment('post-01', NewComment(author_email=author, content=f'Comment {i}'))
+    response = client.get('/blog/posts/post-01?include=comments&commentLimit=2')
+    assert response.status_code == 200
+    post = response.json()
+    assert post['slug'] == 'post-01' and post['comment_count'] == 3
+    assert [comment['content'] for comment in post['comments']] == ['Comment 2', 'Comment 1']
+    rest = store.list_comments_for_post('post-01', post['commentsNextPageToken'], 2)
+    assert [comment.content for comment in rest.comments] == ['Comment 0']
+
+def test_a_post_without_comments_is_read_with_none(client, author):
+    store.create_post(new_post(author, 1))
+    post = client.get('/blog/posts/post-01?include=comments').json()
+    assert post['slug'] == 'post-01' and post['comments'] == []
+    assert post.get('commentsNextPageToken') is None
+
+def test_a_missing_post_with_comments_is_404(client):
+    response = client.get('/blog/posts/missing?include=comments')
+    assert response.status_code == 404 and response.json() == {'error': 'Post not found'}
+
+@pytest.mark.parametrize('limit', [0, -1, 101])
+def test_comment_limits_out_of_range_are_rejected(client, author, limit):
+    store.create_post(new_post(author, 1))
+    assert client.get(f'/blog/posts/post-01?include=comments&commentLimit={limit}').status_code == 422
@@ -0,0 +1,131 @@
+import asyncio
+import threading
+import time
+
+from botocore.exceptions import ClientError
+import pytest
+
+import store
+import throttling
+from backends import AsyncBackend, FaultInjectingBackend
+from memory_backend import InMemoryDynamoDB
+from models import NewPost
+
+KEY = {'TableName': 'BlogTest', 'Key': {'PK': {'S': 'P#missing'}, 'SK': {'S': 'P#missing'}}}
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(throttling, 'BACKOFF_BASE', 0.001)
+
+@pytest.fixture
+def faults() -> FaultInjectingBackend:
+    return FaultInjectingBackend(InMemoryDynamoDB())
+
+def counted(backend: FaultInjectingBackend, calls: list) -> FaultInjectingBackend:
+    '''Counts the calls to get_item that reach the backend, failed or not.'''
+    get_item = backend.get_item
+    backend.get_item = lambda **kwargs: calls.append(kwargs) or get_item(**kwargs)
+    return backend
+
+def throttle_everything(backend: FaultInjectingBackend):
+    backend.capacity = 1e-6
+    backend._tokens = 0.0
+
+def within_deadline(seconds: float):
+    return throttling._deadline.set(time.monotonic() + seconds)
+
+
+def test_errors_are_retried_up_to_max_attempts(faults):
+    calls = []
+    client = throttling.guard(counted(faults, calls))
+    faults.error_rate = 1.0
+    with pytest.raises(ClientError) as error:
+        client.get_item(**KEY)
+    assert error.value.response['Error']['Code'] == 'InternalServerError'
+    assert len(calls) == throttling.MAX_ATTEMPTS
+
+def test_async_calls_are_retried_up_to_max_attempts(faults):
+    calls = []
+    client = throttling.guard_async(AsyncBackend(counted(faults, calls)))
+    throttle_everything(faults)
+    with pytest.raises(ClientError) as error:
+        asyncio.run(client.get_item(**KEY))
+    assert error.value.response['Error']['Code'] == 'ProvisionedThroughputExceededException'
+    assert len(calls) == throttling.MAX_ATTEMPTS
+
+def test_a_retried_call_succeeds():
+    calls = []
+    def get_item(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise ClientError({'Error': {'Code': 'InternalServerError'}, 'ResponseMetadata': {'HTTPStatusCode': 500}},
+                              'GetItem')
+        return {}
+    assert throttling._guarded('get_item', get_item)(**KEY) == {}
+    assert len(calls) == 2
+
+def test_no_retry_past_the_deadline(faults):
+    calls = []
+    client = throttling.guard(counted(faults, calls))
+    faults.error_rate = 1.0
+    faults.latency = 0.05
+    token = within_deadline(0.08)
+    try:
+        with pytest.raises(ClientError):
+            client.get_item(**KEY)
+    finally:
+        throttling._deadline.reset(token)
+    # A second attempt would have ended after the deadline
+    assert len(calls) == 1
+
+def test_throttled_call_of_a_request_is_shed(faults):
+    calls = []
+    client = throttling.guard(counted(faults, calls))
+    throttle_everything(faults)
+    token = within_deadline(10)
+    try:
+        with pytest.raises(throttling.Overloaded):
+            client.get_item(**KEY)
+    finally:
+        throttling._deadline.reset(token)
+    assert len(calls) == throttling.MAX_ATTEMPTS
+    assert throttling.limiter.rate is not None
+
+
+def test_throttled_request_gets_503_with_retry_after(client, table, monkeypatch, author):
+    store.create_post(NewPost(slug='hello', title='Hello', author_email=author, content='Hi'))
+    store.post_cache.clear()
+    faults = FaultInjectingBackend(throttling.unguarded(table))
+    monkeypatch.setattr(store, 'dynamodb', throttling.guard(faults))
+    throttle_everything(faults)
+    response = client.get('/blog/posts/hello')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+
+def test_rate_limited_request_gets_429_with_retry_after(client, monkeypatch, author):
+    store.create_post(NewPost(slug='hello', title='Hello', author_email=author, content='Hi'))
+    store.post_cache.clear()
+    monkeypatch.setattr(throttling, 'REQUEST_DEADLINE', 0.2)
+    # Throttled before sending anything, so down to its minimum of a call per second
+    monkeypatch.setattr(throttling, 'limiter', throttling.AdaptiveRateLimiter())
+    throttling.limiter.on_throttle()
+    throttling.limiter.reserve()
+    response = client.get('/blog/posts/hello')
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+
+
+def test_drain_waits_for_calls_in_flight(faults):
+    client = throttling.guard(faults)
+    faults.latency = 0.2
+    call = threading.Thread(target=client.get_item, kwargs=KEY)
+    call.start()
+    while not throttling.in_flight.count:
+        time.sleep(0.001)
+    assert asyncio.run(throttling.drain(0.01)) == 1
+    started = time.monotonic()
+    assert asyncio.run(throttling.drain(5)) == 0
+    assert time.monotonic() - started < 1
+    call.join(1)
+    assert not call.is_alive()
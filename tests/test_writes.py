@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+
+import pytest
+
+import store
+import throttling
+from models import NewComment, NewPost, NewUser, UpdatedPost
+
+
+@pytest.fixture
+def deletions(monkeypatch) -> list:
+    '''Deletions scheduled, to run with store.run_deletion rather than in the background.'''
+    scheduled = []
+    monkeypatch.setattr(store, 'schedule_deletion', lambda kind, target: scheduled.append((kind, target)) or True)
+    return scheduled
+
+def new_post(author: str, slug: str = 'hello') -> NewPost:
+    return NewPost(slug=slug, title='Hello', author_email=author, content='Hi')
+
+def comment_count(slug: str) -> int:
+    store.post_cache.clear()
+    return store.get_post(slug).comment_count
+
+
+def test_posts_need_an_existing_author():
+    with pytest.raises(store.UserNotFoundError):
+        store.create_post(new_post('nobody@example.com'))
+    store.create_user(NewUser(email='reader@example.com', first_name='R', last_name='Eader', role='Reader'))
+    with pytest.raises(store.NotAnAuthorError):
+        store.create_post(new_post('reader@example.com'))
+    with pytest.raises(store.NotFoundError):
+        store.get_post('hello')
+
+def test_updates_are_checked_against_the_author_too(author):
+    store.create_post(new_post(author))
+    store.create_user(NewUser(email='reader@example.com', first_name='R', last_name='Eader', role='Reader'))
+    with pytest.raises(store.NotAnAuthorError):
+        store.update_post('hello', UpdatedPost(title='Taken', author_email='reader@example.com', content='Hi'))
+    store.post_cache.clear()
+    assert store.get_post('hello').author_email == author
+
+def test_author_errors_are_answered_with_400(client, author):
+    post = {'slug': 'hello', 'title': 'Hello', 'content': 'Hi'}
+    response = client.post('/blog/posts', json={**post, 'author_email': 'nobody@example.com'})
+    assert response.status_code == 400 and response.json() == {'error': 'User does not exist'}
+
+def test_update_returns_the_post_as_stored(author):
+    store.create_post(new_post(author))
+    store.create_comment('hello', NewComment(author_email=author, content='First'))
+    # A stale cached copy doesn't leak into the response
+    store.post_cache.put('hello', store.Post(**{**store.get_post('hello').dict(), 'comment_count': 7}))
+    updated = store.update_post('hello', UpdatedPost(title='Changed', author_email=author, content='Hi'))
+    assert updated.title == 'Changed' and updated.comment_count == 1 and updated.last_comment_at is not None
+
+def test_update_reads_the_post_while_it_writes(monkeypatch, table, author):
+    store.create_post(new_post(author))
+    read = threading.Event()
+    get_item, transact_write_items = table.get_item, table.transact_write_items
+    monkeypatch.setattr(table, 'get_item', lambda **kwargs: read.set() or get_item(**kwargs))
+    # Sent after the read has started, as it is only if both are sent at once
+    def transact_after_read(**kwargs):
+        assert read.wait(5)
+        return transact_write_items(**kwargs)
+    monkeypatch.setattr(table, 'transact_write_items', transact_after_read)
+    updated = store.update_post('hello', UpdatedPost(title='Changed', author_email=author, content='Hi'))
+    assert updated.title == 'Changed' and updated.created_at == store.get_post('hello').created_at
+
+
+def test_comment_writes_keep_the_counters(author):
+    store.create_post(new_post(author))
+    comments = [store.create_comment('hello', NewComment(author_email=author, content=f'Comment {i}'))
+                for i in range(3)]
+    store.post_cache.clear()
+    post = store.get_post('hello')
+    assert post.comment_count == 3
+    assert post.last_comment_at == comments[-1].created_at
+
+    store.delete_comment('hello', author, comments[0].created_at)
+    assert comment_count('hello') == 2
+    # Deleting it again changes nothing
+    store.delete_comment('hello', author, comments[0].created_at)
+    assert comment_count('hello') == 2
+
+    result = store.batch_create_comments('hello', [NewComment(author_email=author, content='More')] * 4)
+    assert [status.status for status in result.results] == ['created'] * 4
+    assert comment_count('hello') == 6
+
+def test_comments_need_an_existing_post(author):
+    with pytest.raises(store.PostNotFoundError):
+        store.create_comment('missing', NewComment(author_email=author, content='Hi'))
+
+
+def test_deleting_a_post_deletes_its_comments(author, deletions):
+    store.create_post(new_post(author))
+    for i in range(3):
+        store.create_comment('hello', NewComment(author_email=author, content=f'Comment {i}'))
+    store.delete_post('hello')
+    assert deletions == [('post', 'hello')]
+    store.run_deletion('post', 'hello')
+    assert store.get_deletion('post', 'hello').status == 'done'
+    assert store.list_comments_for_post('hello').comments == []
+
+def test_a_recreated_post_keeps_its_new_comments(author, deletions):
+    store.create_post(new_post(author))
+    store.create_comment('hello', NewComment(author_email=author, content='Old'))
+    store.delete_post('hello')
+    time.sleep(0.001)
+    # Recreated under the same slug before the deletion job ran
+    store.create_post(new_post(author))
+    store.create_comment('hello', NewComment(author_email=author, content='New'))
+    store.run_deletion('post', 'hello')
+    assert [comment.content for comment in store.list_comments_for_post('hello').comments] == ['New']
+    assert store.get_post('hello').title == 'Hello'
+
+def test_a_recreated_user_keeps_their_new_posts(author, deletions):
+    store.create_post(new_post(author, 'old'))
+    store.delete_user(author)
+    time.sleep(0.001)
+    store.create_user(NewUser(email=author, first_name='Ada', last_name='Lovelace', role='Author'))
+    store.create_post(new_post(author, 'new'))
+    store.run_deletion('user', author)
+    assert [post.slug for post in store.list_posts_for_author(author).posts] == ['new']
+
+def test_failing_deletions_are_given_up_on(author, deletions, monkeypatch):
+    store.create_post(new_post(author))
+    store.delete_post('hello')
+    def fail(*args):
+        raise RuntimeError('Table unavailable')
+    monkeypatch.setattr(store, '_delete_comments', fail)
+    for _ in range(store.DELETION_MAX_ATTEMPTS):
+        assert store.resume_deletions() == [('post', 'hello')]
+        store.run_deletion('post', 'hello')
+    deletion = store.get_deletion('post', 'hello')
+    assert deletion.status == 'failed' and deletion.attempts == store.DELETION_MAX_ATTEMPTS
+    assert store.resume_deletions() == []
+
+
+def test_batches_resend_unprocessed_items(monkeypatch, table, author):
+    table_name = os.environ['BLOG_TABLE']
+    batch_write_item = table.batch_write_item
+    calls = []
+    def partly_processed(**kwargs):
+        calls.append(kwargs)
+        requests = kwargs['RequestItems'][table_name]
+        # The first call leaves its last item unprocessed, as a throttled table does
+        if len(calls) == 1:
+            batch_write_item(RequestItems={table_name: requests[:-1]})
+            return {'UnprocessedItems': {table_name: requests[-1:]}}
+        return batch_write_item(**kwargs)
+    monkeypatch.setattr(table, 'batch_write_item', partly_processed)
+    monkeypatch.setattr(throttling, 'BACKOFF_BASE', 0.001)
+    result = store.batch_create_posts([new_post(author, f'post-{i}') for i in range(3)])
+    assert [status.status for status in result.results] == ['created'] * 3
+    assert len(calls) == 2 and len(calls[1]['RequestItems'][table_name]) == 1
+    assert store.get_post('post-2').slug == 'post-2'